@@ -1,166 +1,1685 @@
 # Created by PlayerFridei
 # Version 0.3.6 Early Testing
 
+import io
+import os
+import re
 import sys
+import csv
+import json
+import copy
 import logging
+import ipaddress
 import random
-import readline
-from pymodbus.client import ModbusTcpClient
-from pymodbus.exceptions import ModbusException, ModbusIOException
-from prettytable import PrettyTable
 import socket
+import select
+import struct
+import threading
 import time
-import shtab
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import heappop, heappush
 from argparse import ArgumentParser
-from colorama import init, Fore, Style
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque, namedtuple
+from contextlib import redirect_stdout
+from types import SimpleNamespace
 
-# Initialize colorama
-init()
+# pymodbus, asyncio, prettytable, shtab and readline are imported where they
+# are first needed, so --help, --shtab, --diff and offline batches skip them.
+# colorama is only needed to translate ANSI escapes on Windows.
+if os.name == "nt":
+    from colorama import init, Fore, Style
+    init()
+else:
+    class Fore:
+        RED = "\033[31m"
+        GREEN = "\033[32m"
+        YELLOW = "\033[33m"
+        CYAN = "\033[36m"
 
-# Configure logging
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    class Style:
+        RESET_ALL = "\033[0m"
+
+# Stand-ins until load_modbus() runs; nothing raises pymodbus exceptions before
+# the first client exists, and our own decoders raise whichever is current
+class ModbusException(Exception):
+    pass
+
+class ModbusIOException(ModbusException):
+    pass
+
+ModbusTcpClient = None
+
+def load_modbus():
+    global ModbusTcpClient, ModbusException, ModbusIOException, asyncio
+    if ModbusTcpClient is None:
+        import asyncio
+        from pymodbus.client import ModbusTcpClient
+        from pymodbus.exceptions import ModbusException, ModbusIOException
+
+def modbus_client(host, port, timeout=3.0):
+    load_modbus()
+    return ModbusTcpClient(host, port=port, timeout=timeout, retries=0)
 
 current_unit_id = 1
+pipeline = None
 
 def set_unit_id(unit_id):
     global current_unit_id
     current_unit_id = unit_id
     print(Fore.GREEN + f"Current Unit ID set to {unit_id}" + Style.RESET_ALL)
 
-def try_methods(client, methods):
-    for method in methods:
+# Function code and per-PDU quantity limit for each readable table.
+# The spec allows 125 registers, but pymodbus rejects responses over 246 bytes.
+READ_TABLES = {
+    "coils": (1, 2000),
+    "discrete_inputs": (2, 2000),
+    "holding_registers": (3, 123),
+    "input_registers": (4, 123),
+}
+ADDRESS_SPACE = 0x10000
+
+# Largest hole (in addresses) worth reading through to save a round trip
+COALESCE_GAP = {
+    "coils": 256,
+    "discrete_inputs": 256,
+    "holding_registers": 16,
+    "input_registers": 16,
+}
+
+def plan_reads(ranges, limit, max_gap=0):
+    # Merge sorted (address, count) ranges into as few PDUs as possible,
+    # then split anything larger than the per-PDU limit
+    blocks = []
+    for address, count in sorted(ranges):
+        end = min(address + count, ADDRESS_SPACE)
+        if count <= 0 or address >= end:
+            continue
+        if blocks:
+            start, stop = blocks[-1]
+            if address - stop <= max_gap and max(stop, end) - start <= limit:
+                blocks[-1] = [start, max(stop, end)]
+                continue
+            address = max(address, stop)
+            if address >= end:
+                continue
+        while end - address > limit:
+            blocks.append([address, address + limit])
+            address += limit
+        blocks.append([address, end])
+    return [(start, stop - start) for start, stop in blocks]
+
+def get_bits(buffer, offset, count):
+    # `count` bits of an LSB-first packed buffer starting at bit `offset`, as an int
+    if count <= 0:
+        return 0
+    first, last = offset >> 3, (offset + count + 7) >> 3
+    return (int.from_bytes(buffer[first:last], "little") >> (offset & 7)) & ((1 << count) - 1)
+
+def set_bits(buffer, offset, count, value):
+    if count <= 0:
+        return
+    first, last = offset >> 3, (offset + count + 7) >> 3
+    mask = ((1 << count) - 1) << (offset & 7)
+    current = int.from_bytes(buffer[first:last], "little")
+    buffer[first:last] = ((current & ~mask) | ((value << (offset & 7)) & mask)).to_bytes(last - first, "little")
+
+def pack_bits(flags):
+    packed = bytearray()
+    for i, flag in enumerate(flags):
+        if i & 7 == 0:
+            packed.append(0)
+        if flag:
+            packed[-1] |= 1 << (i & 7)
+    return int.from_bytes(packed, "little")
+
+def set_bit_offsets(value, count):
+    # Offsets of the set bits of a `count`-bit int, lowest first
+    packed = value.to_bytes((count + 7) >> 3, "little")
+    return [i * 8 + j for i, byte in enumerate(packed) if byte for j in range(8) if byte >> j & 1]
+
+def unpack_bits(value, count):
+    return [bool(byte >> j & 1) for byte in value.to_bytes((count + 7) >> 3, "little") for j in range(8)][:count]
+
+class RegisterStore:
+    # One contiguous range of a table. Registers live in an array('H'), bits are
+    # packed LSB first in a bytearray, and a separate bitmap marks which
+    # addresses hold data that was actually read. Slices share the buffers.
+    def __init__(self, table, address, count, buffers=None, offset=0):
+        self.table = table
+        self.address = address
+        self.count = count
+        self.bits = READ_TABLES[table][0] <= 2
+        if buffers is None:
+            data = bytearray((count + 7) >> 3) if self.bits else array("H", [0]) * count
+            buffers = (data, bytearray((count + 7) >> 3))
+        self.data, self.valid = buffers
+        self.offset = offset
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.count)
+            if step != 1:
+                return self.tolist()[key]
+            return self.view(start, max(stop - start, 0))
+        if key < 0:
+            key += self.count
+        if not 0 <= key < self.count:
+            raise IndexError("register store index out of range")
+        i = self.offset + key
+        if not self.valid[i >> 3] >> (i & 7) & 1:
+            return None
+        if self.bits:
+            return bool(self.data[i >> 3] >> (i & 7) & 1)
+        return self.data[i]
+
+    def __setitem__(self, key, value):
+        self.set_values(key, [value])
+
+    def __eq__(self, other):
+        if isinstance(other, RegisterStore):
+            return self.count == other.count and not self.diff(other)
         try:
-            result = method()
-            if result is not None:
-                return result
-        except (ModbusException, ModbusIOException) as e:
-            logging.error(f"Exception while trying method {method.__name__}: {e}")
-    return []
+            return self.tolist() == list(other)
+        except TypeError:
+            return NotImplemented
 
-def read_coils(client, address, count):
-    methods = [
-        lambda: client.read_coils(address, count, unit=current_unit_id).bits
-    ]
-    return try_methods(client, methods) or [None] * count
+    def __repr__(self):
+        return repr(self.tolist())
 
-def read_discrete_inputs(client, address, count):
-    methods = [
-        lambda: client.read_discrete_inputs(address, count, unit=current_unit_id).bits
-    ]
-    return try_methods(client, methods) or [None] * count
+    def view(self, offset, count):
+        return RegisterStore(self.table, self.address + offset, count, (self.data, self.valid), self.offset + offset)
 
-def read_holding_registers(client, address, count):
-    methods = [
-        lambda: client.read_holding_registers(address, count, unit=current_unit_id).registers
-    ]
-    return try_methods(client, methods) or [None] * count
+    def valid_mask(self):
+        return get_bits(self.valid, self.offset, self.count)
 
-def read_input_registers(client, address, count):
-    methods = [
-        lambda: client.read_input_registers(address, count, unit=current_unit_id).registers
-    ]
-    return try_methods(client, methods) or [None] * count
+    def valid_count(self):
+        return bin(self.valid_mask()).count("1")
 
-def write_coil(client, address, value):
-    try:
-        result = client.write_coil(address, value, unit=current_unit_id)
-        if result.isError():
-            logging.error(f"Failed to write coil: {result}")
+    def tolist(self):
+        if self.bits:
+            values = unpack_bits(get_bits(self.data, self.offset, self.count), self.count)
         else:
-            print(Fore.GREEN + f"Written coil at address {address} to {value}" + Style.RESET_ALL)
-    except ModbusException as e:
-        logging.error(f"Exception while writing coil: {e}")
+            values = self.data[self.offset:self.offset + self.count].tolist()
+        valid = self.valid_mask()
+        if valid != (1 << self.count) - 1:
+            for i, ok in enumerate(unpack_bits(valid, self.count)):
+                if not ok:
+                    values[i] = None
+        return values
+
+    def items(self):
+        return zip(range(self.address, self.address + self.count), self.tolist())
+
+    def set_values(self, offset, values):
+        values = list(values)
+        start = self.offset + offset
+        if self.bits:
+            set_bits(self.data, start, len(values), pack_bits(values))
+        else:
+            self.data[start:start + len(values)] = array("H", [value or 0 for value in values])
+        set_bits(self.valid, start, len(values), pack_bits(value is not None for value in values))
+
+    def set_payload(self, offset, payload, count):
+        # Raw PDU data: big-endian registers or LSB-first packed bits
+        start = self.offset + offset
+        if self.bits:
+            set_bits(self.data, start, count, int.from_bytes(payload[:(count + 7) >> 3], "little"))
+        else:
+            words = array("H", payload[:count * 2])
+            if sys.byteorder == "little":
+                words.byteswap()
+            self.data[start:start + count] = words
+        set_bits(self.valid, start, count, (1 << count) - 1)
+
+    def copy_from(self, offset, other):
+        start, count = self.offset + offset, other.count
+        if self.bits:
+            set_bits(self.data, start, count, get_bits(other.data, other.offset, count))
+        else:
+            self.data[start:start + count] = other.data[other.offset:other.offset + count]
+        set_bits(self.valid, start, count, other.valid_mask())
+
+    def diff(self, other, chunk=256):
+        # Offsets whose value or validity differ. Registers are compared chunk by
+        # chunk as raw memory; inside a differing chunk the XOR of both chunks is
+        # folded so each 16-bit lane leaves one flag byte, and only flags are visited.
+        if self.count != other.count:
+            raise ValueError("cannot diff register stores of different sizes")
+        if self.bits:
+            valid, other_valid = self.valid_mask(), other.valid_mask()
+            delta = ((get_bits(self.data, self.offset, self.count) & valid) ^
+                     (get_bits(other.data, other.offset, other.count) & other_valid)) | (valid ^ other_valid)
+            return set_bit_offsets(delta, self.count)
+        changed = []
+        mine, theirs = memoryview(self.data).cast("B"), memoryview(other.data).cast("B")
+        lanes = int.from_bytes(b"\x01\x00" * chunk, "little")
+        for start in range(0, self.count, chunk):
+            size = min(chunk, self.count - start)
+            a, b = self.offset + start, other.offset + start
+            valid, other_valid = get_bits(self.valid, a, size), get_bits(other.valid, b, size)
+            words, other_words = mine[a * 2:(a + size) * 2], theirs[b * 2:(b + size) * 2]
+            if valid == other_valid and words == other_words:
+                continue
+            delta = int.from_bytes(words, "little") ^ int.from_bytes(other_words, "little")
+            delta |= delta >> 8
+            delta |= delta >> 4
+            delta |= delta >> 2
+            delta |= delta >> 1
+            flags = (delta & lanes).to_bytes(size * 2, "little")[::2]
+            both, full = valid & other_valid, (1 << size) - 1
+            found = []
+            i = flags.find(1)
+            while i != -1:
+                if both == full or both >> i & 1:
+                    found.append(start + i)
+                i = flags.find(1, i + 1)
+            if valid != other_valid:
+                found = sorted(set(found).union(start + i for i in set_bit_offsets(valid ^ other_valid, size)))
+            changed.extend(found)
+        return changed
+
+    def export(self):
+        # (data, validity) bytes normalised to offset 0; registers big-endian
+        if self.bits:
+            data = get_bits(self.data, self.offset, self.count).to_bytes((self.count + 7) >> 3, "little")
+        else:
+            words = self.data[self.offset:self.offset + self.count]
+            if sys.byteorder == "little":
+                words.byteswap()
+            data = words.tobytes()
+        return data, self.valid_mask().to_bytes((self.count + 7) >> 3, "little")
+
+    @classmethod
+    def from_export(cls, table, address, count, data, valid):
+        store = cls(table, address, count)
+        store.set_payload(0, data, count)
+        set_bits(store.valid, 0, count, int.from_bytes(valid, "little"))
+        return store
+
+# Upper bounds (seconds) of the request latency histogram buckets; the last bucket is +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+FUNCTION_NAMES = {
+    1: "read_coils",
+    2: "read_discrete_inputs",
+    3: "read_holding_registers",
+    4: "read_input_registers",
+    5: "write_coil",
+    6: "write_register",
+    15: "write_coils",
+    16: "write_registers",
+}
+
+class TransactionStats:
+    # Counters and latency histogram for one (device, unit, function code)
+    __slots__ = ("requests", "errors", "timeouts", "retries", "bytes_sent", "bytes_received", "latency_sum", "buckets", "exceptions")
+
+    def __init__(self):
+        self.requests = self.errors = self.timeouts = self.retries = 0
+        self.bytes_sent = self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.exceptions = {}
+
+    def answered(self):
+        return sum(self.buckets)
+
+    def quantile_ms(self, fraction):
+        # Upper bound of the bucket holding the given fraction of answered
+        # requests; None when nothing was answered or it falls in the +Inf bucket
+        total = self.answered()
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if total and seen >= fraction * total:
+                return bound * 1000
+        return None
+
+class Metrics:
+    # Every Modbus transaction is recorded here, whichever transport sent it.
+    # status is "ok", "exception" (code holds the exception code), "timeout" or "error".
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trace = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.entries = {}
+            self.live_units = set()
+            self.connects = {}
+            self.connect_failures = 0
+
+    def record(self, transport, device, unit, fc, address, count, sent, received, latency, status="ok", code=None, attempt=0):
+        with self.lock:
+            # Unanswered requests to units that never answered (unit sweeps) share
+            # one entry per device instead of one per probed unit ID
+            if status == "timeout" or code in (10, 11):
+                key = (device, unit if (device, unit) in self.live_units else None, fc)
+            else:
+                self.live_units.add((device, unit))
+                key = (device, unit, fc)
+            stats = self.entries.get(key)
+            if stats is None:
+                stats = self.entries[key] = TransactionStats()
+            stats.requests += 1
+            stats.retries += attempt > 0
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            if status == "timeout":
+                stats.timeouts += 1
+                stats.errors += 1
+            else:
+                # Exception responses are still device response times
+                stats.latency_sum += latency
+                stats.buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+                if status != "ok":
+                    stats.errors += 1
+                if code is not None:
+                    stats.exceptions[code] = stats.exceptions.get(code, 0) + 1
+            if self.trace is not None:
+                self.trace.write(json.dumps({
+                    "time": round(time.time(), 6), "transport": transport, "device": device, "unit": unit,
+                    "function": fc, "address": address, "count": count, "bytes_sent": sent, "bytes_received": received,
+                    "latency_ms": round(latency * 1000, 3), "status": status, "code": code, "attempt": attempt,
+                }) + "\n")
+
+    def connected(self, transport, device, ok):
+        with self.lock:
+            if ok:
+                key = (transport, device)
+                self.connects[key] = self.connects.get(key, 0) + 1
+            else:
+                self.connect_failures += 1
+
+    def reconnects(self):
+        return sum(count - 1 for count in self.connects.values())
+
+    def open_trace(self, path):
+        self.close_trace()
+        self.trace = open(path, "a", buffering=1)
+
+    def close_trace(self):
+        with self.lock:
+            if self.trace is not None:
+                self.trace.close()
+            self.trace = None
+
+    def summary(self):
+        with self.lock:
+            rows = []
+            for (device, unit, fc), stats in sorted(self.entries.items(), key=entry_order):
+                answered = stats.answered()
+                rows.append({
+                    "device": device, "unit": unit, "function": FUNCTION_NAMES.get(fc, str(fc)),
+                    "requests": stats.requests, "errors": stats.errors, "timeouts": stats.timeouts, "retries": stats.retries,
+                    "exceptions": {MODBUS_EXCEPTIONS.get(code, str(code)): n for code, n in sorted(stats.exceptions.items())},
+                    "bytes_sent": stats.bytes_sent, "bytes_received": stats.bytes_received,
+                    "mean_ms": round(stats.latency_sum / answered * 1000, 3) if answered else None,
+                    "p50_ms": stats.quantile_ms(0.5), "p99_ms": stats.quantile_ms(0.99),
+                })
+            timeouts = {device: {"srtt_ms": round(estimator.srtt * 1000, 3), "rttvar_ms": round(estimator.rttvar * 1000, 3),
+                                 "timeout_ms": round(estimator.timeout(request_timeout) * 1000, 3)}
+                        for device, estimator in rtt_estimators.items() if estimator.srtt is not None}
+            return {"since": self.started, "transactions": rows, "timeouts": timeouts,
+                    "reconnects": self.reconnects(), "connect_failures": self.connect_failures}
+
+    def prometheus(self):
+        with self.lock:
+            lines = []
+            counters = [
+                ("sploitbus_requests_total", "Modbus requests sent", "requests"),
+                ("sploitbus_errors_total", "Requests that failed (exception, timeout or transport error)", "errors"),
+                ("sploitbus_timeouts_total", "Requests that got no response in time", "timeouts"),
+                ("sploitbus_retries_total", "Retried requests", "retries"),
+                ("sploitbus_bytes_sent_total", "Bytes sent, MBAP header included", "bytes_sent"),
+                ("sploitbus_bytes_received_total", "Bytes received, MBAP header included", "bytes_received"),
+            ]
+            for name, help_text, field in counters:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for key, stats in sorted(self.entries.items(), key=entry_order):
+                    lines.append(f"{name}{{{metric_labels(*key)}}} {getattr(stats, field)}")
+            lines += ["# HELP sploitbus_exceptions_total Modbus exception responses by exception code", "# TYPE sploitbus_exceptions_total counter"]
+            for key, stats in sorted(self.entries.items(), key=entry_order):
+                for code, count in sorted(stats.exceptions.items()):
+                    lines.append(f'sploitbus_exceptions_total{{{metric_labels(*key)},code="{code}"}} {count}')
+            name = "sploitbus_request_duration_seconds"
+            lines += [f"# HELP {name} Time from sending a request to its response", f"# TYPE {name} histogram"]
+            for key, stats in sorted(self.entries.items(), key=entry_order):
+                labels = metric_labels(*key)
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), stats.buckets):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {stats.latency_sum:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {cumulative}")
+            lines += ["# HELP sploitbus_reconnects_total Connections reopened to a device", "# TYPE sploitbus_reconnects_total counter",
+                      f"sploitbus_reconnects_total {self.reconnects()}",
+                      "# HELP sploitbus_connect_failures_total Failed connection attempts", "# TYPE sploitbus_connect_failures_total counter",
+                      f"sploitbus_connect_failures_total {self.connect_failures}"]
+            return "\n".join(lines) + "\n"
+
+# Timeouts adapt to each device's observed response time: the smoothed RTT
+# plus four times its mean deviation (as TCP does), never below min_timeout
+# and never above the configured timeout, which also applies until the
+# first response arrives
+request_timeout = 3.0
+min_timeout = 0.1
+max_retries = 2
+RETRY_BACKOFF = 0.05  # first retry delay in seconds, doubled per attempt, +/-50% jitter
+
+class RttEstimator:
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = 0.0
+
+    def observe(self, sample):
+        if self.srtt is None:
+            self.srtt, self.rttvar = sample, sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+
+    def timeout(self, ceiling):
+        if self.srtt is None:
+            return ceiling
+        return min(ceiling, max(min_timeout, self.srtt + 4 * self.rttvar))
+
+rtt_estimators = {}
 
-def write_register(client, address, value):
+def rtt_estimator(device):
+    if device not in rtt_estimators:
+        rtt_estimators[device] = RttEstimator()
+    return rtt_estimators[device]
+
+def retry_delay(attempt):
+    return RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+def metric_labels(device, unit, fc):
+    return f'device="{device}",unit="{"" if unit is None else unit}",function="{fc}"'
+
+def entry_order(item):
+    device, unit, fc = item[0]
+    return device, -1 if unit is None else unit, fc
+
+metrics = Metrics()
+
+def client_device(client):
+    # Serial clients have no port number: the device path names them
+    params = client.comm_params
+    return f"{params.host}:{params.port}" if params.port else params.host
+
+def client_frame_size(client, pdu_size):
+    if isinstance(client, SerialClient):
+        return client.transport.frame_size(pdu_size)
+    return MBAP_HEADER.size + pdu_size
+
+def response_status(pdu):
+    # (status, exception code) for a raw response PDU, None meaning no response
+    if pdu is None:
+        return "timeout", None
+    if len(pdu) >= 2 and pdu[0] & 0x80:
+        return "exception", pdu[1]
+    return "ok", None
+
+def request_fields(pdu):
+    # (function code, address, count) of a request PDU
+    fc = pdu[0]
+    address, count = struct.unpack_from(">HH", pdu, 1) if len(pdu) >= 5 else (0, 0)
+    return fc, address, 1 if fc in (5, 6) else count
+
+def record_pdu(transport, device, unit, request, response, latency, status=None, attempt=0):
+    fc, address, count = request_fields(request)
+    if status is None:
+        status, code = response_status(response)
+    else:
+        code = None
+    metrics.record(transport, device, unit, fc, address, count, 7 + len(request),
+                   0 if response is None else 7 + len(response), latency, status, code, attempt)
+
+def client_call(client, unit, fc, address, count, request_size, response_size, call):
+    # Runs one pymodbus request with the device's adaptive timeout. Timeouts and
+    # transport errors are retried with jittered backoff, exception responses are
+    # returned at once. Sizes are PDU sizes; the framing overhead is added here.
+    device = client_device(client)
+    sent = client_frame_size(client, request_size)
+    estimator = rtt_estimator(device)
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(retry_delay(attempt))
+        client.comm_params.timeout_connect = estimator.timeout(request_timeout)
+        started = time.perf_counter()
+        try:
+            result = call()
+            # pymodbus returns (rather than raises) ModbusIOException when nothing came back
+            error = result if isinstance(result, ModbusIOException) else None
+        except ModbusException as e:
+            result, error = None, e
+        finally:
+            client.comm_params.timeout_connect = request_timeout
+        latency = time.perf_counter() - started
+        if error is None:
+            estimator.observe(latency)
+            code = getattr(result, "exception_code", None) if result.isError() else None
+            if not result.isError():
+                metrics.record("client", device, unit, fc, address, count, sent, client_frame_size(client, response_size), latency, attempt=attempt)
+            else:
+                metrics.record("client", device, unit, fc, address, count, sent, client_frame_size(client, 2), latency,
+                               "error" if code is None else "exception", code, attempt)
+            return result
+        status = "timeout" if isinstance(error, ModbusIOException) else "error"
+        metrics.record("client", device, unit, fc, address, count, sent, 0, latency, status, attempt=attempt)
+    if result is not None:
+        return result
+    raise error
+
+def read_block(client, table, address, count, unit_id=None):
+    store = RegisterStore(table, address, count)
+    method = getattr(client, f"read_{table}")
+    unit_id = current_unit_id if unit_id is None else unit_id
+    payload = (count + 7) >> 3 if store.bits else count * 2
     try:
-        result = client.write_register(address, value, unit=current_unit_id)
+        result = client_call(client, unit_id, READ_TABLES[table][0], address, count, 5, 2 + payload,
+                             lambda: method(address, count, slave=unit_id))
         if result.isError():
-            logging.error(f"Failed to write register: {result}")
+            logging.error(f"Failed to read {table} {address}-{address + count - 1}: {result}")
         else:
-            print(Fore.GREEN + f"Written register at address {address} to {value}" + Style.RESET_ALL)
+            store.set_values(0, (result.bits if store.bits else result.registers)[:count])
     except ModbusException as e:
-        logging.error(f"Exception while writing register: {e}")
+        logging.error(f"Exception while reading {table} {address}-{address + count - 1}: {e}")
+    return store
 
-def write_multiple_coils(client, address, values):
-    try:
-        result = client.write_coils(address, values, unit=current_unit_id)
-        if result.isError():
-            logging.error(f"Failed to write multiple coils: {result}")
+MBAP_HEADER = struct.Struct(">HHHB")
+
+MODBUS_EXCEPTIONS = {
+    1: "IllegalFunction",
+    2: "IllegalAddress",
+    3: "IllegalValue",
+    4: "SlaveFailure",
+    5: "Acknowledge",
+    6: "SlaveBusy",
+    8: "MemoryParityError",
+    10: "GatewayPathUnavailable",
+    11: "GatewayNoResponse",
+}
+
+def encode_read_request(fc, address, count):
+    return struct.pack(">BHH", fc, address, count)
+
+def read_response_payload(fc, pdu, count):
+    # Returns the data bytes, or raises ModbusException for exception/garbled responses
+    if len(pdu) >= 2 and pdu[0] == fc | 0x80:
+        raise ModbusException(f"Exception response {MODBUS_EXCEPTIONS.get(pdu[1], pdu[1])} (function {fc})")
+    if len(pdu) < 2 or pdu[0] != fc or len(pdu) < 2 + pdu[1]:
+        raise ModbusException(f"Malformed response to function {fc}: {pdu.hex()}")
+    data = pdu[2:2 + pdu[1]]
+    needed = (count + 7) >> 3 if fc <= 2 else count * 2
+    if len(data) < needed:
+        raise ModbusException(f"Short response to function {fc}: {len(data)} bytes for {count} values")
+    return data
+
+def decode_block(table, address, count, pdu):
+    store = RegisterStore(table, address, count)
+    if pdu is not None:
+        try:
+            store.set_payload(0, read_response_payload(READ_TABLES[table][0], pdu, count), count)
+        except ModbusException as e:
+            logging.error(f"Failed to read {table} {address}-{address + count - 1}: {e}")
+    return store
+
+class PipelinedTransport:
+    # Raw Modbus/TCP connection that keeps up to `window` requests in flight
+    # and matches responses by MBAP transaction ID
+    def __init__(self, host, port, window=8, timeout=3.0):
+        self.host = host
+        self.port = port
+        self.window = max(1, window)
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = bytearray()
+        self.transaction_id = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.sock is None:
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                metrics.connected("pipeline", self.device(), True)
+            except OSError as e:
+                logging.error(f"Failed to open pipelined connection to {self.host}:{self.port}: {e}")
+                metrics.connected("pipeline", self.device(), False)
+                self.sock = None
+        return self.sock is not None
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.buffer.clear()
+
+    def device(self):
+        return f"{self.host}:{self.port}"
+
+    def _next_transaction_id(self):
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        return self.transaction_id
+
+    def _read_frames(self):
+        # Yield (transaction_id, unit_id, pdu) for every complete frame in the buffer
+        while len(self.buffer) >= MBAP_HEADER.size:
+            tid, protocol, length, unit = MBAP_HEADER.unpack_from(self.buffer)
+            end = 6 + length
+            if len(self.buffer) < end:
+                break
+            pdu = bytes(self.buffer[MBAP_HEADER.size:end])
+            del self.buffer[:end]
+            if protocol == 0:
+                yield tid, unit, pdu
+
+    def _retry(self, retries, requests, index, attempt, now, reason):
+        if attempt < max_retries:
+            heappush(retries, (now + retry_delay(attempt + 1), index, attempt + 1))
         else:
-            print(Fore.GREEN + f"Written multiple coils starting at address {address}" + Style.RESET_ALL)
-            # Verify the written values
-            new_values = read_coils(client, address, len(values))
-            if new_values and new_values == values:
-                print(Fore.GREEN + f"Verified multiple coils starting at address {address}" + Style.RESET_ALL)
+            logging.error(f"{reason} (unit {requests[index][0]}), giving up after {attempt + 1} attempts")
+
+    def execute(self, requests):
+        # requests: list of (unit_id, pdu); returns the response PDU (or None) for each.
+        # Unanswered requests are resent with a new transaction ID after a jittered
+        # backoff, up to max_retries times; exception responses are final.
+        results = [None] * len(requests)
+        device = self.device()
+        estimator = rtt_estimator(device)
+        with self.lock:
+            queued = deque((index, 0) for index in range(len(requests)))
+            retries = []  # heap of (not_before, index, attempt)
+            pending = {}
+            while queued or retries:
+                if not self.connect():
+                    break
+                try:
+                    while queued or retries or pending:
+                        now = time.monotonic()
+                        while len(pending) < self.window and (queued or (retries and retries[0][0] <= now)):
+                            if retries and retries[0][0] <= now:
+                                _, index, attempt = heappop(retries)
+                            else:
+                                index, attempt = queued.popleft()
+                            unit, pdu = requests[index]
+                            tid = self._next_transaction_id()
+                            pending[tid] = (index, attempt, time.monotonic())
+                            self.sock.sendall(MBAP_HEADER.pack(tid, 0, len(pdu) + 1, unit) + pdu)
+
+                        now = time.monotonic()
+                        timeout = estimator.timeout(self.timeout)
+                        for tid, (index, attempt, sent) in list(pending.items()):
+                            if sent + timeout <= now:
+                                del pending[tid]
+                                record_pdu("pipeline", device, *requests[index], None, now - sent, attempt=attempt)
+                                self._retry(retries, requests, index, attempt, now, f"Timed out waiting for transaction {tid}")
+
+                        wakeups = [sent + timeout for _, _, sent in pending.values()]
+                        if retries and len(pending) < self.window:
+                            wakeups.append(retries[0][0])
+                        if not wakeups:
+                            continue
+                        wait = max(min(wakeups) - now, 0)
+                        if not pending:
+                            time.sleep(wait)
+                            continue
+                        readable, _, _ = select.select([self.sock], [], [], wait)
+                        if not readable:
+                            continue
+                        data = self.sock.recv(65536)
+                        if not data:
+                            raise ConnectionError("connection closed by peer")
+                        self.buffer += data
+                        now = time.monotonic()
+                        for tid, unit, pdu in self._read_frames():
+                            entry = pending.pop(tid, None)
+                            if entry is not None:
+                                index, attempt, sent = entry
+                                results[index] = pdu
+                                estimator.observe(now - sent)
+                                record_pdu("pipeline", device, *requests[index], pdu, now - sent, attempt=attempt)
+                except OSError as e:
+                    logging.error(f"Pipelined connection to {self.host}:{self.port} failed: {e}")
+                    now = time.monotonic()
+                    for index, attempt, sent in pending.values():
+                        record_pdu("pipeline", device, *requests[index], None, now - sent, "error", attempt)
+                        self._retry(retries, requests, index, attempt, now, "Request lost with the connection")
+                    pending.clear()
+                    self.close()
+        return results
+
+# Modbus over a serial line (RS-485/RS-232). RTU frames are unit + PDU + CRC-16
+# between silences of 3.5 character times; ASCII frames are ':' + hex(unit +
+# PDU + LRC) + CRLF. Serial ports are opened with termios, so no extra package.
+SERIAL_FRAMINGS = ("rtu", "ascii")
+SERIAL_PARITIES = ("N", "E", "O")
+# Shortest silence treated as the end of a frame: USB adapters and ptys hand
+# over bytes in bursts, so the 3.5 character gap alone is too tight
+SERIAL_SILENCE = 0.02
+SERIAL_FRAME_CACHE = 4096
+
+CRC16_TABLE = None
+
+def crc16(data):
+    # Modbus CRC-16 (reflected polynomial 0xA001); over a whole frame including
+    # its CRC the result is 0
+    global CRC16_TABLE
+    table = CRC16_TABLE
+    if table is None:
+        table = []
+        for byte in range(256):
+            crc = byte
+            for _ in range(8):
+                crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+            table.append(crc)
+        CRC16_TABLE = table
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+def encode_serial_frame(framing, unit, pdu):
+    adu = bytes([unit]) + pdu
+    if framing == "rtu":
+        return adu + crc16(adu).to_bytes(2, "little")
+    return b":" + (adu + bytes([-sum(adu) & 0xFF])).hex().upper().encode() + b"\r\n"
+
+def decode_serial_frame(framing, frame):
+    # (unit, pdu) of a received frame, or None if the CRC/LRC does not check
+    if framing == "rtu":
+        if len(frame) < 4 or crc16(frame):
+            return None
+        return frame[0], bytes(frame[1:-2])
+    start = frame.find(b":")
+    try:
+        adu = bytes.fromhex(frame[start + 1:].strip().decode("ascii")) if start >= 0 else b""
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if len(adu) < 3 or sum(adu) & 0xFF:
+        return None
+    return adu[0], adu[1:-1]
+
+def rtu_response_length(frame):
+    # Length of an RTU response once its header has arrived, None when the
+    # function code does not say (the frame then ends at the next silence)
+    if len(frame) < 3:
+        return 5
+    fc = frame[1]
+    if fc & 0x80:
+        return 5
+    if fc in (1, 2, 3, 4, 23):
+        return 5 + frame[2]
+    if fc in (5, 6, 15, 16):
+        return 8
+    return None
+
+def open_serial(path, baudrate, bytesize, parity, stopbits):
+    import termios
+    speed = getattr(termios, f"B{baudrate}", None)
+    if speed is None:
+        raise ValueError(f"unsupported baud rate {baudrate}")
+    fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        # Raw mode: no echo, no line editing, no CR/LF translation, no flow control
+        cflag = termios.CREAD | termios.CLOCAL | (termios.CS8 if bytesize == 8 else termios.CS7)
+        if parity != "N":
+            cflag |= termios.PARENB | (termios.PARODD if parity == "O" else 0)
+        if stopbits == 2:
+            cflag |= termios.CSTOPB
+        cc = termios.tcgetattr(fd)[6]
+        cc[termios.VMIN] = 0
+        cc[termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, [0, 0, cflag, 0, speed, speed, cc])
+        termios.tcflush(fd, termios.TCIOFLUSH)
+    except termios.error as e:
+        os.close(fd)
+        raise OSError(*e.args)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+class SerialTransport:
+    # Modbus RTU/ASCII master. The bus carries one request at a time, so a batch
+    # goes out back to back: each request is sent as soon as the line has been
+    # quiet for the inter-frame gap, and a response ends as soon as the length
+    # given by its function code and byte count has arrived, not after a silence.
+    def __init__(self, path, baudrate=9600, framing="rtu", parity="N", stopbits=1, timeout=3.0, bytesize=None):
+        self.path = path
+        self.baudrate = baudrate
+        self.framing = framing
+        self.parity = parity
+        self.stopbits = stopbits
+        self.timeout = timeout
+        # The spec has 8 data bits for RTU and 7 for ASCII
+        self.bytesize = bytesize or (8 if framing == "rtu" else 7)
+        self.char_time = (1 + self.bytesize + (parity != "N") + stopbits) / baudrate
+        # t3.5 between RTU frames; the spec fixes it at 1.75 ms above 19200 baud
+        self.gap = 0.00175 if baudrate > 19200 else 3.5 * self.char_time
+        # ASCII allows up to a second between the characters of one frame
+        self.silence = max(self.gap, SERIAL_SILENCE) if framing == "rtu" else 1.0
+        self.window = 1  # one request on the bus at a time
+        self.fd = None
+        self.frames = {}
+        self.idle_since = 0.0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.fd is None:
+            try:
+                self.fd = open_serial(self.path, self.baudrate, self.bytesize, self.parity, self.stopbits)
+                metrics.connected("serial", self.device(), True)
+            except ImportError:
+                logging.error("Serial ports need termios (Linux, macOS or another POSIX system)")
+                metrics.connected("serial", self.device(), False)
+            except (OSError, ValueError) as e:
+                logging.error(f"Failed to open serial port {self.path}: {e}")
+                metrics.connected("serial", self.device(), False)
+        return self.fd is not None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+    def device(self):
+        return self.path
+
+    def frame_size(self, pdu_size):
+        return pdu_size + 3 if self.framing == "rtu" else 2 * (pdu_size + 2) + 3
+
+    def encode(self, unit, pdu):
+        # Request frames are kept: polling sends the same few requests again and again
+        frame = self.frames.get((unit, pdu))
+        if frame is None:
+            frame = encode_serial_frame(self.framing, unit, pdu)
+            if len(self.frames) < SERIAL_FRAME_CACHE:
+                self.frames[(unit, pdu)] = frame
+        return frame
+
+    def frame_length(self, buffer):
+        if self.framing == "rtu":
+            return rtu_response_length(buffer)
+        end = buffer.find(b"\n")
+        return end + 1 if end >= 0 else len(buffer) + 1
+
+    def _write(self, frame):
+        view = memoryview(frame)
+        while view:
+            select.select([], [self.fd], [], self.timeout)
+            view = view[os.write(self.fd, view):]
+
+    def _receive(self, deadline):
+        # (frame, arrival of its first byte), or (None, None) if nothing complete came
+        buffer = bytearray()
+        first = last = None
+        while True:
+            expected = self.frame_length(buffer)
+            if expected is not None and len(buffer) >= expected:
+                return bytes(buffer[:expected]), first
+            if last is None:
+                wait = deadline - time.monotonic()
             else:
-                print(Fore.RED + f"Verification failed for multiple coils starting at address {address}" + Style.RESET_ALL)
-    except ModbusException as e:
-        logging.error(f"Exception while writing multiple coils: {e}")
+                remaining = 0 if expected is None else expected - len(buffer)
+                wait = last + self.silence + remaining * self.char_time - time.monotonic()
+            if wait <= 0:
+                if buffer and expected is None:
+                    return bytes(buffer), first
+                if buffer:
+                    logging.error(f"Incomplete frame from {self.path}: {bytes(buffer).hex()}")
+                return None, None
+            readable, _, _ = select.select([self.fd], [], [], wait)
+            if readable:
+                data = os.read(self.fd, 4096)
+                if not data:
+                    raise ConnectionError("serial port closed")
+                last = time.monotonic()
+                first = last if first is None else first
+                buffer += data
+
+    def transact(self, unit, pdu, timeout):
+        # Sends one request and waits up to `timeout` after its last byte has left
+        # for the answer. Returns (response PDU or None, turnaround in seconds).
+        frame = self.encode(unit, pdu)
+        try:
+            while os.read(self.fd, 4096):
+                pass  # stale bytes from an earlier, abandoned answer
+        except BlockingIOError:
+            pass
+        wait = self.idle_since + self.gap - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._write(frame)
+        sent = time.monotonic() + len(frame) * self.char_time
+        try:
+            response, first = self._receive(sent + timeout)
+        finally:
+            self.idle_since = time.monotonic()
+        if response is None:
+            return None, None
+        decoded = decode_serial_frame(self.framing, response)
+        if decoded is None:
+            logging.error(f"Discarding corrupt frame from {self.path}: {response.hex()}")
+            return None, None
+        if decoded[0] != unit or decoded[1][:1] not in (pdu[:1], bytes([pdu[0] | 0x80])):
+            logging.error(f"Discarding frame from unit {decoded[0]} in reply to a request for unit {unit}: {response.hex()}")
+            return None, None
+        return decoded[1], max(first - sent, 0.0)
+
+    def record(self, unit, request, response, latency, status=None, attempt=0):
+        fc, address, count = request_fields(request)
+        code = None
+        if status is None:
+            status, code = response_status(response)
+        metrics.record("serial", self.device(), unit, fc, address, count, self.frame_size(len(request)),
+                       0 if response is None else self.frame_size(len(response)), latency, status, code, attempt)
+
+    def execute(self, requests):
+        # requests: list of (unit_id, pdu); returns the response PDU (or None) for
+        # each. Unanswered requests are resent up to max_retries times; the
+        # adaptive timeout only learns the turnaround, not the time on the wire.
+        results = [None] * len(requests)
+        device = self.device()
+        estimator = rtt_estimator(device)
+        with self.lock:
+            for index, (unit, pdu) in enumerate(requests):
+                for attempt in range(max_retries + 1):
+                    if attempt:
+                        time.sleep(retry_delay(attempt))
+                    if not self.connect():
+                        return results
+                    started = time.monotonic()
+                    try:
+                        response, turnaround = self.transact(unit, pdu, estimator.timeout(self.timeout))
+                    except OSError as e:
+                        logging.error(f"Serial line {self.path} failed: {e}")
+                        self.record(unit, pdu, None, time.monotonic() - started, "error", attempt)
+                        self.close()
+                        continue
+                    self.record(unit, pdu, response, time.monotonic() - started, attempt=attempt)
+                    if response is not None:
+                        estimator.observe(turnaround)
+                        results[index] = response
+                        break
+        return results
+
+class SerialResponse:
+    # The parts of a pymodbus response that the read and write helpers use
+    def __init__(self, pdu, count=0):
+        self.function_code = pdu[0]
+        self.exception_code = (pdu[1] if len(pdu) > 1 else 0) if pdu[0] & 0x80 else None
+        self.bits = []
+        self.registers = []
+        if self.exception_code is None and pdu[0] <= 4:
+            data = read_response_payload(pdu[0], pdu, count)
+            if pdu[0] <= 2:
+                self.bits = unpack_bits(int.from_bytes(data, "little"), count)
+            else:
+                self.registers = list(struct.unpack_from(f">{count}H", data))
+
+    def isError(self):
+        return self.exception_code is not None
 
-def write_multiple_registers(client, address, values):
+    def __str__(self):
+        if self.isError():
+            return f"Exception Response({self.function_code}, {self.function_code & 0x7F}, {MODBUS_EXCEPTIONS.get(self.exception_code, self.exception_code)})"
+        return f"Response(function {self.function_code})"
+
+class SerialClient:
+    # Stands in for a pymodbus client on a serial line, so the read and write
+    # helpers, with client_call's timeouts and retries, work unchanged
+    def __init__(self, path, baudrate=9600, framing="rtu", parity="N", stopbits=1, timeout=3.0, bytesize=None):
+        self.transport = SerialTransport(path, baudrate, framing, parity, stopbits, timeout, bytesize)
+        self.comm_params = SimpleNamespace(host=path, port=0, timeout_connect=timeout)
+
+    def connect(self):
+        return self.transport.connect()
+
+    def close(self):
+        self.transport.close()
+
+    def _call(self, unit, pdu, count=0):
+        # One attempt; client_call decides about retries
+        transport = self.transport
+        with transport.lock:
+            if not transport.connect():
+                raise ModbusException(f"Serial port {transport.path} is not open")
+            try:
+                response, _ = transport.transact(unit, pdu, self.comm_params.timeout_connect)
+            except OSError as e:
+                transport.close()
+                raise ModbusException(f"Serial line {transport.path} failed: {e}")
+        if response is None:
+            return ModbusIOException(f"No response from unit {unit}")
+        return SerialResponse(response, count)
+
+    def read_coils(self, address, count, slave=1):
+        return self._call(slave, encode_read_request(1, address, count), count)
+
+    def read_discrete_inputs(self, address, count, slave=1):
+        return self._call(slave, encode_read_request(2, address, count), count)
+
+    def read_holding_registers(self, address, count, slave=1):
+        return self._call(slave, encode_read_request(3, address, count), count)
+
+    def read_input_registers(self, address, count, slave=1):
+        return self._call(slave, encode_read_request(4, address, count), count)
+
+    def write_coil(self, address, value, slave=1):
+        return self._call(slave, struct.pack(">BHH", 5, address, 0xFF00 if value else 0))
+
+    def write_register(self, address, value, slave=1):
+        return self._call(slave, struct.pack(">BHH", 6, address, value))
+
+    def write_coils(self, address, values, slave=1):
+        data = pack_bits(values).to_bytes((len(values) + 7) >> 3, "little")
+        return self._call(slave, struct.pack(">BHHB", 15, address, len(values), len(data)) + data)
+
+    def write_registers(self, address, values, slave=1):
+        return self._call(slave, struct.pack(f">BHHB{len(values)}H", 16, address, len(values), 2 * len(values), *values))
+
+def read_blocks(client, table, blocks, unit_id=None):
+    if pipeline is None:
+        return [read_block(client, table, start, count, unit_id) for start, count in blocks]
+
+    fc = READ_TABLES[table][0]
+    unit_id = current_unit_id if unit_id is None else unit_id
+    responses = pipeline.execute([(unit_id, encode_read_request(fc, start, count)) for start, count in blocks])
+    return [decode_block(table, start, count, pdu) for (start, count), pdu in zip(blocks, responses)]
+
+def stitch_ranges(table, blocks, data, ranges):
+    # Rebuild each requested range from the sorted, non-overlapping blocks;
+    # addresses no block covers (outside the capability map) stay invalid
+    starts = [start for start, _ in blocks]
+    results = []
+    for address, count in ranges:
+        store = RegisterStore(table, address, count)
+        pos, end = address, min(address + count, ADDRESS_SPACE)
+        i = max(bisect_right(starts, pos) - 1, 0)
+        while pos < end and i < len(blocks):
+            start, length = blocks[i]
+            if start >= end:
+                break
+            pos = max(pos, start)
+            stop = min(start + length, end)
+            if pos < stop:
+                store.copy_from(pos - address, data[i][pos - start:stop - start])
+                pos = stop
+            i += 1
+        results.append(store)
+    return results
+
+# Discovered capability maps keyed by "host:port/unit": for each table, None
+# when the function code is unsupported, otherwise the sorted (address, count)
+# ranges that answer. Reads on a mapped unit only go to those ranges.
+capabilities = {}
+capabilities_path = None
+
+def capability_key(client, unit_id):
+    return f"{client_device(client)}/{unit_id}"
+
+def clip_blocks(blocks, ranges):
+    # Intersect planned (address, count) blocks with sorted valid ranges
+    starts = [start for start, _ in ranges]
+    clipped = []
+    for address, count in blocks:
+        end = address + count
+        i = max(bisect_right(starts, address) - 1, 0)
+        while i < len(ranges) and ranges[i][0] < end:
+            start, stop = max(address, ranges[i][0]), min(end, ranges[i][0] + ranges[i][1])
+            if start < stop:
+                clipped.append((start, stop - start))
+            i += 1
+    return clipped
+
+def plan_table_reads(client, table, ranges, max_gap, unit_id):
+    blocks = plan_reads(ranges, READ_TABLES[table][1], max_gap)
+    tables = capabilities.get(capability_key(client, unit_id))
+    if tables is None or table not in tables:
+        return blocks
+    return clip_blocks(blocks, tables[table] or [])
+
+def read_ranges(client, table, ranges, max_gap=None, unit_id=None):
+    if max_gap is None:
+        max_gap = COALESCE_GAP[table]
+    unit_id = current_unit_id if unit_id is None else unit_id
+    blocks = plan_table_reads(client, table, ranges, max_gap, unit_id)
+    return stitch_ranges(table, blocks, read_blocks(client, table, blocks, unit_id), ranges)
+
+def read_table(client, table, address, count, unit_id=None):
+    return read_ranges(client, table, [(address, count)], unit_id=unit_id)[0]
+
+def read_coils(client, address, count):
+    return read_table(client, "coils", address, count)
+
+def read_discrete_inputs(client, address, count):
+    return read_table(client, "discrete_inputs", address, count)
+
+def read_holding_registers(client, address, count):
+    return read_table(client, "holding_registers", address, count)
+
+def read_input_registers(client, address, count):
+    return read_table(client, "input_registers", address, count)
+
+# Per-PDU quantity limits for FC15 (write multiple coils) and FC16 (write multiple registers)
+WRITE_LIMITS = {"coils": 1968, "holding_registers": 123}
+WRITE_NAMES = {"coils": ("coil", "coils"), "holding_registers": ("register", "registers")}
+
+# off: no read-back; once: one batched read of the whole written range;
+# strict: read back each request's range and stop at the first mismatch
+VERIFY_POLICIES = ("off", "once", "strict")
+verify_policy = "once"
+
+def set_dry_run(mode):
+    if mode not in ("on", "off"):
+        raise ValueError("dry run must be 'on' or 'off'")
+    write_guard.dry_run = mode == "on"
+    print(Fore.GREEN + f"Dry run {mode}: writes are {'only reported' if write_guard.dry_run else 'sent'}" + Style.RESET_ALL)
+
+def set_verify_policy(policy):
+    global verify_policy
+    if policy not in VERIFY_POLICIES:
+        raise ValueError(f"verify policy must be one of {', '.join(VERIFY_POLICIES)}")
+    verify_policy = policy
+    print(Fore.GREEN + f"Write verification set to {policy}" + Style.RESET_ALL)
+
+def describe_range(table, address, count):
+    singular, plural = WRITE_NAMES[table]
+    if count == 1:
+        return f"{singular} at address {address}"
+    return f"{count} {plural} starting at address {address}"
+
+def contiguous_runs(addresses):
+    # [(address, count)] covering sorted addresses
+    runs = []
+    for address in addresses:
+        if runs and runs[-1][0] + runs[-1][1] == address:
+            runs[-1][1] += 1
+        else:
+            runs.append([address, 1])
+    return [tuple(run) for run in runs]
+
+class WriteGuard:
+    # Keeps writes inside the allowed ranges, turns them into no-ops in dry-run
+    # mode and, while capturing, records the value each address had before the
+    # first write to it so `rollback` can put it back. The journal is JSON
+    # lines: "capture" entries hold those original values, "write" entries what
+    # was sent, and a "rollback" entry closes a device/unit/table.
+    def __init__(self):
+        self.enabled = False
+        self.dry_run = False
+        self.allowed = {}  # table -> [(start, stop)]
+        self.originals = {}  # (device, unit, table) -> {address: value}
+        self.journal = None
+        self.journal_path = None
+
+    def allow(self, spec):
+        # <table>:<start>[-<end>], end inclusive
+        table, _, span = spec.partition(":")
+        start, _, end = span.partition("-")
+        if table not in WRITE_LIMITS or not start:
+            raise ValueError(f"expected '<coils|holding_registers>:<start>[-<end>]', got '{spec}'")
+        start = int(start, 0)
+        end = int(end, 0) if end else start
+        if not 0 <= start <= end < ADDRESS_SPACE:
+            raise ValueError(f"bad address range in '{spec}'")
+        self.allowed.setdefault(table, []).append((start, end + 1))
+
+    def permits(self, table, address, count):
+        if not self.allowed:
+            return True
+        position, stop = address, address + count
+        for start, end in sorted(self.allowed.get(table, [])):
+            if start <= position < end:
+                position = end
+        return position >= stop
+
+    def open_journal(self, path):
+        # Replays an existing journal so originals survive a restart
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line
+                    key = (entry["device"], entry["unit"], entry["table"])
+                    if entry["op"] == "capture":
+                        originals = self.originals.setdefault(key, {})
+                        for offset, value in enumerate(entry["values"]):
+                            originals.setdefault(entry["address"] + offset, value)
+                    elif entry["op"] == "rollback":
+                        self.originals.pop(key, None)
+        self.journal = open(path, "a")
+        self.journal_path = path
+        self.enabled = True
+
+    def log(self, op, key, address=None, values=None, **extra):
+        if self.journal is None:
+            return
+        entry = {"time": timestamp(), "op": op, "device": key[0], "unit": key[1], "table": key[2]}
+        if address is not None:
+            entry.update(address=address, values=values)
+        entry.update(extra)
+        self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+        # Originals must be on disk before the write that overwrites them
+        os.fsync(self.journal.fileno())
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def capture(self, client, table, ranges, unit_id):
+        # Reads the addresses of `ranges` that have no original value yet, all
+        # in one batch; returns False when any of them could not be read
+        if not self.enabled or self.dry_run:
+            return True
+        key = (client_device(client), unit_id, table)
+        originals = self.originals.setdefault(key, {})
+        missing = contiguous_runs(sorted({address for start, count in ranges
+                                          for address in range(start, start + count) if address not in originals}))
+        if not missing:
+            return True
+        for (address, count), store in zip(missing, read_ranges(client, table, missing, None, unit_id)):
+            values = store.tolist()
+            if None in values:
+                print(Fore.RED + f"Could not read the original value of {describe_range(table, address + values.index(None), 1)}; "
+                      "not writing ('guard off' to write without rollback)." + Style.RESET_ALL)
+                return False
+            self.log("capture", key, address, values)
+            for offset, value in enumerate(values):
+                originals[address + offset] = value
+        return True
+
+    def rollback(self, client, unit_id):
+        # Restores every captured address of this device and unit that no longer
+        # holds its original value, with as few FC15/FC16 requests as possible
+        device = client_device(client)
+        keys = [key for key, originals in self.originals.items() if key[:2] == (device, unit_id) and originals]
+        if not keys:
+            print(Fore.YELLOW + f"Nothing to roll back for unit {unit_id} on {device}." + Style.RESET_ALL)
+            return True
+        ok = True
+        for key in keys:
+            table, originals = key[2], self.originals[key]
+            runs = contiguous_runs(sorted(originals))
+            requests = []
+            for (address, count), store in zip(runs, read_ranges(client, table, runs, None, unit_id)):
+                current = store.tolist()
+                changed = [offset for offset in range(count) if current[offset] != originals[address + offset]]
+                # Greedy from the left: each request spans as many changed
+                # addresses as fit, rewriting unchanged ones in between
+                index = 0
+                while index < len(changed):
+                    start = stop = changed[index]
+                    while index < len(changed) and changed[index] - start < WRITE_LIMITS[table]:
+                        stop = changed[index]
+                        index += 1
+                    requests.append((address + start, [originals[address + offset] for offset in range(start, stop + 1)]))
+            restored = sum(len(values) for _, values in requests)
+            if self.dry_run:
+                print(Fore.YELLOW + f"Dry run: would restore {restored} {WRITE_NAMES[table][1]} of unit {unit_id} with {len(requests)} requests" + Style.RESET_ALL)
+                continue
+            written = all(write_request(client, table, address, values, unit_id) for address, values in requests)
+            if written and requests:
+                stores = read_ranges(client, table, [(address, len(values)) for address, values in requests], None, unit_id)
+                written = all(store.tolist() == values for store, (_, values) in zip(stores, requests))
+            if not written:
+                print(Fore.RED + f"Rollback of {WRITE_NAMES[table][1]} on unit {unit_id} failed; originals kept, run 'rollback' again." + Style.RESET_ALL)
+                ok = False
+                continue
+            self.log("rollback", key, restored=restored, requests=len(requests))
+            del self.originals[key]
+            print(Fore.GREEN + f"Rolled back {restored} {WRITE_NAMES[table][1]} of unit {unit_id} with {len(requests)} requests "
+                  f"({len(originals) - restored} already held their original values)" + Style.RESET_ALL)
+        return ok
+
+    def status(self):
+        return {"capture": self.enabled, "dry_run": self.dry_run, "journal": self.journal_path,
+                "allowed": {table: [[start, stop - 1] for start, stop in sorted(ranges)] for table, ranges in self.allowed.items()},
+                "captured": [{"device": device, "unit": unit, "table": table, "addresses": len(originals)}
+                             for (device, unit, table), originals in sorted(self.originals.items()) if originals]}
+
+write_guard = WriteGuard()
+
+def write_request(client, table, address, values, unit_id):
+    # One FC5/FC6 request for a single value, otherwise one FC15/FC16 request
+    count = len(values)
+    if table == "coils":
+        fc, size = (5, 5) if count == 1 else (15, 6 + ((count + 7) >> 3))
+    else:
+        fc, size = (6, 5) if count == 1 else (16, 6 + 2 * count)
+    if fc == 5:
+        call = lambda: client.write_coil(address, values[0], slave=unit_id)
+    elif fc == 15:
+        call = lambda: client.write_coils(address, values, slave=unit_id)
+    elif fc == 6:
+        call = lambda: client.write_register(address, values[0], slave=unit_id)
+    else:
+        call = lambda: client.write_registers(address, values, slave=unit_id)
     try:
-        result = client.write_registers(address, values, unit=current_unit_id)
+        result = client_call(client, unit_id, fc, address, count, size, 5, call)
         if result.isError():
-            logging.error(f"Failed to write multiple registers: {result}")
-        else:
-            print(Fore.GREEN + f"Written multiple registers starting at address {address}" + Style.RESET_ALL)
-            # Verify the written values
-            new_values = read_holding_registers(client, address, len(values))
-            if new_values and new_values == values:
-                print(Fore.GREEN + f"Verified multiple registers starting at address {address}" + Style.RESET_ALL)
-            else:
-                print(Fore.RED + f"Verification failed for multiple registers starting at address {address}" + Style.RESET_ALL)
+            logging.error(f"Failed to write {describe_range(table, address, count)}: {result}")
+            return False
+        return True
     except ModbusException as e:
-        logging.error(f"Exception while writing multiple registers: {e}")
+        logging.error(f"Exception while writing {describe_range(table, address, count)}: {e}")
+    except struct.error as e:
+        logging.error(f"Exception while writing {describe_range(table, address, count)}: {e}")
+    return False
+
+def verify_written(client, table, address, values, unit_id):
+    current = read_table(client, table, address, len(values), unit_id).tolist()
+    mismatches = [address + i for i, (expected, actual) in enumerate(zip(values, current)) if actual != expected]
+    if mismatches:
+        shown = ", ".join(str(a) for a in mismatches[:10]) + (", ..." if len(mismatches) > 10 else "")
+        print(Fore.RED + f"Verification failed for {len(mismatches)} of {len(values)} values starting at address {address} (addresses {shown})" + Style.RESET_ALL)
+        return False
+    print(Fore.GREEN + f"Verified {describe_range(table, address, len(values))}" + Style.RESET_ALL)
+    return True
+
+def write_values(client, table, address, values, verify=None, unit_id=None):
+    # Writes contiguous values with as few requests as the protocol allows and
+    # verifies them according to the policy; returns True on success
+    verify = verify_policy if verify is None else verify
+    unit_id = current_unit_id if unit_id is None else unit_id
+    values = list(values)
+    if not write_guard.permits(table, address, len(values)):
+        print(Fore.RED + f"Refusing to write {describe_range(table, address, len(values))}: outside the allowed write ranges" + Style.RESET_ALL)
+        return False
+    if write_guard.dry_run:
+        current = read_table(client, table, address, len(values), unit_id).tolist()
+        changed = sum(1 for before, after in zip(current, values) if before != after)
+        print(Fore.YELLOW + f"Dry run: would write {describe_range(table, address, len(values))} ({changed} would change)" + Style.RESET_ALL)
+        return True
+    if not write_guard.capture(client, table, [(address, len(values))], unit_id):
+        return False
+    key = (client_device(client), unit_id, table)
+    limit = WRITE_LIMITS[table]
+    for start in range(0, len(values), limit):
+        chunk = values[start:start + limit]
+        sent = write_request(client, table, address + start, chunk, unit_id)
+        write_guard.log("write", key, address + start, chunk, ok=sent)
+        if not sent:
+            return False
+        if verify == "strict" and not verify_written(client, table, address + start, chunk, unit_id):
+            return False
+    print(Fore.GREEN + f"Written {describe_range(table, address, len(values))}" + Style.RESET_ALL)
+    if verify == "once":
+        return verify_written(client, table, address, values, unit_id)
+    return True
+
+def write_coil(client, address, value, verify=None):
+    return write_values(client, "coils", address, [value], verify)
+
+def write_register(client, address, value, verify=None):
+    return write_values(client, "holding_registers", address, [value], verify)
+
+def write_multiple_coils(client, address, values, verify=None):
+    return write_values(client, "coils", address, values, verify)
+
+def write_multiple_registers(client, address, values, verify=None):
+    return write_values(client, "holding_registers", address, values, verify)
 
 def display_table(headers, data):
+    from prettytable import PrettyTable
     table = PrettyTable(headers)
     table.max_width = 40  # Adjust this as necessary for better readability
     for row in data:
         table.add_row(row)
     print(table)
 
-def message_parser(client):
-    try:
-        holding_registers = read_holding_registers(client, 0, 64)
-        messages = []
-        for reg in holding_registers:
-            if 0 <= reg <= 0xFFFF:
-                messages.append(chr(reg & 0xFF))
-                messages.append(chr((reg >> 8) & 0xFF))
+# Typed values: struct code and width in registers. Word order is the order of
+# the registers of a multi-register value ("big" = most significant first, the
+# Modbus convention); byte order is the order of the two bytes inside a register.
+DATA_TYPES = {
+    "int16": ("h", 1),
+    "uint16": ("H", 1),
+    "int32": ("i", 2),
+    "uint32": ("I", 2),
+    "float32": ("f", 2),
+    "int64": ("q", 4),
+    "uint64": ("Q", 4),
+    "float64": ("d", 4),
+}
+BYTE_ORDERS = ("big", "little")
+
+def ordered_words(store, width=1, word_order="big", byte_order="big", phase=0):
+    # Copy of a register block as an array('H') whose raw bytes, read big-endian,
+    # hold the `width`-register values starting at `phase` in their natural order
+    words = store.data[store.offset:store.offset + store.count]
+    if word_order == "little" and width > 1:
+        source = array("H", words)
+        end = phase + (store.count - phase) // width * width
+        for k in range(width):
+            words[phase + k:end:width] = source[phase + width - 1 - k:end:width]
+    if (sys.byteorder == "little") != (byte_order == "little"):
+        words.byteswap()
+    return words
+
+def span_valid(mask, offset, width):
+    return (mask >> offset) & ((1 << width) - 1) == (1 << width) - 1
+
+def decode_values(store, data_type, word_order="big", byte_order="big"):
+    # Every consecutive value of `data_type` in a register block, unpacked with a
+    # single struct call; values that touch an unread register are None
+    code, width = DATA_TYPES[data_type]
+    count = store.count // width
+    values = list(struct.unpack_from(f">{count}{code}", ordered_words(store, width, word_order, byte_order)))
+    mask = store.valid_mask()
+    if mask != (1 << store.count) - 1:
+        for i in range(count):
+            if not span_valid(mask, i * width, width):
+                values[i] = None
+    return values
+
+def decode_string(store, byte_order="big", encoding="latin-1"):
+    # Two characters per register; unread registers become '?'
+    data = memoryview(ordered_words(store, byte_order=byte_order)).cast("B")
+    mask = store.valid_mask()
+    if mask == (1 << store.count) - 1:
+        return str(data, encoding, "replace")
+    return "".join(str(data[i * 2:i * 2 + 2], encoding, "replace") if mask >> i & 1 else "?" for i in range(store.count))
+
+Tag = namedtuple("Tag", ["name", "table", "address", "data_type", "length", "word_order", "byte_order", "scale", "offset", "units"])
+
+def tag_width(tag):
+    if tag.data_type == "bool":
+        return 1
+    return tag.length if tag.data_type == "string" else DATA_TYPES[tag.data_type][1]
+
+def parse_tag(fields):
+    # <name> <table> <address> <type> [length=N] [scale=X] [offset=X] [units=U] [word=big|little] [byte=big|little]
+    if len(fields) < 4 or fields[1] not in READ_TABLES:
+        raise ValueError("expected '<name> <table> <address> <type> [key=value ...]'")
+    name, table, address, data_type = fields[0], fields[1], int(fields[2], 0), fields[3].lower()
+    options = {"length": "1", "scale": "1", "offset": "0", "units": "", "word": "big", "byte": "big"}
+    for field in fields[4:]:
+        key, _, value = field.partition("=")
+        if key not in options or not value:
+            raise ValueError(f"unknown tag option '{field}'")
+        options[key] = value
+    if options["word"] not in BYTE_ORDERS or options["byte"] not in BYTE_ORDERS:
+        raise ValueError("word and byte order must be 'big' or 'little'")
+    bits = READ_TABLES[table][0] <= 2
+    if bits != (data_type == "bool") or (not bits and data_type not in DATA_TYPES and data_type != "string"):
+        raise ValueError(f"type '{data_type}' does not fit {table} (use bool for bit tables, string or one of {', '.join(DATA_TYPES)} for registers)")
+    length = int(options["length"])
+    tag = Tag(name, table, address, data_type, length, options["word"], options["byte"],
+              float(options["scale"]), float(options["offset"]), options["units"])
+    if not 1 <= length <= READ_TABLES[table][1] or not 0 <= address <= ADDRESS_SPACE - tag_width(tag):
+        raise ValueError("tag does not fit in the address space or in one request")
+    return tag
+
+def load_tag_map(path):
+    tags, names = [], set()
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            try:
+                tag = parse_tag(fields)
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: {e}")
+            if tag.name in names:
+                raise ValueError(f"{path}:{line_number}: duplicate tag '{tag.name}'")
+            names.add(tag.name)
+            tags.append(tag)
+    return tags
+
+TagBlock = namedtuple("TagBlock", ["table", "address", "count", "layouts"])
+
+class TagMap:
+    # Tags packed into read blocks. Within a block, tags that share a layout
+    # (word order, byte order and register alignment) are decoded together by
+    # one precompiled struct, with pad bytes over the registers in between.
+    def __init__(self, tags):
+        self.tags = tags
+        self.blocks = []
+        for table, (_, limit) in READ_TABLES.items():
+            block = []
+            for tag in sorted((tag for tag in tags if tag.table == table), key=lambda tag: tag.address):
+                if block:
+                    start = block[0].address
+                    stop = max(t.address + tag_width(t) for t in block)
+                    if tag.address - stop > COALESCE_GAP[table] or max(stop, tag.address + tag_width(tag)) - start > limit:
+                        self.blocks.append(self.compile(table, block))
+                        block = []
+                block.append(tag)
+            if block:
+                self.blocks.append(self.compile(table, block))
+
+    def compile(self, table, tags):
+        start = tags[0].address
+        count = max(tag.address + tag_width(tag) for tag in tags) - start
+        if READ_TABLES[table][0] <= 2:
+            return TagBlock(table, start, count, [(None, tags)])
+        lanes = {}
+        for tag in tags:
+            width = tag_width(tag)
+            if tag.data_type != "string" and tag.word_order == "little" and width > 1:
+                key = ("little", tag.byte_order, width, (tag.address - start) % width)
+            else:
+                key = ("big", tag.byte_order, 1, 0)
+            # Overlapping tags (one register read as two types) go in separate lanes
+            for lane in lanes.setdefault(key, []):
+                if lane[-1].address + tag_width(lane[-1]) <= tag.address:
+                    lane.append(tag)
+                    break
+            else:
+                lanes[key].append([tag])
+        layouts = []
+        for key, key_lanes in lanes.items():
+            for lane in key_lanes:
+                fmt, position = [">"], start
+                for tag in lane:
+                    if tag.address > position:
+                        fmt.append(f"{(tag.address - position) * 2}x")
+                    fmt.append(f"{tag.length * 2}s" if tag.data_type == "string" else DATA_TYPES[tag.data_type][0])
+                    position = tag.address + tag_width(tag)
+                layouts.append((key + (struct.Struct("".join(fmt)),), lane))
+        return TagBlock(table, start, count, layouts)
+
+    def decode(self, block, store):
+        # (tag, value) for every tag of a block, given the block's RegisterStore
+        results = []
+        mask = store.valid_mask()
+        complete = mask == (1 << store.count) - 1
+        for layout, tags in block.layouts:
+            if layout is None:
+                values = [store[tag.address - block.address] for tag in tags]
             else:
-                messages.append('?')
-        return ''.join(messages)
+                word_order, byte_order, width, phase, unpacker = layout
+                values = unpacker.unpack_from(ordered_words(store, width, word_order, byte_order, phase))
+            for tag, value in zip(tags, values):
+                if not complete and not span_valid(mask, tag.address - block.address, tag_width(tag)):
+                    value = None
+                results.append((tag, scale_tag_value(tag, value)))
+        return results
+
+    def read(self, client, unit_id=None):
+        results = []
+        for table in READ_TABLES:
+            blocks = [block for block in self.blocks if block.table == table]
+            if blocks:
+                stores = read_ranges(client, table, [(block.address, block.count) for block in blocks], 0, unit_id)
+                for block, store in zip(blocks, stores):
+                    results.extend(self.decode(block, store))
+        return results
+
+def scale_tag_value(tag, value):
+    if value is None or tag.data_type == "bool":
+        return value
+    if tag.data_type == "string":
+        return value.decode("latin-1").rstrip("\x00")
+    if tag.scale != 1 or tag.offset:
+        return value * tag.scale + tag.offset
+    return value
+
+tag_map = None
+
+def set_tag_map(path):
+    global tag_map
+    tag_map = TagMap(load_tag_map(path))
+    return tag_map
+
+def message_parser(client, holding_registers=None):
+    try:
+        if holding_registers is None:
+            holding_registers = read_holding_registers(client, 0, 64)
+        # Messages are stored low byte first
+        return decode_string(holding_registers, byte_order="little")
     except Exception as e:
         logging.error(f"Failed to parse messages: {e}")
         return "No messages found."
 
-def grab_banner(client):
+def read_banner(client):
+    coils = read_coils(client, 0, 10)
+    discrete_inputs = read_discrete_inputs(client, 0, 10)
+    # One PDU covers both the banner and the message block
+    holding_registers, message_registers = read_ranges(client, "holding_registers", [(0, 10), (0, 64)])
+    input_registers = read_input_registers(client, 0, 10)
+    return coils, discrete_inputs, holding_registers, input_registers, message_registers
+
+def grab_banner(client, banner=None):
     try:
         banner_data = []
+        coils, discrete_inputs, holding_registers, input_registers, message_registers = banner or read_banner(client)
 
         # Try reading coils
-        coils = read_coils(client, 0, 10) or ["Unsupported"]
-        banner_data.append(["Coils", coils])
+        banner_data.append(["Coils", coils or ["Unsupported"]])
 
         # Try reading discrete inputs
-        discrete_inputs = read_discrete_inputs(client, 0, 10) or ["Unsupported"]
-        banner_data.append(["Discrete Inputs", discrete_inputs])
+        banner_data.append(["Discrete Inputs", discrete_inputs or ["Unsupported"]])
 
         # Try reading holding registers
-        holding_registers = read_holding_registers(client, 0, 10) or ["Unsupported"]
-        banner_data.append(["Holding Registers", holding_registers])
+        banner_data.append(["Holding Registers", holding_registers or ["Unsupported"]])
 
         # Try reading input registers
-        input_registers = read_input_registers(client, 0, 10) or ["Unsupported"]
-        banner_data.append(["Input Registers", input_registers])
+        banner_data.append(["Input Registers", input_registers or ["Unsupported"]])
 
         # Parse messages
-        messages = message_parser(client)
+        messages = message_parser(client, message_registers)
         banner_data.append(["Messages", messages])
 
         # Display the banner information
+        from prettytable import PrettyTable
         banner_table = PrettyTable()
         banner_table.field_names = ["Type", "Value"]
         banner_table.max_width = 40  # Adjust this as necessary for better readability
@@ -184,8 +1703,9 @@ def advanced_banner(client):
         discrete_inputs = read_discrete_inputs(client, 0, 10) or ["Unsupported"]
         banner_data.append(["Discrete Inputs", discrete_inputs])
 
-        # Try reading holding registers
-        holding_registers = read_holding_registers(client, 0, 10) or ["Unsupported"]
+        # Try reading holding registers (one PDU also covers the message block)
+        holding_registers, message_registers = read_ranges(client, "holding_registers", [(0, 10), (0, 64)])
+        holding_registers = holding_registers or ["Unsupported"]
         banner_data.append(["Holding Registers", holding_registers])
 
         # Try reading input registers
@@ -193,7 +1713,7 @@ def advanced_banner(client):
         banner_data.append(["Input Registers", input_registers])
 
         # Parse messages
-        messages = message_parser(client)
+        messages = message_parser(client, message_registers)
         banner_data.append(["Messages", messages])
 
         # Collect detailed information about each coil and register
@@ -204,6 +1724,7 @@ def advanced_banner(client):
         banner_data.append(["Register Descriptions", register_descriptions])
 
         # Display the advanced banner information
+        from prettytable import PrettyTable
         banner_table = PrettyTable()
         banner_table.field_names = ["Type", "Value"]
         banner_table.max_width = 40  # Adjust this as necessary for better readability
@@ -215,54 +1736,291 @@ def advanced_banner(client):
     except Exception as e:
         logging.error(f"Failed to grab advanced banner: {e}")
 
-def find_unit_ids(client):
-    start = b"\x21\x00\x00\x00\x00\x06"
-    theend = b"\x04\x00\x01\x00\x00"
-    noll = b"\x00"
+class AsyncMbapConnection:
+    # Single asyncio Modbus/TCP connection shared by many concurrent requests;
+    # a reader task hands each response to the waiter with the same transaction ID
+    def __init__(self, host, port, timeout=3.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.dispatcher = None
+        self.pending = {}
+        self.transaction_id = 0
+        self.connect_lock = asyncio.Lock()
+        self.connect_error = None
 
-    active_unit_ids = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(probe_unit_id, client, unit_id, start, theend, noll) for unit_id in range(1, 255)]
-        for future in futures:
-            result = future.result()
-            if result:
-                active_unit_ids.append(result)
-    
-    return active_unit_ids
+    async def connect(self):
+        # A failed connect is remembered, so the requests queued behind it on
+        # the lock fail at once instead of each waiting out its own timeout
+        async with self.connect_lock:
+            if self.connect_error is not None:
+                raise self.connect_error
+            if self.writer is None:
+                try:
+                    self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    logging.error(f"Failed to connect to {self.host}:{self.port}: {str(e) or 'timed out'}")
+                    self.connect_error = e
+                    raise
+                self.writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.dispatcher = asyncio.create_task(self._dispatch())
+
+    async def close(self):
+        writer, self.writer = self.writer, None
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+            self.dispatcher = None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _dispatch(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(MBAP_HEADER.size)
+                tid, protocol, length, unit = MBAP_HEADER.unpack(header)
+                if length < 2:
+                    raise ConnectionError(f"invalid MBAP length {length}")
+                pdu = await self.reader.readexactly(length - 1)
+                future = self.pending.pop(tid, None)
+                if future is not None and not future.done() and protocol == 0:
+                    future.set_result(pdu)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            logging.error(f"Connection to {self.host}:{self.port} lost: {e}")
+        finally:
+            # close() takes the writer first and closes it itself
+            if self.writer is not None:
+                self.writer.close()
+            self.reader = self.writer = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_result(None)
+            self.pending.clear()
+
+    async def request(self, unit, pdu):
+        # Response PDU, or None once every attempt timed out; exception
+        # responses are returned straight away
+        estimator = rtt_estimator(f"{self.host}:{self.port}")
+        for attempt in range(max_retries + 1):
+            if attempt:
+                await asyncio.sleep(retry_delay(attempt))
+            try:
+                await self.connect()
+            except (OSError, asyncio.TimeoutError):
+                return None
+            response = await self._attempt(unit, pdu, estimator, attempt)
+            if response is not None:
+                return response
+        return None
+
+    async def _attempt(self, unit, pdu, estimator, attempt):
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        tid = self.transaction_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tid] = future
+        response = None
+        started = time.monotonic()
+        try:
+            self.writer.write(MBAP_HEADER.pack(tid, 0, len(pdu) + 1, unit) + pdu)
+            # The first responses of a sweep shrink the timeout of requests
+            # already in flight, so re-check the deadline every min_timeout
+            while not future.done():
+                remaining = started + estimator.timeout(self.timeout) - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), min(remaining, min_timeout))
+                except asyncio.TimeoutError:
+                    pass
+            response = future.result()
+            if response is not None:
+                estimator.observe(time.monotonic() - started)
+            return response
+        finally:
+            self.pending.pop(tid, None)
+            record_pdu("async", f"{self.host}:{self.port}", unit, pdu, response, time.monotonic() - started, attempt=attempt)
+
+async def execute_async(host, port, requests, concurrency, timeout):
+    connection = AsyncMbapConnection(host, port, timeout)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(unit, pdu):
+        async with semaphore:
+            return await connection.request(unit, pdu)
 
-def probe_unit_id(client, unit_id, start, theend, noll):
-    sploit = start + unit_id.to_bytes(1, 'big') + theend
     try:
-        client.connect()
-        client.socket.sendall(sploit)
-        data = client.socket.recv(12)
-        client.close()
+        return await asyncio.gather(*(run(unit, pdu) for unit, pdu in requests))
+    finally:
+        await connection.close()
 
-        if not data:
-            data = noll * 4
+def execute_concurrent(client, requests, concurrency=16, timeout=3.0):
+    # requests: list of (unit_id, pdu); returns the response PDU (or None) for each.
+    # A serial bus answers one request at a time, so there is nothing to overlap.
+    if isinstance(client, SerialClient):
+        return client.transport.execute(requests)
+    return asyncio.run(execute_async(client.comm_params.host, client.comm_params.port, requests, concurrency, timeout))
 
-        if data[:4] == b"\x21\x00\x00\x00":
+def unit_responded(pdu):
+    # Gateways answer for absent units with "path unavailable" / "target failed to respond"
+    return pdu is not None and not (len(pdu) >= 2 and pdu[0] & 0x80 and pdu[1] in (10, 11))
+
+def find_unit_ids(client, concurrency=16, timeout=3.0):
+    unit_ids = range(1, 255)
+    responses = execute_concurrent(client, [(unit_id, encode_read_request(4, 0, 1)) for unit_id in unit_ids], concurrency, timeout)
+
+    active_unit_ids = []
+    for unit_id, pdu in zip(unit_ids, responses):
+        if unit_responded(pdu):
             print(Fore.GREEN + f"Received: correct MODBUS/TCP from Unit ID {unit_id}" + Style.RESET_ALL)
-            return unit_id
+            active_unit_ids.append(unit_id)
         else:
             print(Fore.YELLOW + f"Received: incorrect/none data from Unit ID {unit_id} (probably not in use)" + Style.RESET_ALL)
-    except Exception as e:
-        logging.error(f"Exception while probing Unit ID {unit_id}: {e}")
-    return None
+    return active_unit_ids
 
-def enumerate_unit(client, unit_id):
-    set_unit_id(unit_id)
-    print(Fore.CYAN + f"Grabbing banner for Unit ID {unit_id}..." + Style.RESET_ALL)
-    grab_banner(client)
+# (table, address, count) reads that make up a banner, in read_banner order
+BANNER_READS = [
+    ("coils", 0, 10),
+    ("discrete_inputs", 0, 10),
+    ("holding_registers", 0, 64),
+    ("input_registers", 0, 10),
+]
 
-def enumerate_units(client):
+def enumerate_units(client, concurrency=16, timeout=3.0):
     print(Fore.CYAN + "Enumerating Unit IDs..." + Style.RESET_ALL)
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(enumerate_unit, client, unit_id) for unit_id in range(1, 255)]
-        for future in futures:
-            future.result()
+    active_unit_ids = find_unit_ids(client, concurrency, timeout)
+
+    requests = []
+    for unit_id in active_unit_ids:
+        for table, address, count in BANNER_READS:
+            requests.append((unit_id, encode_read_request(READ_TABLES[table][0], address, count)))
+    responses = execute_concurrent(client, requests, concurrency, timeout)
+
+    for i, unit_id in enumerate(active_unit_ids):
+        blocks = []
+        for (table, address, count), pdu in zip(BANNER_READS, responses[i * len(BANNER_READS):]):
+            blocks.append(decode_block(table, address, count, pdu))
+        coils, discrete_inputs, message_registers, input_registers = blocks
+        print(Fore.CYAN + f"Grabbing banner for Unit ID {unit_id}..." + Style.RESET_ALL)
+        grab_banner(client, (coils, discrete_inputs, message_registers[:10], input_registers, message_registers))
+
+# Spacing of the single-address probes that seed discovery; ranges narrower
+# than this that fall between two probes are not found
+DISCOVERY_STEP = {
+    "coils": 256,
+    "discrete_inputs": 256,
+    "holding_registers": 32,
+    "input_registers": 32,
+}
+
+def probe_reads(client, unit_id, fc, reads, concurrency, timeout):
+    # True for every (address, count) read that returned data, else the
+    # exception code, or None when nothing came back
+    responses = execute_concurrent(client, [(unit_id, encode_read_request(fc, address, count)) for address, count in reads], concurrency, timeout)
+    return [None if pdu is None else True if pdu[:1] == bytes([fc]) else pdu[1] if len(pdu) >= 2 else None for pdu in responses]
+
+def bisect_counts(client, unit_id, fc, searches, concurrency, timeout):
+    # searches: [first(count), lo, hi] with read(first(lo), lo) answering and
+    # read(first(hi), hi) known to fail; narrows all of them in parallel, one
+    # round of requests per halving, and returns the largest answering counts
+    while True:
+        active = [search for search in searches if search[2] - search[1] > 1]
+        if not active:
+            return [search[1] for search in searches]
+        reads = []
+        for search in active:
+            mid = (search[1] + search[2]) // 2
+            reads.append((search[0](mid), mid))
+        for search, (_, mid), ok in zip(active, reads, probe_reads(client, unit_id, fc, reads, concurrency, timeout)):
+            if ok is True:
+                search[1] = mid
+            else:
+                search[2] = mid
+
+def discover_table(client, unit_id, table, step, concurrency=16, timeout=3.0):
+    # Valid (address, count) ranges of one table, or None if the function code is unsupported;
+    # raises ModbusIOException when no probe was answered at all.
+    # Probes one address every `step`, checks that neighbouring answering probes are joined
+    # by a readable block, then bisects every boundary: O(log step) requests each.
+    fc, limit = READ_TABLES[table]
+    step = max(1, min(step, limit))
+    grid = list(range(0, ADDRESS_SPACE, step))
+    seeds = probe_reads(client, unit_id, fc, [(address, 1) for address in grid], concurrency, timeout)
+    if all(seed is None for seed in seeds):
+        raise ModbusIOException(f"unit {unit_id} did not answer any {TABLE_TITLES[table].lower()} probe")
+    # True == 1, so answered probes must not count as Illegal Function
+    if all(seed is not True and seed == 1 for seed in seeds):
+        return None
+    valid = [seed is True for seed in seeds]
+    joined = [False] * len(grid)
+    spans = [i for i in range(len(grid) - 1) if valid[i] and valid[i + 1]]
+    for i, ok in zip(spans, probe_reads(client, unit_id, fc, [(grid[i], step) for i in spans], concurrency, timeout)):
+        joined[i] = ok is True
+
+    # End of the run holding each answering probe that is not joined to the next one,
+    # and start of the run holding each one not joined to the previous one
+    ends = [i for i in range(len(grid)) if valid[i] and not joined[i]]
+    starts = [i for i in range(1, len(grid)) if valid[i] and not joined[i - 1]]
+    searches = [[lambda count, g=grid[i]: g, 1, min(step, ADDRESS_SPACE - grid[i]) + 1] for i in ends]
+    searches += [[lambda count, g=grid[i]: g - count + 1, 1, step + 1] for i in starts]
+    counts = bisect_counts(client, unit_id, fc, searches, concurrency, timeout)
+    run_end = dict(zip(ends, counts[:len(ends)]))
+    run_start = dict(zip(starts, counts[len(ends):]))
+
+    ranges = []
+    for i, address in enumerate(grid):
+        if not valid[i]:
+            continue
+        start = address - run_start[i] + 1 if i in run_start else address
+        end = address + run_end[i] if i in run_end else address + step
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return [(start, end - start) for start, end in ranges]
+
+def discover(client, unit_id=None, step=None, concurrency=16, timeout=3.0):
+    unit_id = current_unit_id if unit_id is None else unit_id
+    tables = {}
+    for table in READ_TABLES:
+        print(Fore.CYAN + f"Discovering {TABLE_TITLES[table]} on unit {unit_id}..." + Style.RESET_ALL)
+        try:
+            tables[table] = discover_table(client, unit_id, table, step or DISCOVERY_STEP[table], concurrency, timeout)
+        except ModbusIOException as e:
+            # A silent unit is not an empty one: keep (and save) no map for it
+            print(Fore.RED + f"Discovery failed, no capability map kept: {e}" + Style.RESET_ALL)
+            return False
+    capabilities[capability_key(client, unit_id)] = tables
+    if capabilities_path:
+        save_capabilities(capabilities_path)
+    return tables
+
+def load_capabilities(path):
+    with open(path) as f:
+        data = json.load(f)
+    for key, tables in data.items():
+        capabilities[key] = {table: None if ranges is None else [tuple(r) for r in ranges]
+                             for table, ranges in tables.items() if table in READ_TABLES}
+
+def save_capabilities(path):
+    try:
+        with open(path, "w") as f:
+            json.dump(capabilities, f, indent=1)
+    except OSError as e:
+        print(Fore.RED + f"Failed to save capability map: {e}" + Style.RESET_ALL)
 
 def network_details(client, ip):
+    if isinstance(client, SerialClient):
+        print(Fore.YELLOW + f"Serial line {client.transport.path}: {client.transport.framing.upper()} at {client.transport.baudrate} baud, no network details." + Style.RESET_ALL)
+        return
     try:
         server_info = socket.gethostbyaddr(ip)
         print(Fore.CYAN + f"Modbus Server Hostname: {server_info[0]}" + Style.RESET_ALL)
@@ -280,36 +2038,10 @@ def network_details(client, ip):
         print(Fore.CYAN + f"Modbus Server IP Address: {ip}" + Style.RESET_ALL)
 
 def display_help():
-    commands = [
-        ["read_coils <address> <count>", "Read coils from the given address."],
-        ["read_discrete_inputs <address> <count>", "Read discrete inputs from the given address."],
-        ["read_holding_registers <address> <count>", "Read holding registers from the given address."],
-        ["read_input_registers <address> <count>", "Read input registers from the given address."],
-        ["write_coil <address> <value>", "Write a value to a coil at the given address."],
-        ["write_register <address> <value>", "Write a value to a register at the given address."],
-        ["write_multiple_coils <address> <values>", "Write multiple coils starting at the given address."],
-        ["write_multiple_registers <address> <values>", "Write multiple registers starting at the given address."],
-        ["display_all_coils", "Display the first 100 coils."],
-        ["display_all_discrete_inputs", "Display the first 100 discrete inputs."],
-        ["display_all_holding_registers", "Display the first 100 holding registers."],
-        ["display_all_input_registers", "Display the first 100 input registers."],
-        ["chaos_mode", "Alternate coil values in the first 100 coils."],
-        ["network_details", "Show the network details of the Modbus server."],
-        ["grab_banner", "Grab the banner of the Modbus server."],
-        ["advanced_banner", "Grab a detailed banner of the Modbus server."],
-        ["find_unit_ids", "Find active Modbus Unit IDs in the range 1 to 254."],
-        ["enumerate", "Enumerate all Unit IDs and display their banners."],
-        ["set_unit_id <unit_id>", "Set the current Unit ID to use for operations."],
-        ["hex_modify <address> <hex_value>", "Modify register value at the given address."],
-        ["hex_randomize <count>", "Randomize values in the given number of registers."],
-        ["text_edit <text>", "Edit text in the first registers."],
-        ["crash_system [speed]", "Overload the system with random data at the given speed (default: 0.01s)."],
-        ["monitor", "Continuously fetch and display the Modbus banner in real time."],
-        ["help", "Display the list of commands."],
-        ["exit", "Exit the client."]
-    ]
-    for cmd, desc in commands:
-        print(Fore.YELLOW + f"{cmd:<45} {desc}" + Style.RESET_ALL)
+    for command in COMMANDS.values():
+        print(Fore.YELLOW + f"{command.usage:<45} {command.description}" + Style.RESET_ALL)
+    print(Fore.YELLOW + f"{'on <target|group|all> <command>':<45} Run a command against other targets." + Style.RESET_ALL)
+    print(Fore.YELLOW + f"{'exit':<45} Exit the client." + Style.RESET_ALL)
     print()
 
 def hex_modify(client, address, hex_value):
@@ -319,21 +2051,28 @@ def hex_modify(client, address, hex_value):
         while int_value > 0:
             values.append(int_value & 0xFFFF)
             int_value >>= 16
+        values = values or [0]
 
-        for i, value in enumerate(values):
-            write_register(client, address + i, value)
-            print(Fore.GREEN + f"Written hex value {format(value, '04x')} to register at address {address + i}" + Style.RESET_ALL)
+        ok = write_multiple_registers(client, address, values)
+        # Refused, failed and dry-run writes changed nothing
+        if ok and not write_guard.dry_run:
+            for i, value in enumerate(values):
+                print(Fore.GREEN + f"Written hex value {format(value, '04x')} to register at address {address + i}" + Style.RESET_ALL)
+        return ok
     except ValueError:
         print(Fore.RED + "Invalid hex value." + Style.RESET_ALL)
+        return False
 
 def hex_randomize(client, count):
-    for i in range(count):
-        random_value = random.randint(0, 0xFFFF)
-        hex_value = format(random_value, '04x')
-        write_register(client, i, random_value)
-        print(Fore.GREEN + f"Randomized register at address {i} with hex value {hex_value}" + Style.RESET_ALL)
-        time.sleep(0.1)
-    logging.info("Hex Randomize mode activated.")
+    # The registers are contiguous, so they go out as FC16 requests of up to
+    # 123 values, with the guard and dry run applied once to the whole range
+    values = [random.randint(0, 0xFFFF) for _ in range(count)]
+    ok = write_multiple_registers(client, 0, values)
+    if ok and not write_guard.dry_run:
+        for i, value in enumerate(values):
+            print(Fore.GREEN + f"Randomized register at address {i} with hex value {format(value, '04x')}" + Style.RESET_ALL)
+        logging.info("Hex Randomize mode activated.")
+    return ok
 
 def string_to_hex_list(text):
     hex_list = []
@@ -344,224 +2083,1960 @@ def string_to_hex_list(text):
 
 def text_edit(client, text):
     hex_list = string_to_hex_list(text)
-    for i, hex_value in enumerate(hex_list):
-        int_value = int(hex_value, 16)
-        try:
-            write_register(client, i, int_value)
-            print(Fore.GREEN + f"Written character '{chr(int_value)}' as hex value {hex_value} to register at address {i}" + Style.RESET_ALL)
-            time.sleep(0.1)
-        except ModbusException as e:
-            logging.error(f"Exception while writing in text_edit at address {i}: {e}")
-    logging.info("Text edit mode activated.")
+    ok = write_multiple_registers(client, 0, [int(hex_value, 16) for hex_value in hex_list])
+    if ok and not write_guard.dry_run:
+        for i, hex_value in enumerate(hex_list):
+            print(Fore.GREEN + f"Written character '{text[i]}' as hex value {hex_value} to register at address {i}" + Style.RESET_ALL)
+        logging.info("Text edit mode activated.")
+    return ok
 
 def crash_system(client, speed=0.01):
     max_registers = 65535
+    if write_guard.dry_run:
+        # One report (and one read) for the whole range instead of one per register
+        return write_values(client, "holding_registers", 0, [random.randint(0, 0xFFFF) for _ in range(max_registers)], "off")
+    if not write_guard.capture(client, "holding_registers", [(0, max_registers)], current_unit_id):
+        return False
     for i in range(max_registers):
         random_value = random.randint(0, 0xFFFF)
         hex_value = format(random_value, '04x')
         random_unit_id = random.randint(1, 254)
         try:
-            write_register(client, i, random_value)
-            print(Fore.RED + f"Written random value {random_value} (hex {hex_value}) to register at address {i}" + Style.RESET_ALL)
+            if write_register(client, i, random_value, verify="off"):
+                print(Fore.RED + f"Written random value {random_value} (hex {hex_value}) to register at address {i}" + Style.RESET_ALL)
         except ModbusException as e:
             logging.error(f"Exception while writing in crash_system at address {i}: {e}")
         time.sleep(speed)
     logging.info("Crash system activated: System overloaded with random data.")
 
-def monitor(client):
+class SnapshotBlock:
+    def __init__(self, table, address, count, interval, priority=0):
+        self.table = table
+        self.address = address
+        self.count = count
+        self.interval = interval
+        self.priority = priority
+        self.values = None
+        self.updated = None  # time.monotonic() of the last poll
+
+    def due_at(self):
+        return float("-inf") if self.updated is None else self.updated + self.interval
+
+class UnitSnapshot:
+    # Cached view of one unit's tables, polled block by block as each falls due
+    def __init__(self, unit_id):
+        self.unit_id = unit_id
+        self.blocks = []
+
+    def watch(self, table, address, count, interval, priority=0):
+        for block in self.blocks:
+            if (block.table, block.address, block.count) == (table, address, count):
+                block.interval = interval
+                block.priority = priority
+                return block
+        block = SnapshotBlock(table, address, count, interval, priority)
+        self.blocks.append(block)
+        return block
+
+    def next_due(self):
+        return min(block.due_at() for block in self.blocks)
+
+    def due_blocks(self, now):
+        due = {}
+        for block in self.blocks:
+            if block.due_at() <= now:
+                due.setdefault(block.table, []).append(block)
+        return due
+
+    def apply(self, block, values, now):
+        # Store a fresh poll; returns (block, offset, value) for every changed cell
+        previous, block.values, block.updated = block.values, values, now
+        offsets = range(len(values)) if previous is None else previous.diff(values)
+        return [(block, offset, values[offset]) for offset in offsets]
+
+class RateLimiter:
+    # Token bucket: `rate` requests per second with bursts of up to `burst`
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class PollScheduler:
+    # Polls the blocks of several unit snapshots, merging due blocks into as few
+    # PDUs as possible and capping the request rate overall and per unit. Each
+    # scheduler owns its snapshots, so it only polls the blocks added to it.
+    def __init__(self, max_rate=0, max_unit_rate=0):
+        self.max_unit_rate = max_unit_rate
+        self.global_limiter = RateLimiter(max_rate) if max_rate > 0 else None
+        self.unit_limiters = {}
+        self.snapshots = []
+
+    def add(self, unit_id, table, address, count, interval, priority=0):
+        for snapshot in self.snapshots:
+            if snapshot.unit_id == unit_id:
+                break
+        else:
+            snapshot = UnitSnapshot(unit_id)
+            self.snapshots.append(snapshot)
+        return snapshot.watch(table, address, count, interval, priority)
+
+    def next_due(self):
+        return min(snapshot.next_due() for snapshot in self.snapshots)
+
+    def throttle(self, unit_id):
+        limiters = [self.global_limiter] if self.global_limiter else []
+        if self.max_unit_rate > 0:
+            if unit_id not in self.unit_limiters:
+                self.unit_limiters[unit_id] = RateLimiter(self.max_unit_rate)
+            limiters.append(self.unit_limiters[unit_id])
+        if not limiters:
+            return
+        delay = max(limiter.wait_time(time.monotonic()) for limiter in limiters)
+        if delay > 0:
+            time.sleep(delay)
+        now = time.monotonic()
+        for limiter in limiters:
+            limiter.consume(now)
+
+    def poll(self, client, now=None):
+        # Returns (block, offset, value) for every cell that changed
+        now = time.monotonic() if now is None else now
+        groups = []
+        for snapshot in self.snapshots:
+            for table, blocks in snapshot.due_blocks(now).items():
+                groups.append((snapshot, table, blocks))
+        # Highest priority first, then the most overdue
+        groups.sort(key=lambda group: (-max(block.priority for block in group[2]), min(block.due_at() for block in group[2])))
+
+        changes = []
+        throttled = self.global_limiter is not None or self.max_unit_rate > 0
+        for snapshot, table, blocks in groups:
+            ranges = [(block.address, block.count) for block in blocks]
+            pdus = plan_table_reads(client, table, ranges, COALESCE_GAP[table], snapshot.unit_id)
+            if throttled:
+                data = []
+                for pdu in pdus:
+                    self.throttle(snapshot.unit_id)
+                    data.extend(read_blocks(client, table, [pdu], snapshot.unit_id))
+            else:
+                data = read_blocks(client, table, pdus, snapshot.unit_id)
+            for block, values in zip(blocks, stitch_ranges(table, pdus, data, ranges)):
+                changes.extend(snapshot.apply(block, values, time.monotonic()))
+        return changes
+
+def load_poll_list(path):
+    # One entry per line: <unit> <table> <address> <count> <interval> [priority]
+    entries = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) not in (5, 6) or fields[1] not in READ_TABLES:
+                raise ValueError(f"{path}:{line_number}: expected '<unit> <table> <address> <count> <interval> [priority]'")
+            unit_id, table, address, count = int(fields[0]), fields[1], int(fields[2]), int(fields[3])
+            interval = float(fields[4])
+            priority = int(fields[5]) if len(fields) == 6 else 0
+            entries.append((unit_id, table, address, count, interval, priority))
+    return entries
+
+TABLE_TITLES = {
+    "coils": "Coils",
+    "discrete_inputs": "Discrete Inputs",
+    "holding_registers": "Holding Registers",
+    "input_registers": "Input Registers",
+}
+
+def format_cell(value):
+    if value is None:
+        return "?"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value)
+
+class LiveView:
+    # Fixed screen layout for a snapshot so updates can move the cursor to a
+    # single cell instead of redrawing the terminal
+    def __init__(self, snapshots, per_row=10, width=6):
+        self.snapshots = snapshots
+        self.per_row = per_row
+        self.width = width
+        self.positions = {}
+        self.message_row = None
+        self.status_row = None
+
+    def draw(self):
+        lines = [Fore.CYAN + "Monitoring (Ctrl+C to stop)" + Style.RESET_ALL]
+        for snapshot, block in self.blocks():
+            lines.append(Fore.CYAN + f"Unit {snapshot.unit_id} {TABLE_TITLES[block.table]} {block.address}-{block.address + block.count - 1}" + Style.RESET_ALL)
+            bits = READ_TABLES[block.table][0] <= 2
+            # Bits pack 32 to a row in groups of 8, like the read grid
+            per_row, width = (32, 1) if bits else (self.per_row, self.width)
+            for row_start in range(0, block.count, per_row):
+                cells = []
+                for offset in range(row_start, min(row_start + per_row, block.count)):
+                    column = offset - row_start
+                    gap = column // 8 + 1 if bits else 0
+                    self.positions[(id(block), offset)] = (len(lines) + 1, 8 + column * width + gap, width)
+                    cell = format_cell(block.values[offset] if block.values else None).rjust(width)
+                    cells.append(" " + cell if bits and column % 8 == 0 else cell)
+                lines.append(f"{block.address + row_start:>6}:" + "".join(cells))
+        if self.message_block() is not None:
+            lines.append(Fore.CYAN + "Messages" + Style.RESET_ALL)
+            lines.append(self.message_text())
+            self.message_row = len(lines)
+        lines.append("")
+        self.status_row = len(lines)
+        sys.stdout.write("\033[H\033[2J" + "\n".join(lines))
+        self.status("")
+
+    def blocks(self):
+        for snapshot in self.snapshots:
+            for block in snapshot.blocks:
+                yield snapshot, block
+
+    def message_block(self):
+        for _, block in self.blocks():
+            if block.table == "holding_registers" and block.address == 0 and block.count >= 64:
+                return block
+        return None
+
+    def message_text(self):
+        block = self.message_block()
+        text = message_parser(None, block.values[:64]) if block.values else ""
+        return "".join(c if c.isprintable() else "." for c in text)
+
+    def update(self, changes):
+        out = []
+        message_changed = False
+        for block, offset, value in changes:
+            row, col, width = self.positions[(id(block), offset)]
+            out.append(f"\033[{row};{col}H" + Fore.YELLOW + format_cell(value).rjust(width) + Style.RESET_ALL)
+            message_changed = message_changed or (block is self.message_block() and offset < 64)
+        if message_changed:
+            out.append(f"\033[{self.message_row};1H\033[2K" + self.message_text())
+        sys.stdout.write("".join(out))
+        self.status(f"Last refresh {time.strftime('%H:%M:%S')}, {len(changes)} changed")
+
+    def status(self, text):
+        sys.stdout.write(f"\033[{self.status_row};1H\033[2K{text}")
+        sys.stdout.flush()
+
+    def close(self):
+        sys.stdout.write(f"\033[{self.status_row + 1};1H")
+        sys.stdout.flush()
+
+def run_live_view(client, scheduler):
+    view = None
     try:
+        scheduler.poll(client)
+        view = LiveView(scheduler.snapshots)
+        view.draw()
         while True:
-            print("\033c", end="")  # Clear the screen
-            grab_banner(client)
-            time.sleep(1)
+            time.sleep(max(0, scheduler.next_due() - time.monotonic()))
+            view.update(scheduler.poll(client))
     except KeyboardInterrupt:
+        if view is not None:
+            view.close()
         print(Fore.CYAN + "\nMonitoring stopped." + Style.RESET_ALL)
     except Exception as e:
         logging.error(f"Exception during monitoring: {e}")
         print(Fore.RED + f"Exception during monitoring: {e}" + Style.RESET_ALL)
 
+def monitor(client, interval=1.0, max_rate=0, max_unit_rate=0):
+    scheduler = PollScheduler(max_rate, max_unit_rate)
+    for table, address, count in BANNER_READS:
+        scheduler.add(current_unit_id, table, address, count, interval)
+    run_live_view(client, scheduler)
+
+def poll(client, path, max_rate=0, max_unit_rate=0):
+    try:
+        entries = load_poll_list(path)
+    except (OSError, ValueError) as e:
+        print(Fore.RED + f"Failed to load poll list: {e}" + Style.RESET_ALL)
+        return
+    if not entries:
+        print(Fore.RED + "Poll list is empty." + Style.RESET_ALL)
+        return
+    scheduler = PollScheduler(max_rate, max_unit_rate)
+    for entry in entries:
+        scheduler.add(*entry)
+    run_live_view(client, scheduler)
+
+# Binary snapshot: magic, 4-byte header length, JSON header, then records of
+# (function code, address, count) followed by the exported data and validity bytes
+SNAPSHOT_MAGIC = b"SBSNAP\x00\x01"
+SNAPSHOT_RECORD = struct.Struct(">BHI")
+TABLES_BY_CODE = {fc: table for table, (fc, _) in READ_TABLES.items()}
+
+# PDUs read (and written out) per chunk while dumping
+DUMP_CHUNK_PDUS = 32
+
+def timestamp():
+    return time.strftime("%Y-%m-%dT%H:%M:%S%z")
+
+def dump_format(path):
+    return {".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl"}.get(os.path.splitext(path)[1].lower(), "snapshot")
+
+class SnapshotWriter:
+    def __init__(self, path, header):
+        self.file = open(path, "wb")
+        meta = json.dumps(header).encode()
+        self.file.write(SNAPSHOT_MAGIC + struct.pack(">I", len(meta)) + meta)
+
+    def write(self, store):
+        data, valid = store.export()
+        self.file.write(SNAPSHOT_RECORD.pack(READ_TABLES[store.table][0], store.address, store.count) + data + valid)
+
+    def close(self):
+        self.file.close()
+
+class JsonlWriter:
+    def __init__(self, path, header):
+        self.file = open(path, "w")
+        self.file.write(json.dumps(header) + "\n")
+
+    def write(self, store):
+        self.file.write(json.dumps({"table": store.table, "address": store.address, "time": timestamp(), "values": store.tolist()}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+class CsvWriter:
+    COLUMNS = ["time", "host", "port", "unit", "table", "address", "value"]
+
+    def __init__(self, path, header):
+        self.file = open(path, "w", newline="")
+        self.header = header
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.COLUMNS)
+
+    def write(self, store):
+        now, header = timestamp(), self.header
+        self.writer.writerows(
+            [now, header["host"], header["port"], header["unit"], store.table, address, "" if value is None else int(value)]
+            for address, value in store.items())
+
+    def close(self):
+        self.file.close()
+
+DUMP_WRITERS = {"csv": CsvWriter, "jsonl": JsonlWriter, "snapshot": SnapshotWriter}
+
+def iter_dump(path):
+    # Yields the header dict, then one RegisterStore per record, without loading the whole file
+    fmt = dump_format(path)
+    if fmt == "snapshot":
+        with open(path, "rb") as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError(f"{path} is not a sploitbus snapshot")
+            (length,) = struct.unpack(">I", f.read(4))
+            yield json.loads(f.read(length))
+            while True:
+                record = f.read(SNAPSHOT_RECORD.size)
+                if len(record) < SNAPSHOT_RECORD.size:
+                    break
+                fc, address, count = SNAPSHOT_RECORD.unpack(record)
+                table = TABLES_BY_CODE[fc]
+                size = (count + 7) >> 3
+                data = f.read(size if fc <= 2 else count * 2)
+                yield RegisterStore.from_export(table, address, count, data, f.read(size))
+    elif fmt == "jsonl":
+        with open(path) as f:
+            yield json.loads(f.readline())
+            for line in f:
+                record = json.loads(line)
+                store = RegisterStore(record["table"], record["address"], len(record["values"]))
+                store.set_values(0, record["values"])
+                yield store
+    else:
+        with open(path, newline="") as f:
+            rows = csv.DictReader(f)
+            run = []
+            for row in rows:
+                if not run:
+                    yield {"host": row["host"], "port": int(row["port"]), "unit": int(row["unit"]), "timestamp": row["time"]}
+                address = int(row["address"])
+                if run and (row["table"] != run[0][0] or address != run[-1][1] + 1 or len(run) >= 4096):
+                    yield csv_run_store(run)
+                    run = []
+                run.append((row["table"], address, None if row["value"] == "" else int(row["value"])))
+            if run:
+                yield csv_run_store(run)
+
+def csv_run_store(run):
+    store = RegisterStore(run[0][0], run[0][1], len(run))
+    store.set_values(0, [value for _, _, value in run])
+    return store
+
+def load_snapshot(path):
+    # Returns (header, {table: RegisterStore}) with each table's records merged
+    # into one store spanning the lowest to the highest address dumped
+    records = iter_dump(path)
+    header = next(records, None)
+    if header is None:
+        # e.g. a CSV dump interrupted before its first row
+        raise ValueError(f"{path}: empty dump")
+    chunks = {}
+    for store in records:
+        chunks.setdefault(store.table, []).append(store)
+    tables = {}
+    for table, stores in chunks.items():
+        start = min(store.address for store in stores)
+        merged = RegisterStore(table, start, max(store.address + store.count for store in stores) - start)
+        for store in stores:
+            merged.copy_from(store.address - start, store)
+        tables[table] = merged
+    return header, tables
+
+def parse_dump_ranges(args):
+    # [table [address count]] -> list of (table, address, count); no table means everything
+    if not args or args[0] == "all":
+        return [(table, 0, ADDRESS_SPACE) for table in READ_TABLES]
+    if args[0] not in READ_TABLES or len(args) not in (1, 3):
+        raise ValueError("expected [table [address count]]")
+    if len(args) == 1:
+        return [(args[0], 0, ADDRESS_SPACE)]
+    address, count = int(args[1]), int(args[2])
+    return [(args[0], address, min(count, ADDRESS_SPACE - address))]
+
+def dump(client, path, ranges, unit_id=None):
+    unit_id = current_unit_id if unit_id is None else unit_id
+    header = {"host": client.comm_params.host, "port": client.comm_params.port, "unit": unit_id, "timestamp": timestamp()}
+    started = time.monotonic()
+    total = valid = 0
+    try:
+        writer = DUMP_WRITERS[dump_format(path)](path, header)
+    except OSError as e:
+        print(Fore.RED + f"Failed to open dump file: {e}" + Style.RESET_ALL)
+        return
+    try:
+        for table, address, count in ranges:
+            step = READ_TABLES[table][1] * max(DUMP_CHUNK_PDUS, pipeline.window if pipeline else 0)
+            for start in range(address, address + count, step):
+                store = read_table(client, table, start, min(step, address + count - start), unit_id)
+                writer.write(store)
+                total += store.count
+                valid += store.valid_count()
+    except KeyboardInterrupt:
+        print(Fore.YELLOW + "\nDump interrupted, file contains the chunks read so far." + Style.RESET_ALL)
+    finally:
+        writer.close()
+    print(Fore.GREEN + f"Dumped {total} values ({valid} read successfully) to {path} in {time.monotonic() - started:.1f}s" + Style.RESET_ALL)
+
+def change_runs(addresses):
+    runs = []
+    for address in addresses:
+        if runs and address == runs[-1][1] + 1:
+            runs[-1][1] = address
+        else:
+            runs.append([address, address])
+    return runs
+
+def diff_stores(before, after):
+    # Changed addresses over the span both stores cover
+    start = max(before.address, after.address)
+    stop = min(before.address + before.count, after.address + after.count)
+    if stop <= start:
+        return []
+    old = before[start - before.address:stop - before.address]
+    new = after[start - after.address:stop - after.address]
+    return [start + offset for offset in old.diff(new)]
+
+def diff_snapshots(path_a, path_b):
+    header_a, tables_a = load_snapshot(path_a)
+    header_b, tables_b = load_snapshot(path_b)
+    if header_a.get("unit") != header_b.get("unit"):
+        logging.warning(f"Comparing different units: {header_a.get('unit')} and {header_b.get('unit')}")
+    results = []
+    for table in READ_TABLES:
+        if table in tables_a and table in tables_b:
+            before, after = tables_a[table], tables_b[table]
+            results.append({"table": table, "before": before, "after": after, "changed": diff_stores(before, after)})
+    return header_a, header_b, results
+
+def snapshot_pairs(path_a, path_b):
+    # Two files, or two directories paired by file name
+    if not (os.path.isdir(path_a) and os.path.isdir(path_b)):
+        return [(path_a, path_b)]
+    names = sorted(set(os.listdir(path_a)) & set(os.listdir(path_b)))
+    return [(os.path.join(path_a, name), os.path.join(path_b, name)) for name in names
+            if os.path.isfile(os.path.join(path_a, name))]
+
+def format_value(value):
+    return "-" if value is None else int(value)
+
+def print_diff(header_a, header_b, results, limit=50):
+    print(Fore.CYAN + f"Unit {header_a.get('unit')}: {header_a.get('timestamp')} -> {header_b.get('timestamp')}" + Style.RESET_ALL)
+    for result in results:
+        table, before, after, changed = result["table"], result["before"], result["after"], result["changed"]
+        if not changed:
+            print(Fore.GREEN + f"{TABLE_TITLES[table]}: no changes" + Style.RESET_ALL)
+            continue
+        runs = change_runs(changed)
+        print(Fore.YELLOW + f"{TABLE_TITLES[table]}: {len(changed)} addresses changed in {len(runs)} runs" + Style.RESET_ALL)
+        rows = []
+        for start, end in runs:
+            for address in range(start, end + 1):
+                if len(rows) >= limit:
+                    break
+                old, new = before[address - before.address], after[address - after.address]
+                delta = new - old if old is not None and new is not None and not before.bits else ""
+                rows.append([f"{start}-{end}" if start != end else start, address, format_value(old), format_value(new), delta])
+        display_table(["Run", "Address", "Before", "After", "Delta"], rows)
+        if len(changed) > len(rows):
+            print(Fore.YELLOW + f"... {len(changed) - len(rows)} more changes not shown" + Style.RESET_ALL)
+
+def diff(path_a, path_b, limit=50):
+    pairs = snapshot_pairs(path_a, path_b)
+    if not pairs:
+        print(Fore.RED + "No snapshots with matching names to compare." + Style.RESET_ALL)
+    for a, b in pairs:
+        try:
+            print_diff(*diff_snapshots(a, b), limit)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            print(Fore.RED + f"Failed to diff {a} and {b}: {e}" + Style.RESET_ALL)
+
+# Passive capture ingestion: Modbus/TCP transactions in a pcap or pcapng file
+# rebuild each unit's tables without sending a single packet. The file is
+# memory-mapped and walked record by record, so its size does not matter.
+PCAP_MAGIC = {b"\xd4\xc3\xb2\xa1": ("<", 1e-6), b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+              b"\x4d\x3c\xb2\xa1": ("<", 1e-9), b"\xa1\xb2\x3c\x4d": (">", 1e-9)}
+PCAPNG_SECTION = 0x0A0D0D0A
+ETHERTYPES_VLAN = (0x8100, 0x88A8, 0x9100)
+IPV6_EXTENSIONS = (0, 43, 60)  # hop-by-hop, routing, destination options
+
+def iter_capture(path):
+    # Yields (timestamp, linktype, mmap, offset, length) for every captured packet
+    import mmap
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return  # empty file
+        try:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            magic = mm[:4]
+            if magic in PCAP_MAGIC:
+                yield from iter_pcap(mm, *PCAP_MAGIC[magic])
+            elif struct.unpack_from("<I", mm)[0] == PCAPNG_SECTION:
+                yield from iter_pcapng(mm)
+            else:
+                raise ValueError(f"{path} is not a pcap or pcapng capture")
+        finally:
+            mm.close()
+
+def iter_pcap(mm, order, resolution):
+    (linktype,) = struct.unpack_from(order + "I", mm, 20)
+    header = struct.Struct(order + "IIII")
+    offset, size = 24, len(mm)
+    while offset + header.size <= size:
+        seconds, fraction, length, _ = header.unpack_from(mm, offset)
+        offset += header.size
+        yield seconds + fraction * resolution, linktype, mm, offset, min(length, size - offset)
+        offset += length
+
+def iter_pcapng(mm):
+    # Section headers set the byte order; interface blocks give the link type
+    # and timestamp resolution of the packet blocks that refer to them
+    offset, size, order, interfaces = 0, len(mm), "<", []
+    while offset + 12 <= size:
+        block_type = struct.unpack_from(order + "I", mm, offset)[0]
+        if block_type == PCAPNG_SECTION:
+            order = "<" if mm[offset + 8:offset + 12] == b"\x4d\x3c\x2b\x1a" else ">"
+            interfaces = []
+        length = struct.unpack_from(order + "I", mm, offset + 4)[0]
+        if length < 12:
+            break
+        body = offset + 8
+        if block_type == 1:
+            linktype = struct.unpack_from(order + "H", mm, body)[0]
+            interfaces.append((linktype, pcapng_resolution(mm, order, body + 8, offset + length - 4)))
+        elif block_type in (6, 2):
+            if block_type == 6:
+                interface, high, low, captured = struct.unpack_from(order + "IIII", mm, body)
+                data = body + 20
+            else:
+                interface, _, high, low, captured = struct.unpack_from(order + "HHIII", mm, body)
+                data = body + 20
+            if interface < len(interfaces):
+                linktype, resolution = interfaces[interface]
+                yield ((high << 32) | low) * resolution, linktype, mm, data, min(captured, size - data)
+        elif block_type == 3 and interfaces:
+            # Simple packet block: interface 0, no timestamp
+            captured = min(struct.unpack_from(order + "I", mm, body)[0], length - 16)
+            yield 0.0, interfaces[0][0], mm, body + 4, min(captured, size - body - 4)
+        offset += length
+
+def pcapng_resolution(mm, order, offset, end):
+    # if_tsresol option: 10^-n seconds, or 2^-n with the top bit set
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(order + "HH", mm, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = mm[offset + 4]
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        offset += 4 + ((length + 3) & ~3)
+    return 1e-6
+
+def ip_offset(linktype, mm, offset, length):
+    # (IP version, offset of the IP header) for the link layers captures use
+    if linktype == 1:  # Ethernet, possibly VLAN tagged
+        ethertype, offset = struct.unpack_from(">H", mm, offset + 12)[0], offset + 14
+        while ethertype in ETHERTYPES_VLAN:
+            ethertype, offset = struct.unpack_from(">H", mm, offset + 2)[0], offset + 4
+        return {0x0800: 4, 0x86DD: 6}.get(ethertype), offset
+    if linktype == 113:  # Linux cooked
+        return {0x0800: 4, 0x86DD: 6}.get(struct.unpack_from(">H", mm, offset + 14)[0]), offset + 16
+    if linktype == 276:  # Linux cooked v2
+        return {0x0800: 4, 0x86DD: 6}.get(struct.unpack_from(">H", mm, offset)[0]), offset + 20
+    if linktype in (0, 108):  # BSD loopback: address family in host or network order
+        family = struct.unpack_from("<I" if linktype == 0 else ">I", mm, offset)[0]
+        if linktype == 0 and family > 0xFFFF:
+            family = struct.unpack_from(">I", mm, offset)[0]
+        return 4 if family == 2 else 6 if family in (10, 24, 28, 30) else None, offset + 4
+    if linktype in (12, 14, 101, 228, 229):  # raw IP
+        return mm[offset] >> 4, offset
+    return None, offset
+
+def tcp_segment(linktype, mm, offset, length):
+    # (src, sport, dst, dport, seq, flags, payload offset, payload length) or None
+    end = offset + length
+    try:
+        version, ip = ip_offset(linktype, mm, offset, length)
+        if version == 4:
+            ihl = (mm[ip] & 0x0F) * 4
+            total, fragment, protocol = struct.unpack_from(">H2xH1xB", mm, ip + 2)
+            if protocol != 6 or fragment & 0x3FFF:
+                return None
+            src, dst = mm[ip + 12:ip + 16], mm[ip + 16:ip + 20]
+            tcp, end = ip + ihl, min(end, ip + total)
+        elif version == 6:
+            payload_length, protocol = struct.unpack_from(">HB", mm, ip + 4)
+            src, dst = mm[ip + 8:ip + 24], mm[ip + 24:ip + 40]
+            tcp, end = ip + 40, min(end, ip + 40 + payload_length)
+            while protocol in IPV6_EXTENSIONS:
+                protocol, size = mm[tcp], (mm[tcp + 1] + 1) * 8
+                tcp += size
+            if protocol != 6:
+                return None
+        else:
+            return None
+        sport, dport, seq, data_offset, flags = struct.unpack_from(">HHI4xBB", mm, tcp)
+    except (struct.error, IndexError):
+        return None
+    payload = tcp + (data_offset >> 4) * 4
+    return src, sport, dst, dport, seq, flags, payload, max(0, end - payload)
+
+def address_text(raw):
+    return socket.inet_ntop(socket.AF_INET if len(raw) == 4 else socket.AF_INET6, raw)
+
+class CaptureStream:
+    # One direction of a TCP connection, reassembled in sequence order. Lost or
+    # truncated segments drop what is buffered and resync at the next segment.
+    def __init__(self):
+        self.next_seq = None
+        self.buffer = bytearray()
+
+    def add(self, seq, payload):
+        # Returns False when data was missing
+        if self.next_seq is not None:
+            delta = (seq - self.next_seq) & 0xFFFFFFFF
+            if delta >= 0x80000000:  # retransmission, keep only new bytes
+                payload = payload[0x100000000 - delta:]
+                if not payload:
+                    return True
+                seq = self.next_seq
+            elif delta:
+                self.buffer.clear()
+                self.next_seq = (seq + len(payload)) & 0xFFFFFFFF
+                self.buffer += payload
+                return False
+        self.next_seq = (seq + len(payload)) & 0xFFFFFFFF
+        self.buffer += payload
+        return True
+
+    def frames(self):
+        # Yields (transaction_id, unit, pdu); a header that cannot be MBAP resyncs
+        buffer = self.buffer
+        while len(buffer) >= MBAP_HEADER.size:
+            tid, protocol, length, unit = MBAP_HEADER.unpack_from(buffer)
+            if protocol != 0 or not 2 <= length <= 254:
+                buffer.clear()
+                return
+            end = 6 + length
+            if len(buffer) < end:
+                return
+            pdu = bytes(buffer[MBAP_HEADER.size:end])
+            del buffer[:end]
+            yield tid, unit, pdu
+
+class CaptureState:
+    # Tables of every (server, port, unit) seen in a capture, filled from the
+    # responses to reads and from acknowledged writes
+    def __init__(self, port=502):
+        self.port = port
+        self.streams = {}
+        self.pending = {}  # connection -> {transaction id: (unit, request pdu)}
+        self.units = {}    # (server, port, unit) -> {table: RegisterStore}
+        self.seen = {}     # (server, port, unit) -> (first, last) capture time
+        self.changed = set()
+        self.counts = {"packets": 0, "segments": 0, "requests": 0, "responses": 0, "matched": 0,
+                       "exceptions": 0, "malformed": 0, "gaps": 0}
+
+    def packet(self, timestamp, linktype, mm, offset, length):
+        self.counts["packets"] += 1
+        segment = tcp_segment(linktype, mm, offset, length)
+        if segment is None:
+            return
+        src, sport, dst, dport, seq, flags, payload, size = segment
+        if dport == self.port:
+            client, server, to_server = (src, sport), (dst, dport), True
+        elif sport == self.port:
+            client, server, to_server = (dst, dport), (src, sport), False
+        else:
+            return
+        connection = (client, server)
+        key = (connection, to_server)
+        if flags & 0x02:  # SYN: a new connection may reuse the ports
+            self.streams.pop(key, None)
+            if to_server:
+                self.pending.pop(connection, None)
+            return
+        if size:
+            self.segment(connection, key, to_server, seq, mm[payload:payload + size], timestamp)
+        if flags & 0x05:  # FIN or RST: the connection's state goes with it
+            self.streams.pop(key, None)
+            if not to_server or flags & 0x04:
+                self.pending.pop(connection, None)
+
+    def segment(self, connection, key, to_server, seq, payload, timestamp):
+        self.counts["segments"] += 1
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = CaptureStream()
+        if not stream.add(seq, payload):
+            self.counts["gaps"] += 1
+        pending = self.pending.setdefault(connection, {})
+        for tid, unit, pdu in stream.frames():
+            if to_server:
+                self.counts["requests"] += 1
+                pending[tid] = (unit, pdu)
+                continue
+            self.counts["responses"] += 1
+            request = pending.pop(tid, None)
+            if request is not None and request[0] == unit and pdu and request[1][0] == pdu[0] & 0x7F:
+                self.counts["matched"] += 1
+                server = connection[1]
+                self.apply((address_text(server[0]), server[1], unit), request[1], pdu, timestamp)
+
+    def tables(self, key):
+        tables = self.units.get(key)
+        if tables is None:
+            tables = self.units[key] = {}
+        return tables
+
+    def store(self, key, table):
+        tables = self.tables(key)
+        if table not in tables:
+            tables[table] = RegisterStore(table, 0, ADDRESS_SPACE)
+        return tables[table]
+
+    def apply(self, key, request, response, timestamp):
+        first = self.seen.get(key, (timestamp, timestamp))[0]
+        self.seen[key] = (first, timestamp)
+        self.tables(key)
+        fc = request[0]
+        if response[0] & 0x80:
+            self.counts["exceptions"] += 1
+            return
+        try:
+            if fc in TABLES_BY_CODE:
+                address, count = struct.unpack_from(">HH", request, 1)
+                data = read_response_payload(fc, response, count)
+                self.store(key, TABLES_BY_CODE[fc]).set_payload(address, data, min(count, ADDRESS_SPACE - address))
+            elif fc in (5, 6):
+                address, value = struct.unpack_from(">HH", request, 1)
+                if fc == 5:
+                    self.store(key, "coils").set_values(address, [value == 0xFF00])
+                else:
+                    self.store(key, "holding_registers").set_payload(address, request[3:5], 1)
+            elif fc in (15, 16):
+                address, count, size = struct.unpack_from(">HHB", request, 1)
+                count = min(count, ADDRESS_SPACE - address)
+                table = "coils" if fc == 15 else "holding_registers"
+                self.store(key, table).set_payload(address, request[6:6 + size], count)
+            elif fc == 23:
+                # Read/write multiple registers: the write happens before the read
+                read_address, read_count, write_address, write_count, size = struct.unpack_from(">HHHHB", request, 1)
+                store = self.store(key, "holding_registers")
+                store.set_payload(write_address, request[10:10 + size], min(write_count, ADDRESS_SPACE - write_address))
+                store.set_payload(read_address, read_response_payload(fc, response, read_count), min(read_count, ADDRESS_SPACE - read_address))
+            else:
+                return
+        except (struct.error, ModbusException):
+            self.counts["malformed"] += 1
+            return
+        self.changed.add(key)
+
+def valid_runs(store):
+    # (offset, count) of every run of valid addresses
+    runs, mask, position = [], store.valid_mask(), 0
+    while mask:
+        skip = (mask & -mask).bit_length() - 1
+        mask >>= skip
+        length = (~mask & (mask + 1)).bit_length() - 1
+        runs.append((position + skip, length))
+        mask >>= length
+        position += skip + length
+    return runs
+
+def capture_snapshot_path(directory, key, suffix=""):
+    host, port, unit = key
+    return os.path.join(directory, f"{host.replace(':', '-')}_{port}_unit{unit}{suffix}.snap")
+
+def write_capture_snapshot(path, key, tables, source, captured):
+    header = {"host": key[0], "port": key[1], "unit": key[2], "timestamp": captured, "source": source}
+    writer = SnapshotWriter(path, header)
+    try:
+        for table in READ_TABLES:
+            if table in tables:
+                for offset, count in valid_runs(tables[table]):
+                    writer.write(tables[table].view(offset, count))
+    finally:
+        writer.close()
+
+def capture_time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(timestamp))
+
+def ingest_capture(path, directory, interval=None, port=502):
+    # Streams the capture into per-unit snapshots in `directory`: the final
+    # state as <host>_<port>_unit<id>.snap and, every `interval` seconds of
+    # capture time, the units that changed as <host>_<port>_unit<id>_<time>.snap
+    state = CaptureState(port)
+    os.makedirs(directory, exist_ok=True)
+    written = []
+    next_cut = None
+    for timestamp, linktype, mm, offset, length in iter_capture(path):
+        if interval and timestamp:
+            if next_cut is None:
+                next_cut = timestamp + interval
+            elif timestamp >= next_cut:
+                suffix = "_" + time.strftime("%Y%m%dT%H%M%S", time.localtime(next_cut))
+                for key in sorted(state.changed):
+                    written.append(capture_snapshot_path(directory, key, suffix))
+                    write_capture_snapshot(written[-1], key, state.units[key], path, capture_time(next_cut))
+                state.changed.clear()
+                next_cut += interval * ((timestamp - next_cut) // interval + 1)
+        state.packet(timestamp, linktype, mm, offset, length)
+    for key, tables in sorted(state.units.items()):
+        written.append(capture_snapshot_path(directory, key))
+        write_capture_snapshot(written[-1], key, tables, path, capture_time(state.seen[key][1]))
+    return state, written
+
+def capture_banner(tables):
+    # The grab_banner views of a unit rebuilt from a capture
+    def view(table, count):
+        store = tables.get(table)
+        return store.view(0, count) if store is not None else RegisterStore(table, 0, count)
+    messages = view("holding_registers", 64)
+    return view("coils", 10), view("discrete_inputs", 10), messages[:10], view("input_registers", 10), messages
+
+# Reconnect backoff for pooled connections: doubles per failure up to the maximum
+RECONNECT_BACKOFF = 1.0
+RECONNECT_BACKOFF_MAX = 60.0
+
+class Target:
+    def __init__(self, name, host, port=502, unit_id=1, groups=()):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.groups = list(groups)
+
+class PooledConnection:
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.monotonic()
+        self.failures = 0
+        self.retry_at = 0.0
+
+class SessionManager:
+    # Named targets sharing a pool of ModbusTcpClient connections keyed by
+    # (host, port). Only hosts on the allow-list are ever connected to.
+    def __init__(self, allow=(), idle_timeout=300.0, timeout=3.0):
+        self.allow_networks = []
+        self.allow_hosts = set()
+        for entry in allow:
+            self.add_allowed(entry)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.targets = {}
+        self.pool = {}
+        self.last_error = None
+
+    def add_allowed(self, entry):
+        try:
+            self.allow_networks.append(ipaddress.ip_network(entry, strict=False))
+        except ValueError:
+            self.allow_hosts.add(entry.lower())
+
+    def is_allowed(self, host):
+        if host.lower() in self.allow_hosts:
+            return True
+        try:
+            address = ipaddress.ip_address(socket.gethostbyname(host))
+        except (OSError, ValueError):
+            return False
+        return any(address in network for network in self.allow_networks)
+
+    def add_target(self, target):
+        if not self.is_allowed(target.host):
+            raise ValueError(f"{target.host} is not in the allow-list")
+        self.targets[target.name] = target
+
+    def resolve(self, name):
+        # A target name, a group name, or 'all'
+        if name in self.targets:
+            return [self.targets[name]]
+        members = [target for target in self.targets.values() if name == "all" or name in target.groups]
+        if not members:
+            raise ValueError(f"unknown target or group '{name}'")
+        return members
+
+    def evict_idle(self, now):
+        for key, entry in list(self.pool.items()):
+            if now - entry.last_used > self.idle_timeout:
+                entry.client.close()
+                del self.pool[key]
+
+    def client(self, target):
+        # Connected client for the target, or None while it is unreachable or
+        # backing off (with the reason in last_error)
+        self.last_error = None
+        if not self.is_allowed(target.host):
+            self.last_error = f"Refusing to connect to {target.host}: not in the allow-list"
+            logging.error(self.last_error)
+            return None
+        now = time.monotonic()
+        self.evict_idle(now)
+        key = (target.host, target.port)
+        if key not in self.pool:
+            self.pool[key] = PooledConnection(modbus_client(target.host, target.port, self.timeout))
+        entry = self.pool[key]
+        if not entry.client.connected:
+            if now < entry.retry_at:
+                self.last_error = f"Not reconnecting to {target.host}:{target.port} for another {entry.retry_at - now:.1f}s"
+                logging.error(self.last_error)
+                return None
+            if not entry.client.connect():
+                metrics.connected("client", client_device(entry.client), False)
+                entry.failures += 1
+                entry.retry_at = now + min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF * 2 ** (entry.failures - 1))
+                self.last_error = f"Failed to connect to {target.host}:{target.port} (attempt {entry.failures})"
+                logging.error(self.last_error)
+                return None
+            metrics.connected("client", client_device(entry.client), True)
+            entry.failures = 0
+        entry.last_used = now
+        return entry.client
+
+    def state(self, target):
+        entry = self.pool.get((target.host, target.port))
+        if entry is None:
+            return "idle"
+        if entry.client.connected:
+            return "connected"
+        return f"failed x{entry.failures}" if entry.failures else "closed"
+
+    def close(self):
+        for entry in self.pool.values():
+            entry.client.close()
+        self.pool.clear()
+
+def parse_host_port(value, default_port=502):
+    host, _, port = value.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return value, default_port
+
+def load_targets(path, sessions):
+    # 'allow <host|network>' lines extend the allow-list;
+    # '<name> <host[:port]> [unit_id] [group,...]' lines define targets
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            try:
+                if fields[0] == "allow":
+                    for entry in fields[1:]:
+                        sessions.add_allowed(entry)
+                elif 2 <= len(fields) <= 4:
+                    host, port = parse_host_port(fields[1])
+                    unit_id = int(fields[2]) if len(fields) > 2 else 1
+                    groups = fields[3].split(",") if len(fields) > 3 else ()
+                    sessions.add_target(Target(fields[0], host, port, unit_id, groups))
+                else:
+                    raise ValueError("expected '<name> <host[:port]> [unit_id] [group,...]'")
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: {e}")
+
+def command_targets(client, options, args):
+    sessions = options.sessions
+    return [{"name": target.name, "host": target.host, "port": target.port, "unit": target.unit_id,
+             "groups": target.groups, "state": sessions.state(target)} for target in sessions.targets.values()]
+
+def render_targets(targets):
+    if not targets:
+        print(Fore.YELLOW + "No targets configured." + Style.RESET_ALL)
+        return
+    display_table(["Name", "Host", "Port", "Unit", "Groups", "State"],
+                  [[t["name"], t["host"], t["port"], t["unit"], ",".join(t["groups"]), t["state"]] for t in targets])
+
+def command_add_target(client, options, args):
+    host, port = parse_host_port(args[1])
+    unit_id = int(args[2]) if len(args) > 2 else 1
+    groups = args[3].split(",") if len(args) > 3 else ()
+    try:
+        options.sessions.add_target(Target(args[0], host, port, unit_id, groups))
+    except ValueError as e:
+        print(Fore.RED + f"Cannot add target: {e}" + Style.RESET_ALL)
+        return False
+    print(Fore.GREEN + f"Target {args[0]} -> {host}:{port} unit {unit_id}" + Style.RESET_ALL)
+
+def run_on_targets(options, name, line, output):
+    # Runs one command against every target named by `name`, each with its own
+    # connection and unit ID (set_unit_id inside 'on' updates the target)
+    global current_unit_id, pipeline
+    words = line.split()
+    if not words or words[0].lower() in ("on", "exit"):
+        print(Fore.RED + "Usage: on <target|group|all> <command> [args...]" + Style.RESET_ALL)
+        return False
+    try:
+        targets = options.sessions.resolve(name)
+    except ValueError as e:
+        print(Fore.RED + f"{e}" + Style.RESET_ALL)
+        return False
+
+    ok = True
+    saved = current_unit_id, pipeline
+    for target in targets:
+        if output != "json":
+            print(Fore.CYAN + f"== {target.name} ({target.host}:{target.port}, unit {target.unit_id}) ==" + Style.RESET_ALL)
+        client = options.sessions.client(target)
+        if client is None:
+            if output == "json":
+                print(json.dumps({"command": words[0].lower(), "args": words[1:], "ok": False, "result": None, "messages": [],
+                                  "target": target.name, "error": options.sessions.last_error}), flush=True)
+            ok = False
+            continue
+        target_options = copy.copy(options)
+        target_options.ip, target_options.port = target.host, target.port
+        current_unit_id, pipeline = target.unit_id, None
+        try:
+            ok = run_command(client, target_options, line, output, target.name) and ok
+        finally:
+            target.unit_id = current_unit_id
+            current_unit_id, pipeline = saved
+    return ok
+
+def parse_range(address, count=1):
+    # Address and count arguments, checked against the address space before
+    # anything reaches the client
+    address, count = int(address), int(count)
+    if not 0 <= address < ADDRESS_SPACE:
+        raise ValueError(f"address must be 0-{ADDRESS_SPACE - 1}")
+    if not 1 <= count <= ADDRESS_SPACE - address:
+        raise ValueError(f"count must be 1-{ADDRESS_SPACE - address} at address {address}")
+    return address, count
+
+def parse_register_value(text):
+    value = int(text)
+    if not 0 <= value <= 0xFFFF:
+        raise ValueError("register values must be 0-65535")
+    return value
+
+def command_read(table, address=None, count=None):
+    # Handler for read_* (address and count from the arguments) and display_all_* (fixed range)
+    def handler(client, options, args):
+        if address is None:
+            return read_table(client, table, *parse_range(args[0], args[1]))
+        return read_table(client, table, address, count)
+    return handler
+
+def command_write_coil(client, options, args):
+    return write_coil(client, parse_range(args[0])[0], bool(int(args[1])))
+
+def command_write_register(client, options, args):
+    return write_register(client, parse_range(args[0])[0], parse_register_value(args[1]))
+
+def command_write_multiple_coils(client, options, args):
+    address = parse_range(args[0], len(args) - 1)[0]
+    return write_multiple_coils(client, address, [bool(int(v)) for v in args[1:]])
+
+def command_write_multiple_registers(client, options, args):
+    address = parse_range(args[0], len(args) - 1)[0]
+    return write_multiple_registers(client, address, [parse_register_value(v) for v in args[1:]])
+
+def command_chaos_mode(client, options, args):
+    if not write_guard.capture(client, "coils", [(0, 100)], current_unit_id):
+        return False
+    for i in range(100):
+        value = not bool(i % 2)
+        write_coil(client, i, value, verify="off")
+        time.sleep(0.1)
+    logging.info("Chaos mode activated: Alternated coil values.")
+    return read_coils(client, 0, 100)
+
+def command_hex_modify(client, options, args):
+    return hex_modify(client, parse_range(args[0])[0], args[1])
+
+def command_hex_randomize(client, options, args):
+    count = parse_range(0, args[0])[1]
+    if not hex_randomize(client, count):
+        return False
+    if not write_guard.dry_run:
+        print(Fore.GREEN + f"Randomized {count} registers." + Style.RESET_ALL)
+    return read_holding_registers(client, 0, count)
+
+def command_text_edit(client, options, args):
+    return text_edit(client, ' '.join(args))
+
+def optional_float(args, default, name):
+    if args:
+        try:
+            return float(args[0])
+        except ValueError:
+            print(Fore.RED + f"Invalid {name} value. Using default {name} {default}s." + Style.RESET_ALL)
+    return default
+
+def command_guard(client, options, args):
+    if args:
+        if args[0] not in ("on", "off"):
+            raise ValueError("expected 'on' or 'off'")
+        write_guard.enabled = args[0] == "on"
+        print(Fore.GREEN + f"Capturing original values before writes: {args[0]}" + Style.RESET_ALL)
+    return write_guard.status()
+
+def render_guard(status):
+    allowed = ", ".join(f"{table}:{start}-{end}" for table, ranges in status["allowed"].items() for start, end in ranges)
+    print(Fore.CYAN + f"Capture: {'on' if status['capture'] else 'off'}, dry run: {'on' if status['dry_run'] else 'off'}, "
+          f"journal: {status['journal'] or 'none'}, allowed writes: {allowed or 'anywhere'}" + Style.RESET_ALL)
+    if status["captured"]:
+        display_table(["Device", "Unit", "Table", "Originals"],
+                      [[entry["device"], entry["unit"], TABLE_TITLES[entry["table"]], entry["addresses"]] for entry in status["captured"]])
+
+def command_dump(client, options, args):
+    dump(client, args[0], parse_dump_ranges(args[1:]))
+
+def command_diff(client, options, args):
+    diff(args[0], args[1], int(args[2]) if len(args) == 3 else 50)
+
+def write_metrics(path):
+    try:
+        with open(path, "w") as f:
+            f.write(metrics.prometheus())
+    except OSError as e:
+        print(Fore.RED + f"Failed to write metrics: {e}" + Style.RESET_ALL)
+        return False
+    print(Fore.GREEN + f"Metrics written to {path}" + Style.RESET_ALL)
+    return True
+
+def command_stats(client, options, args):
+    if not args:
+        return metrics.summary()
+    if args == ["reset"]:
+        metrics.reset()
+        print(Fore.GREEN + "Statistics reset." + Style.RESET_ALL)
+        return True
+    if args[0] == "export" and len(args) == 2:
+        return write_metrics(args[1])
+    raise ValueError("expected 'reset' or 'export <file>'")
+
+def render_stats(summary):
+    rows = summary["transactions"]
+    if not rows:
+        print(Fore.YELLOW + "No requests recorded yet." + Style.RESET_ALL)
+    else:
+        display_table(["Device", "Unit", "Function", "Requests", "Errors", "Timeouts", "Retries", "Bytes out", "Bytes in", "Mean ms", "p50 ms", "p99 ms"],
+                      [["-" if value is None else value for value in (row["device"], row["unit"], row["function"], row["requests"], row["errors"], row["timeouts"], row["retries"],
+                        row["bytes_sent"], row["bytes_received"], row["mean_ms"],
+                        row["p50_ms"] and f"<={row['p50_ms']:g}", row["p99_ms"] and f"<={row['p99_ms']:g}")]
+                       for row in rows])
+        for row in rows:
+            if row["exceptions"]:
+                codes = ", ".join(f"{name} x{count}" for name, count in row["exceptions"].items())
+                unit = "(no answer)" if row["unit"] is None else row["unit"]
+                print(Fore.YELLOW + f"{row['device']} unit {unit} {row['function']}: {codes}" + Style.RESET_ALL)
+    for device, estimate in summary["timeouts"].items():
+        print(Fore.CYAN + f"{device}: timeout {estimate['timeout_ms']:g} ms (smoothed RTT {estimate['srtt_ms']:g} ms, deviation {estimate['rttvar_ms']:g} ms)" + Style.RESET_ALL)
+    print(Fore.CYAN + f"Reconnects: {summary['reconnects']}, failed connection attempts: {summary['connect_failures']}" + Style.RESET_ALL)
+
+def command_trace(client, options, args):
+    if args[0] == "off":
+        metrics.close_trace()
+        print(Fore.GREEN + "Tracing stopped." + Style.RESET_ALL)
+        return True
+    try:
+        metrics.open_trace(args[0])
+    except OSError as e:
+        print(Fore.RED + f"Failed to open trace file: {e}" + Style.RESET_ALL)
+        return False
+    print(Fore.GREEN + f"Tracing every request to {args[0]}" + Style.RESET_ALL)
+    return True
+
+def command_discover(client, options, args):
+    unit_id = int(args[0]) if args else None
+    step = int(args[1]) if len(args) > 1 else None
+    if step is not None and step < 1:
+        raise ValueError("step must be positive")
+    return discover(client, unit_id, step, options.concurrency, options.timeout)
+
+def describe_ranges(ranges):
+    if ranges is None:
+        return "Unsupported"
+    if not ranges:
+        return "No readable addresses"
+    return ", ".join(f"{start}" if count == 1 else f"{start}-{start + count - 1}" for start, count in ranges)
+
+def render_capabilities(tables):
+    display_table(["Table", "Function", "Addresses", "Count"],
+                  [[TABLE_TITLES[table], READ_TABLES[table][0], describe_ranges(ranges), sum(count for _, count in ranges or [])]
+                   for table, ranges in tables.items()])
+
+def command_capabilities(client, options, args):
+    if args == ["clear"]:
+        capabilities.clear()
+        if capabilities_path:
+            save_capabilities(capabilities_path)
+        print(Fore.GREEN + "Capability maps cleared." + Style.RESET_ALL)
+        return True
+    if args:
+        raise ValueError("expected no argument or 'clear'")
+    return {key: {table: describe_ranges(ranges) for table, ranges in tables.items()} for key, tables in capabilities.items()}
+
+def render_capability_maps(maps):
+    if not maps:
+        print(Fore.YELLOW + "No capability maps; run 'discover' first." + Style.RESET_ALL)
+        return
+    display_table(["Device/Unit"] + [TABLE_TITLES[table] for table in READ_TABLES],
+                  [[key] + [tables.get(table, "Not discovered") for table in READ_TABLES] for key, tables in maps.items()])
+
+def command_tags(client, options, args):
+    try:
+        tags = set_tag_map(args[0])
+    except OSError as e:
+        print(Fore.RED + f"Failed to load tag map: {e}" + Style.RESET_ALL)
+        return False
+    print(Fore.GREEN + f"Loaded {len(tags.tags)} tags in {len(tags.blocks)} read blocks." + Style.RESET_ALL)
+    return True
+
+def tag_row(tag, value):
+    return {"name": tag.name, "table": tag.table, "address": tag.address, "type": tag.data_type, "value": value, "units": tag.units}
+
+def command_read_tags(client, options, args):
+    if tag_map is None:
+        print(Fore.RED + "No tag map loaded; use 'tags <file>' or --tags." + Style.RESET_ALL)
+        return False
+    unknown = set(args) - {tag.name for tag in tag_map.tags}
+    if unknown:
+        raise ValueError(f"unknown tag {', '.join(sorted(unknown))}")
+    return [tag_row(tag, value) for tag, value in tag_map.read(client) if not args or tag.name in args]
+
+def format_tag_value(value):
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    return format_cell(value)
+
+def render_tags(rows):
+    display_table(["Name", "Table", "Address", "Type", "Value", "Units"],
+                  [[row["name"], TABLE_TITLES[row["table"]], row["address"], row["type"], format_tag_value(row["value"]), row["units"]] for row in rows])
+
+def watch_tags(client, interval=1.0, max_rate=0, max_unit_rate=0):
+    # Prints each tag when its decoded value changes; only blocks with changed
+    # registers are decoded again
+    if tag_map is None:
+        print(Fore.RED + "No tag map loaded; use 'tags <file>' or --tags." + Style.RESET_ALL)
+        return False
+    scheduler = PollScheduler(max_rate, max_unit_rate)
+    watched = {}
+    for block in tag_map.blocks:
+        watched[id(scheduler.add(current_unit_id, block.table, block.address, block.count, interval))] = block
+    last = {}
+    print(Fore.CYAN + "Watching tags (Ctrl+C to stop)" + Style.RESET_ALL)
+    try:
+        while True:
+            changed = {}
+            for snapshot_block, _, _ in scheduler.poll(client):
+                if id(snapshot_block) in watched:
+                    changed[id(snapshot_block)] = snapshot_block
+            now = time.strftime('%H:%M:%S')
+            for key, snapshot_block in changed.items():
+                for tag, value in tag_map.decode(watched[key], snapshot_block.values):
+                    if tag.name not in last or last[tag.name] != value:
+                        last[tag.name] = value
+                        print(f"{now} {tag.name} = {format_tag_value(value)} {tag.units}".rstrip(), flush=True)
+            time.sleep(max(0, scheduler.next_due() - time.monotonic()))
+    except KeyboardInterrupt:
+        print(Fore.CYAN + "\nWatching stopped." + Style.RESET_ALL)
+    return True
+
+# Recorder: every sample of every numeric tag goes into a fixed-size ring, so
+# memory stays flat however long it runs. With a file, the samples are also
+# appended as column segments (a row count, the time column, then one column
+# per point, big-endian doubles) every RECORD_FLUSH seconds.
+RECORD_DEPTH = 3600
+RECORD_FLUSH = 30.0
+RECORDING_MAGIC = b"SBREC\x00\x00\x01"
+RECORDING_SEGMENT = struct.Struct(">I")
+NAN = float("nan")
+
+def column_bytes(column):
+    if sys.byteorder == "little":
+        column = array("d", column)
+        column.byteswap()
+    return column.tobytes()
+
+def column_from_bytes(data):
+    column = array("d", data)
+    if sys.byteorder == "little":
+        column.byteswap()
+    return column
+
+class Recorder:
+    # All points share one time column; slot total % depth takes the next row
+    def __init__(self, names, depth=RECORD_DEPTH):
+        self.names = list(names)
+        self.depth = max(1, depth)
+        self.times = array("d", bytes(8 * self.depth))
+        self.columns = {name: array("d", bytes(8 * self.depth)) for name in self.names}
+        self.changed_at = dict.fromkeys(self.names)
+        self.total = 0
+        self.file = None
+        self.flushed = 0
+        self.flushed_at = 0.0
+
+    def append(self, when, row):
+        # row maps every point to a float, NaN when it could not be read
+        slot, previous = self.total % self.depth, (self.total - 1) % self.depth
+        self.times[slot] = when
+        for name, column in self.columns.items():
+            value = row[name]
+            if self.total and value != column[previous] and (value == value or column[previous] == column[previous]):
+                self.changed_at[name] = when
+            column[slot] = value
+        self.total += 1
+        if self.file is not None and (self.total - self.flushed >= self.depth or when - self.flushed_at >= RECORD_FLUSH):
+            self.flush(when)
+
+    def latest(self, column, count):
+        # The last `count` retained entries of a column, oldest first
+        end = self.total % self.depth if self.total >= self.depth else self.total
+        if count <= end:
+            return column[end - count:end]
+        return column[self.depth - (count - end):] + column[:end]
+
+    def window(self, seconds=None):
+        # (times, {name: values}) for the retained rows, limited to the last `seconds`
+        count = min(self.total, self.depth)
+        times = self.latest(self.times, count)
+        if seconds is not None and count:
+            count -= bisect_left(times, times[-1] - seconds)
+            times = times[len(times) - count:]
+        return times, {name: self.latest(column, count) for name, column in self.columns.items()}
+
+    def open(self, path, header):
+        # Appends to an existing recording of the same points
+        if os.path.exists(path) and os.path.getsize(path):
+            existing = read_recording_header(path)[0]
+            if existing["points"] != self.names:
+                raise ValueError(f"{path} records different points ({', '.join(existing['points'])})")
+            self.file = open(path, "ab")
+        else:
+            self.file = open(path, "wb")
+            meta = json.dumps(dict(header, points=self.names)).encode()
+            self.file.write(RECORDING_MAGIC + struct.pack(">I", len(meta)) + meta)
+        self.flushed = self.total
+        self.flushed_at = time.time()
+
+    def flush(self, when=None):
+        pending = self.total - self.flushed
+        if pending:
+            parts = [RECORDING_SEGMENT.pack(pending), column_bytes(self.latest(self.times, pending))]
+            parts.extend(column_bytes(self.latest(self.columns[name], pending)) for name in self.names)
+            self.file.write(b"".join(parts))
+            self.file.flush()
+        self.flushed = self.total
+        self.flushed_at = time.time() if when is None else when
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+def read_recording_header(f):
+    # Returns (header, offset of the first segment) for a path or open file
+    if isinstance(f, str):
+        with open(f, "rb") as f:
+            return read_recording_header(f)
+    if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+        raise ValueError("not a sploitbus recording")
+    size = struct.unpack(">I", f.read(4))[0]
+    return json.loads(f.read(size)), len(RECORDING_MAGIC) + 4 + size
+
+def load_recording(path, depth=RECORD_DEPTH):
+    # Rebuilds the rings from the last `depth` rows of a recording, reading
+    # only the segments that hold them
+    with open(path, "rb") as f:
+        header, offset = read_recording_header(f)
+        width = 8 * (len(header["points"]) + 1)
+        segments, size = [], os.fstat(f.fileno()).st_size
+        while offset + RECORDING_SEGMENT.size <= size:
+            f.seek(offset)
+            rows = RECORDING_SEGMENT.unpack(f.read(RECORDING_SEGMENT.size))[0]
+            if offset + RECORDING_SEGMENT.size + rows * width > size:
+                break  # cut short by a crash before the flush finished
+            segments.append((offset + RECORDING_SEGMENT.size, rows))
+            offset += RECORDING_SEGMENT.size + rows * width
+        recorder = Recorder(header["points"], depth)
+        wanted, start = recorder.depth, len(segments)
+        while start and wanted > 0:
+            start -= 1
+            wanted -= segments[start][1]
+        columns = [array("d") for _ in range(len(header["points"]) + 1)]
+        for offset, rows in segments[start:]:
+            f.seek(offset)
+            for column in columns:
+                column.extend(column_from_bytes(f.read(8 * rows)))
+    count = min(len(columns[0]), recorder.depth)
+    recorder.times[:count] = columns[0][len(columns[0]) - count:]
+    for name, column in zip(recorder.names, columns[1:]):
+        values = column[len(column) - count:]
+        recorder.columns[name][:count] = values
+        for index in range(count - 1, 0, -1):
+            if values[index] != values[index - 1] and (values[index] == values[index] or values[index - 1] == values[index - 1]):
+                recorder.changed_at[name] = recorder.times[index]
+                break
+    recorder.total = recorder.flushed = count
+    return header, recorder
+
+recorder = None
+
+def record(client, options, args):
+    # Polls the tag map like watch_tags, but keeps every sample of every numeric tag
+    global recorder
+    interval = optional_float(args, 1.0, "interval")
+    path = args[1] if len(args) > 1 else options.recording
+    if tag_map is None:
+        print(Fore.RED + "No tag map loaded; use 'tags <file>' or --tags." + Style.RESET_ALL)
+        return False
+    names = [tag.name for tag in tag_map.tags if tag.data_type != "string"]
+    if not names:
+        print(Fore.RED + "The tag map has no numeric tags to record." + Style.RESET_ALL)
+        return False
+    if recorder is None or recorder.names != names:
+        recorder = Recorder(names, options.record_depth)
+    if path:
+        header = {"host": options.ip, "port": options.port, "unit": current_unit_id, "interval": interval, "timestamp": timestamp()}
+        try:
+            recorder.open(path, header)
+        except (OSError, ValueError, struct.error) as e:
+            print(Fore.RED + f"Failed to open recording: {e}" + Style.RESET_ALL)
+            return False
+    scheduler = PollScheduler(options.max_rate, options.max_unit_rate)
+    watched = {}
+    for block in tag_map.blocks:
+        watched[id(scheduler.add(current_unit_id, block.table, block.address, block.count, interval))] = block
+    row = dict.fromkeys(names, NAN)
+    started = recorder.total
+    print(Fore.CYAN + f"Recording {len(names)} tags every {interval}s, keeping the last {recorder.depth} samples of each"
+          + (f" and appending to {path}" if path else "") + " (Ctrl+C to stop)" + Style.RESET_ALL)
+    try:
+        while True:
+            changed = {}
+            for snapshot_block, _, _ in scheduler.poll(client):
+                if id(snapshot_block) in watched:
+                    changed[id(snapshot_block)] = snapshot_block
+            for key, snapshot_block in changed.items():
+                for tag, value in tag_map.decode(watched[key], snapshot_block.values):
+                    if tag.name in row:
+                        row[tag.name] = NAN if value is None else float(value)
+            recorder.append(time.time(), row)
+            sys.stdout.write(f"\r{time.strftime('%H:%M:%S')} {recorder.total - started} samples")
+            sys.stdout.flush()
+            time.sleep(max(0, scheduler.next_due() - time.monotonic()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+    print(Fore.CYAN + f"\nRecording stopped after {recorder.total - started} samples; use 'history' to query them." + Style.RESET_ALL)
+    return True
+
+def command_history(client, options, args):
+    # history [seconds] [name...]: last, min, max and last change per point
+    if recorder is None or not recorder.total:
+        print(Fore.RED + "Nothing recorded; run 'record' or load a recording with --recording." + Style.RESET_ALL)
+        return False
+    seconds = None
+    if args and re.fullmatch(r"[0-9.]+", args[0]):
+        seconds, args = float(args[0]), args[1:]
+    unknown = [name for name in args if name not in recorder.columns]
+    if unknown:
+        raise ValueError(f"not recorded: {', '.join(unknown)}")
+    units = {tag.name: tag.units for tag in tag_map.tags} if tag_map is not None else {}
+    times, columns = recorder.window(seconds)
+    rows = []
+    for name in args or recorder.names:
+        valid = [value for value in columns[name] if value == value]
+        last = columns[name][-1] if len(times) else NAN
+        changed = recorder.changed_at[name]
+        rows.append({"name": name, "samples": len(valid), "last": None if last != last else last,
+                     "min": min(valid) if valid else None, "max": max(valid) if valid else None,
+                     "last_change": capture_time(changed) if changed is not None else None, "units": units.get(name, "")})
+    return rows
+
+def render_history(rows):
+    display_table(["Name", "Samples", "Last", "Min", "Max", "Last change", "Units"],
+                  [[row["name"], row["samples"], format_tag_value(row["last"]), format_tag_value(row["min"]),
+                    format_tag_value(row["max"]), row["last_change"] or "-", row["units"]] for row in rows])
+
+def command_pcap(client, options, args):
+    # Interval snapshots are named to the second
+    interval = int(args[2]) if len(args) > 2 and int(args[2]) > 0 else None
+    port = int(args[3]) if len(args) > 3 else 502
+    started = time.monotonic()
+    try:
+        state, written = ingest_capture(args[0], args[1], interval, port)
+    except OSError as e:
+        print(Fore.RED + f"Failed to ingest capture: {e}" + Style.RESET_ALL)
+        return False
+    units = []
+    for key, tables in sorted(state.units.items()):
+        first, last = state.seen[key]
+        units.append({"host": key[0], "port": key[1], "unit": key[2], "first_seen": capture_time(first), "last_seen": capture_time(last),
+                      "snapshot": capture_snapshot_path(args[1], key), "banner": capture_banner(tables)})
+    return {"capture": args[0], "seconds": round(time.monotonic() - started, 3), "counts": state.counts, "units": units, "snapshots": written}
+
+def render_capture(result):
+    counts = result["counts"]
+    print(Fore.CYAN + f"Read {counts['packets']} packets from {result['capture']} in {result['seconds']:.1f}s: "
+          f"{counts['requests']} requests, {counts['responses']} responses, {counts['matched']} matched "
+          f"({counts['exceptions']} exceptions, {counts['malformed']} malformed, {counts['gaps']} stream gaps)" + Style.RESET_ALL)
+    if not result["units"]:
+        print(Fore.YELLOW + "No Modbus/TCP transactions found." + Style.RESET_ALL)
+    for unit in result["units"]:
+        print(Fore.CYAN + f"== {unit['host']}:{unit['port']} unit {unit['unit']} ({unit['first_seen']} -> {unit['last_seen']}) -> {unit['snapshot']} ==" + Style.RESET_ALL)
+        grab_banner(None, unit["banner"])
+    timed = len(result["snapshots"]) - len(result["units"])
+    if timed:
+        print(Fore.GREEN + f"Wrote {timed} interval snapshots as well." + Style.RESET_ALL)
+
+# Reads longer than this print as a compact grid (bits grouped by byte,
+# registers hex-dump style) instead of one table row per address
+GRID_THRESHOLD = 100
+GRID_CHUNK_ROWS = 256
+PRINTABLE = bytes(byte if 32 <= byte < 127 else 46 for byte in range(256))
+
+def grid_columns(bits):
+    try:
+        width = os.get_terminal_size(sys.stdout.fileno()).columns
+    except (OSError, ValueError):
+        width = 80
+    if bits:
+        return 32 if width >= 50 else 16
+    return 16 if width >= 130 else 8
+
+def render_grid(store):
+    # One formatting pass per row over the exported bytes; rows are written
+    # in chunks so a long read starts printing straight away
+    per_row = grid_columns(store.bits)
+    data = store.export()[0]
+    valid = store.valid_mask()
+    complete = valid == (1 << store.count) - 1
+    bits = int.from_bytes(data, "little") if store.bits else 0
+    out = [Fore.CYAN + f"{TABLE_TITLES[store.table]} {store.address}-{store.address + store.count - 1}"
+           f" ({store.valid_count()} of {store.count} read)" + Style.RESET_ALL + "\n"]
+    for start in range(0, store.count, per_row):
+        size = min(per_row, store.count - start)
+        full = (1 << size) - 1
+        mask = full if complete else valid >> start & full
+        if store.bits:
+            # Lowest address first
+            text = format(bits >> start & full, f"0{size}b")[::-1]
+            if mask != full:
+                text = "".join(c if mask >> i & 1 else "?" for i, c in enumerate(text))
+            cells = " ".join(text[i:i + 8] for i in range(0, size, 8))
+        else:
+            chunk = data[start * 2:(start + size) * 2]
+            words, text = chunk.hex(" ", 2), chunk.translate(PRINTABLE).decode("ascii")
+            if mask != full:
+                words = " ".join(word if mask >> i & 1 else "????" for i, word in enumerate(words.split(" ")))
+                text = "".join(text[i * 2:i * 2 + 2] if mask >> i & 1 else "  " for i in range(size))
+            cells = f"{words:<{per_row * 5 - 1}}  |{text}|"
+        out.append(f"{store.address + start:>6}: {cells}\n")
+        if len(out) >= GRID_CHUNK_ROWS:
+            sys.stdout.write("".join(out))
+            out = []
+    sys.stdout.write("".join(out))
+    sys.stdout.flush()
+
+def render_store(store):
+    if store.count > GRID_THRESHOLD:
+        render_grid(store)
+    else:
+        display_table(["Address", "Value"], store.items())
+
+def render_unit_ids(active_ids):
+    print(Fore.GREEN + f"Active Unit IDs: {active_ids}" + Style.RESET_ALL)
+
+Command = namedtuple("Command", ["handler", "usage", "description", "min_args", "max_args", "render"], defaults=[render_store])
+
+# Every REPL/batch command: handler(client, options, args) returns a result that
+# `render` prints in table mode and that is emitted as JSON in structured mode.
+# max_args of None means any number of arguments.
+COMMANDS = {
+    "read_coils": Command(command_read("coils"), "read_coils <address> <count>", "Read coils from the given address.", 2, 2),
+    "read_discrete_inputs": Command(command_read("discrete_inputs"), "read_discrete_inputs <address> <count>", "Read discrete inputs from the given address.", 2, 2),
+    "read_holding_registers": Command(command_read("holding_registers"), "read_holding_registers <address> <count>", "Read holding registers from the given address.", 2, 2),
+    "read_input_registers": Command(command_read("input_registers"), "read_input_registers <address> <count>", "Read input registers from the given address.", 2, 2),
+    "write_coil": Command(command_write_coil, "write_coil <address> <value>", "Write a value to a coil at the given address.", 2, 2),
+    "write_register": Command(command_write_register, "write_register <address> <value>", "Write a value to a register at the given address.", 2, 2),
+    "write_multiple_coils": Command(command_write_multiple_coils, "write_multiple_coils <address> <values>", "Write multiple coils starting at the given address.", 2, None),
+    "write_multiple_registers": Command(command_write_multiple_registers, "write_multiple_registers <address> <values>", "Write multiple registers starting at the given address.", 2, None),
+    "display_all_coils": Command(command_read("coils", 0, 100), "display_all_coils", "Display the first 100 coils.", 0, 0),
+    "display_all_discrete_inputs": Command(command_read("discrete_inputs", 0, 100), "display_all_discrete_inputs", "Display the first 100 discrete inputs.", 0, 0),
+    "display_all_holding_registers": Command(command_read("holding_registers", 0, 100), "display_all_holding_registers", "Display the first 100 holding registers.", 0, 0),
+    "display_all_input_registers": Command(command_read("input_registers", 0, 100), "display_all_input_registers", "Display the first 100 input registers.", 0, 0),
+    "chaos_mode": Command(command_chaos_mode, "chaos_mode", "Alternate coil values in the first 100 coils.", 0, 0),
+    "discover": Command(command_discover, "discover [unit_id] [step]", "Map the readable address ranges of every table and use them for later reads.", 0, 2, render_capabilities),
+    "capabilities": Command(command_capabilities, "capabilities [clear]", "Show or clear the discovered capability maps.", 0, 1, render_capability_maps),
+    "network_details": Command(lambda client, options, args: network_details(client, options.ip), "network_details", "Show the network details of the Modbus server.", 0, 0),
+    "grab_banner": Command(lambda client, options, args: read_banner(client), "grab_banner", "Grab the banner of the Modbus server.", 0, 0, lambda banner: grab_banner(None, banner)),
+    "advanced_banner": Command(lambda client, options, args: advanced_banner(client), "advanced_banner", "Grab a detailed banner of the Modbus server.", 0, 0),
+    "find_unit_ids": Command(lambda client, options, args: find_unit_ids(client, options.concurrency, options.timeout), "find_unit_ids", "Find active Modbus Unit IDs in the range 1 to 254.", 0, 0, render_unit_ids),
+    "enumerate": Command(lambda client, options, args: enumerate_units(client, options.concurrency, options.timeout), "enumerate", "Enumerate all Unit IDs and display their banners.", 0, 0),
+    "set_unit_id": Command(lambda client, options, args: set_unit_id(int(args[0])), "set_unit_id <unit_id>", "Set the current Unit ID to use for operations.", 1, 1),
+    "set_dry_run": Command(lambda client, options, args: set_dry_run(args[0]), "set_dry_run <on|off>", "Report writes (and how many values they would change) instead of sending them.", 1, 1),
+    "guard": Command(command_guard, "guard [on|off]", "Show the write guard, or turn capturing of original values before writes on or off.", 0, 1, render_guard),
+    "rollback": Command(lambda client, options, args: write_guard.rollback(client, int(args[0]) if args else current_unit_id), "rollback [unit_id]", "Restore every value written since capture began on this device and unit.", 0, 1),
+    "set_verify": Command(lambda client, options, args: set_verify_policy(args[0]), "set_verify <off|once|strict>", "Set how writes are read back and verified (default: once).", 1, 1),
+    "hex_modify": Command(command_hex_modify, "hex_modify <address> <hex_value>", "Modify register value at the given address.", 2, 2),
+    "hex_randomize": Command(command_hex_randomize, "hex_randomize <count>", "Randomize values in the given number of registers.", 1, 1),
+    "text_edit": Command(command_text_edit, "text_edit <text>", "Edit text in the first registers.", 1, None),
+    "crash_system": Command(lambda client, options, args: crash_system(client, optional_float(args, 0.01, "speed")), "crash_system [speed]", "Overload the system with random data at the given speed (default: 0.01s).", 0, 1),
+    "tags": Command(command_tags, "tags <tag_map_file>", "Load a tag map (name table address type [length= scale= offset= units= word= byte=]).", 1, 1),
+    "read_tags": Command(command_read_tags, "read_tags [name...]", "Read and decode every tag (or the named ones) with as few requests as possible.", 0, None, render_tags),
+    "watch_tags": Command(lambda client, options, args: watch_tags(client, optional_float(args, 1.0, "interval"), options.max_rate, options.max_unit_rate), "watch_tags [interval]", "Poll the tag map and print tags whose decoded value changes (default: 1s).", 0, 1),
+    "record": Command(record, "record [interval] [file]", "Poll the tag map into per-tag ring buffers, optionally appending to a recording file (default: 1s).", 0, 2),
+    "history": Command(command_history, "history [seconds] [name...]", "Show last, min, max and last change of recorded tags over the last seconds (default: all kept).", 0, None, render_history),
+    "monitor": Command(lambda client, options, args: monitor(client, optional_float(args, 1.0, "interval"), options.max_rate, options.max_unit_rate), "monitor [interval]", "Continuously fetch and display the Modbus banner in real time (default: 1s).", 0, 1),
+    "poll": Command(lambda client, options, args: poll(client, args[0], options.max_rate, options.max_unit_rate), "poll <poll_list_file>", "Poll the blocks listed in a file (unit table address count interval [priority]).", 1, 1),
+    "dump": Command(command_dump, "dump <file> [table [address count]]", "Stream a register dump to .csv, .jsonl or a binary snapshot.", 1, 4),
+    "diff": Command(command_diff, "diff <before> <after> [max_rows]", "Compare two saved dumps (or directories of dumps).", 2, 3),
+    "pcap": Command(command_pcap, "pcap <capture> <outdir> [interval [port]]", "Rebuild unit snapshots and banners from a pcap/pcapng capture, sending nothing.", 2, 4, render_capture),
+    "targets": Command(command_targets, "targets", "List the configured targets and their connection state.", 0, 0, render_targets),
+    "add_target": Command(command_add_target, "add_target <name> <host[:port]> [unit_id] [groups]", "Add an allow-listed target (groups comma separated).", 2, 4),
+    "stats": Command(command_stats, "stats [reset | export <file>]", "Show request counts and latencies, reset them, or export them as Prometheus text.", 0, 2, render_stats),
+    "trace": Command(command_trace, "trace <file|off>", "Append one JSON line per request to a file, or stop tracing.", 1, 1),
+    "help": Command(lambda client, options, args: display_help(), "help", "Display the list of commands.", 0, 0),
+}
+
+# Commands that work without a default connection
+OFFLINE_COMMANDS = {"diff", "pcap", "history", "guard", "set_dry_run", "targets", "add_target", "set_verify", "stats", "trace", "capabilities", "tags", "help"}
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+def to_json(result):
+    if isinstance(result, RegisterStore):
+        return {"table": result.table, "address": result.address, "values": result.tolist()}
+    if isinstance(result, (list, tuple)):
+        return [to_json(item) for item in result]
+    if isinstance(result, dict):
+        return {key: to_json(value) for key, value in result.items()}
+    return result
+
+def execute_command(client, options, name, args):
+    # Returns (ok, result)
+    command = COMMANDS.get(name)
+    if command is None:
+        print(Fore.RED + "Unknown command. Type 'help' for a list of commands." + Style.RESET_ALL)
+        return False, None
+    if client is None and name not in OFFLINE_COMMANDS:
+        print(Fore.RED + "No default connection; use 'on <target> <command>'." + Style.RESET_ALL)
+        return False, None
+    if len(args) < command.min_args or (command.max_args is not None and len(args) > command.max_args):
+        print(Fore.RED + f"Usage: {command.usage}" + Style.RESET_ALL)
+        return False, None
+    try:
+        # Handlers return False to report failure and True when there is nothing to render
+        result = command.handler(client, options, args)
+        if isinstance(result, bool):
+            return result, None
+        return True, result
+    except ValueError as e:
+        print(Fore.RED + f"Usage: {command.usage} ({e})" + Style.RESET_ALL)
+        return False, None
+    except (struct.error, ModbusException, OSError) as e:
+        # Reported per command instead of ending the batch or the shell
+        logging.error(f"{name} failed: {e}")
+        print(Fore.RED + f"{name} failed: {e}" + Style.RESET_ALL)
+        return False, None
+
+def present_result(name, result, output):
+    # Renders (table) or converts (json) a result; returns (ok, json result)
+    try:
+        if output == "json":
+            return True, to_json(result)
+        COMMANDS[name].render(result)
+        return True, None
+    except (ValueError, struct.error, ModbusException, OSError) as e:
+        logging.error(f"Failed to display the result of {name}: {e}")
+        print(Fore.RED + f"Failed to display the result of {name}: {e}" + Style.RESET_ALL)
+        return False, None
+
+def run_command(client, options, line, output="table", target=None):
+    # Runs one command line; returns None for 'exit', otherwise whether it succeeded
+    words = line.strip().split()
+    if not words or words[0].startswith("#"):
+        return True
+    name, args = words[0].lower(), words[1:]
+    if name == "exit":
+        return None
+    if name == "on" and target is None:
+        if not args:
+            print(Fore.RED + "Usage: on <target|group|all> <command> [args...]" + Style.RESET_ALL)
+            return False
+        return run_on_targets(options, args[0], " ".join(args[1:]), output)
+
+    if output == "json":
+        captured = io.StringIO()
+        with redirect_stdout(captured):
+            ok, result = execute_command(client, options, name, args)
+            if ok:
+                ok, result = present_result(name, result, output)
+        messages = [ANSI_ESCAPE.sub("", text) for text in captured.getvalue().splitlines() if text.strip()]
+        record = {"command": name, "args": args, "ok": ok, "result": result, "messages": messages}
+        if target is not None:
+            record["target"] = target
+        print(json.dumps(record), flush=True)
+        return ok
+
+    ok, result = execute_command(client, options, name, args)
+    if ok and result is not None:
+        ok = present_result(name, result, output)[0]
+    return ok
+
+def run_batch(client, options, source, output):
+    # Returns the number of commands that failed
+    failures = 0
+    lines = sys.stdin if source == "-" else open(source)
+    try:
+        for line in lines:
+            ok = run_command(client, options, line, output)
+            if ok is None:
+                break
+            if not ok:
+                failures += 1
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    return failures
+
+def close_connections(client, options):
+    if client is not None:
+        client.close()
+    if pipeline is not None:
+        pipeline.close()
+    options.sessions.close()
+    if options.metrics:
+        write_metrics(options.metrics)
+    metrics.close_trace()
+    write_guard.close()
+
 def main():
+    global pipeline, current_unit_id, verify_policy, request_timeout, min_timeout, max_retries, capabilities_path, recorder
     parser = ArgumentParser()
-    shtab.add_argument_to(parser, ["-s", "--shtab"])
-    parser.add_argument("ip", help="IP address of the Modbus server")
-    parser.add_argument("port", type=int, help="Port of the Modbus server")
+    parser.add_argument("-s", "--shtab", choices=["bash", "zsh", "tcsh"], help="Print a shell tab completion script and exit")
+    parser.add_argument("ip", nargs="?", help="IP address of the Modbus server")
+    parser.add_argument("port", nargs="?", type=int, help="Port of the Modbus server")
+    parser.add_argument("--serial", metavar="DEVICE", help="Talk Modbus RTU/ASCII on a serial port (e.g. /dev/ttyUSB0) instead of Modbus/TCP")
+    parser.add_argument("--baudrate", type=int, default=9600, help="Serial baud rate (default: 9600)")
+    parser.add_argument("--framing", choices=SERIAL_FRAMINGS, default="rtu", help="Serial framing (default: rtu)")
+    parser.add_argument("--parity", choices=SERIAL_PARITIES, default="N", help="Serial parity (default: N)")
+    parser.add_argument("--bytesize", type=int, choices=[7, 8], help="Serial data bits (default: 8 for RTU, 7 for ASCII)")
+    parser.add_argument("--stopbits", type=int, choices=[1, 2], default=1, help="Serial stop bits (default: 1)")
+    parser.add_argument("-w", "--window", type=int, default=1, help="Number of pipelined read requests in flight (default: 1, no pipelining)")
+    parser.add_argument("-t", "--timeout", type=float, default=3.0, help="Maximum per-request timeout in seconds, used until a device has answered (default: 3)")
+    parser.add_argument("--min-timeout", type=float, default=0.1, help="Lower bound for the adaptive per-device timeout in seconds (default: 0.1)")
+    parser.add_argument("-r", "--retries", type=int, default=2, help="Resend unanswered requests up to this many times; exception responses are never retried (default: 2)")
+    parser.add_argument("--max-rate", type=float, default=0, help="Global cap on polling requests per second (default: unlimited)")
+    parser.add_argument("--max-unit-rate", type=float, default=0, help="Cap on polling requests per second to each unit (default: unlimited)")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="Requests in flight during unit sweeps (default: 16)")
+    parser.add_argument("--verify", choices=VERIFY_POLICIES, default="once", help="Write verification: off, once (one read of the written range) or strict (per request, stop on mismatch)")
+    parser.add_argument("--dry-run", action="store_true", help="Report writes instead of sending them")
+    parser.add_argument("--write-allow", action="append", default=[], metavar="TABLE:START[-END]", help="Only allow writes inside this range, e.g. holding_registers:100-199 (repeatable)")
+    parser.add_argument("--journal", metavar="FILE", help="Capture original values before every write and append them and the writes to FILE; 'rollback' restores them")
+    parser.add_argument("-u", "--unit-id", type=int, default=1, help="Unit ID to use for operations (default: 1)")
+    parser.add_argument("--dump", nargs="+", metavar="ARG", help="Dump registers and exit: <file> [table [address count]]; .csv, .jsonl or binary snapshot")
+    parser.add_argument("-b", "--batch", metavar="FILE", help="Run the commands in FILE ('-' for stdin) without prompting, then exit")
+    parser.add_argument("-o", "--output", choices=["table", "json"], help="Result format: 'table' (default in the shell) or 'json' lines (default in batch mode)")
+    parser.add_argument("--targets", metavar="FILE", help="Load named targets ('<name> <host[:port]> [unit_id] [groups]') and 'allow' lines")
+    parser.add_argument("--allow", action="append", default=[], metavar="HOST", help="Allow multi-target commands to connect to HOST or network (repeatable)")
+    parser.add_argument("--idle-timeout", type=float, default=300, help="Close pooled target connections idle this many seconds (default: 300)")
+    parser.add_argument("--capabilities", metavar="FILE", help="Load discovered capability maps from FILE and save new ones to it")
+    parser.add_argument("--tags", metavar="FILE", help="Load a tag map naming typed values ('<name> <table> <address> <type> [key=value ...]')")
+    parser.add_argument("--recording", metavar="FILE", help="Load the recent samples of a tag recording from FILE and append new 'record' samples to it")
+    parser.add_argument("--record-depth", type=int, default=RECORD_DEPTH, help=f"Samples kept in memory per recorded tag (default: {RECORD_DEPTH})")
+    parser.add_argument("--trace", metavar="FILE", help="Append one JSON line per Modbus request (timing, bytes, status) to FILE")
+    parser.add_argument("--metrics", metavar="FILE", help="Write request counters and latency histograms as Prometheus text to FILE on exit")
+    parser.add_argument("--pcap", nargs="+", metavar="ARG", help="Rebuild snapshots from a capture offline and exit: <capture> <outdir> [interval [port]]")
+    parser.add_argument("--diff", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two saved dumps (or directories of dumps) offline and exit")
     args = parser.parse_args()
 
-    client = ModbusTcpClient(args.ip, args.port)
-    if not client.connect():
-        logging.error(f"Failed to connect to Modbus server at {args.ip}:{args.port}")
-        sys.exit(1)
+    if args.shtab:
+        import shtab
+        print(shtab.complete(parser, args.shtab))
+        return
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-    print(Fore.CYAN + "Connected to Modbus server." + Style.RESET_ALL)
-    print(Fore.YELLOW + "Type 'help' for a list of commands." + Style.RESET_ALL)
+    if args.diff:
+        diff(*args.diff)
+        return
+    if args.pcap:
+        if not 2 <= len(args.pcap) <= 4:
+            parser.error("--pcap: expected <capture> <outdir> [interval [port]]")
+        ok, result = execute_command(None, args, "pcap", args.pcap)
+        if ok and args.output == "json":
+            print(json.dumps(to_json(result)))
+        elif ok:
+            render_capture(result)
+        sys.exit(0 if ok else 1)
+    if args.capabilities:
+        capabilities_path = args.capabilities
+        if os.path.exists(args.capabilities):
+            try:
+                load_capabilities(args.capabilities)
+            except (OSError, ValueError, TypeError) as e:
+                parser.error(f"--capabilities: {e}")
+    if args.tags:
+        try:
+            set_tag_map(args.tags)
+        except (OSError, ValueError) as e:
+            parser.error(f"--tags: {e}")
+    if args.recording and os.path.exists(args.recording):
+        try:
+            recorder = load_recording(args.recording, args.record_depth)[1]
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            parser.error(f"--recording: {e}")
+    write_guard.dry_run = args.dry_run
+    try:
+        for spec in args.write_allow:
+            write_guard.allow(spec)
+    except ValueError as e:
+        parser.error(f"--write-allow: {e}")
+    if args.journal:
+        try:
+            write_guard.open_journal(args.journal)
+        except (OSError, KeyError, TypeError) as e:
+            parser.error(f"--journal: {e}")
+    if args.trace:
+        try:
+            metrics.open_trace(args.trace)
+        except OSError as e:
+            parser.error(f"--trace: {e}")
+    args.sessions = SessionManager(args.allow, args.idle_timeout, args.timeout)
+    if args.targets:
+        try:
+            load_targets(args.targets, args.sessions)
+        except (OSError, ValueError) as e:
+            parser.error(f"--targets: {e}")
+    if (args.ip is None or args.port is None) and not args.targets and not args.serial:
+        parser.error("the following arguments are required: ip, port")
 
-    while True:
+    dump_ranges = None
+    if args.dump:
         try:
-            command = input(Fore.CYAN + "modbus> " + Style.RESET_ALL).strip().split()
-            if len(command) == 0:
-                continue
+            dump_ranges = parse_dump_ranges(args.dump[1:])
+        except ValueError as e:
+            parser.error(f"--dump: {e}")
+    current_unit_id = args.unit_id
+    verify_policy = args.verify
+    request_timeout = args.timeout
+    min_timeout = min(args.min_timeout, args.timeout)
+    max_retries = max(0, args.retries)
+
+    if dump_ranges is not None and args.ip is None and not args.serial:
+        parser.error("--dump needs ip and port")
+
+    client = None
+    if args.serial:
+        client = SerialClient(args.serial, args.baudrate, args.framing, args.parity, args.stopbits, args.timeout, args.bytesize)
+        if not client.connect():
+            sys.exit(1)
+        # Reads go through the transport so each batch crosses the bus back to back
+        pipeline = client.transport
+        if not args.batch:
+            print(Fore.CYAN + f"Opened {args.serial} ({args.framing.upper()} {args.baudrate} {client.transport.bytesize}{args.parity}{args.stopbits})." + Style.RESET_ALL)
+    elif args.ip is not None:
+        client = modbus_client(args.ip, args.port, args.timeout)
+        connected = client.connect()
+        metrics.connected("client", client_device(client), connected)
+        if not connected:
+            logging.error(f"Failed to connect to Modbus server at {args.ip}:{args.port}")
+            sys.exit(1)
+
+        if args.window > 1:
+            pipeline = PipelinedTransport(args.ip, args.port, args.window, args.timeout)
+            if not pipeline.connect():
+                sys.exit(1)
 
-            cmd = command[0].lower()
+        if not args.batch:
+            print(Fore.CYAN + "Connected to Modbus server." + Style.RESET_ALL)
 
-            if cmd == "exit":
+    if dump_ranges is not None:
+        dump(client, args.dump[0], dump_ranges)
+        close_connections(client, args)
+        return
+
+    if args.batch:
+        try:
+            failures = run_batch(client, args, args.batch, args.output or "json")
+        except OSError as e:
+            logging.error(f"Failed to read batch file: {e}")
+            failures = 1
+        close_connections(client, args)
+        sys.exit(1 if failures else 0)
+
+    import readline  # line editing and history for input()
+    print(Fore.YELLOW + "Type 'help' for a list of commands." + Style.RESET_ALL)
+
+    while True:
+        try:
+            line = input(Fore.CYAN + "modbus> " + Style.RESET_ALL)
+            if run_command(client, args, line, args.output or "table") is None:
                 break
-            elif cmd == "read_coils":
-                if len(command) != 3:
-                    print(Fore.RED + "Usage: read_coils <address> <count>" + Style.RESET_ALL)
-                    continue
-                address, count = int(command[1]), int(command[2])
-                coils = read_coils(client, address, count)
-                display_table(["Address", "Value"], [[i + address, v] for i, v in enumerate(coils)])
-            elif cmd == "read_discrete_inputs":
-                if len(command) != 3:
-                    print(Fore.RED + "Usage: read_discrete_inputs <address> <count>" + Style.RESET_ALL)
-                    continue
-                address, count = int(command[1]), int(command[2])
-                inputs = read_discrete_inputs(client, address, count)
-                display_table(["Address", "Value"], [[i + address, v] for i, v in enumerate(inputs)])
-            elif cmd == "read_holding_registers":
-                if len(command) != 3:
-                    print(Fore.RED + "Usage: read_holding_registers <address> <count>" + Style.RESET_ALL)
-                    continue
-                address, count = int(command[1]), int(command[2])
-                registers = read_holding_registers(client, address, count)
-                display_table(["Address", "Value"], [[i + address, v] for i, v in enumerate(registers)])
-            elif cmd == "read_input_registers":
-                if len(command) != 3:
-                    print(Fore.RED + "Usage: read_input_registers <address> <count>" + Style.RESET_ALL)
-                    continue
-                address, count = int(command[1]), int(command[2])
-                registers = read_input_registers(client, address, count)
-                display_table(["Address", "Value"], [[i + address, v] for i, v in enumerate(registers)])
-            elif cmd == "write_coil":
-                if len(command) != 3:
-                    print(Fore.RED + "Usage: write_coil <address> <value>" + Style.RESET_ALL)
-                    continue
-                address, value = int(command[1]), bool(int(command[2]))
-                write_coil(client, address, value)
-                # Verify the written value
-                new_value = read_coils(client, address, 1)
-                if new_value and new_value[0] == value:
-                    print(Fore.GREEN + f"Verified coil at address {address} is set to {value}" + Style.RESET_ALL)
-                else:
-                    print(Fore.RED + f"Verification failed for coil at address {address}" + Style.RESET_ALL)
-            elif cmd == "write_register":
-                if len(command) != 3:
-                    print(Fore.RED + "Usage: write_register <address> <value>" + Style.RESET_ALL)
-                    continue
-                address, value = int(command[1]), int(command[2])
-                write_register(client, address, value)
-                # Verify the written value
-                new_value = read_holding_registers(client, address, 1)
-                if new_value and new_value[0] == value:
-                    print(Fore.GREEN + f"Verified register at address {address} is set to {value}" + Style.RESET_ALL)
-                else:
-                    print(Fore.RED + f"Verification failed for register at address {address}" + Style.RESET_ALL)
-            elif cmd == "write_multiple_coils":
-                if len(command) < 3:
-                    print(Fore.RED + "Usage: write_multiple_coils <address> <values>" + Style.RESET_ALL)
-                    continue
-                address = int(command[1])
-                values = [bool(int(v)) for v in command[2:]]
-                write_multiple_coils(client, address, values)
-            elif cmd == "write_multiple_registers":
-                if len(command) < 3:
-                    print(Fore.RED + "Usage: write_multiple_registers <address> <values>" + Style.RESET_ALL)
-                    continue
-                address = int(command[1])
-                values = [int(v) for v in command[2:]]
-                write_multiple_registers(client, address, values)
-                # Verify the written values
-                new_values = read_holding_registers(client, address, len(values))
-                if new_values and new_values == values:
-                    print(Fore.GREEN + f"Verified multiple registers starting at address {address}" + Style.RESET_ALL)
-                else:
-                    print(Fore.RED + f"Verification failed for multiple registers starting at address {address}" + Style.RESET_ALL)
-            elif cmd == "display_all_coils":
-                display_table(["Address", "Value"], [[i, v] for i, v in enumerate(read_coils(client, 0, 100))])
-            elif cmd == "display_all_discrete_inputs":
-                display_table(["Address", "Value"], [[i, v] for i, v in enumerate(read_discrete_inputs(client, 0, 100))])
-            elif cmd == "display_all_holding_registers":
-                display_table(["Address", "Value"], [[i, v] for i, v in enumerate(read_holding_registers(client, 0, 100))])
-            elif cmd == "display_all_input_registers":
-                display_table(["Address", "Value"], [[i, v] for i, v in enumerate(read_input_registers(client, 0, 100))])
-            elif cmd == "chaos_mode":
-                for i in range(100):
-                    value = not bool(i % 2)
-                    write_coil(client, i, value)
-                    time.sleep(0.1)
-                logging.info("Chaos mode activated: Alternated coil values.")
-                display_table(["Address", "Value"], [[i, v] for i, v in enumerate(read_coils(client, 0, 100))])
-            elif cmd == "network_details":
-                network_details(client, args.ip)
-            elif cmd == "grab_banner":
-                grab_banner(client)
-            elif cmd == "advanced_banner":
-                advanced_banner(client)
-            elif cmd == "find_unit_ids":
-                active_ids = find_unit_ids(client)
-                print(Fore.GREEN + f"Active Unit IDs: {active_ids}" + Style.RESET_ALL)
-            elif cmd == "enumerate":
-                enumerate_units(client)
-            elif cmd == "set_unit_id":
-                if len(command) != 2:
-                    print(Fore.RED + "Usage: set_unit_id <unit_id>" + Style.RESET_ALL)
-                    continue
-                unit_id = int(command[1])
-                set_unit_id(unit_id)
-            elif cmd == "help":
-                display_help()
-            elif cmd == "hex_modify":
-                if len(command) != 3:
-                    print(Fore.RED + "Usage: hex_modify <address> <hex_value>" + Style.RESET_ALL)
-                    continue
-                address, value = int(command[1]), command[2]
-                hex_modify(client, address, value)
-                # Verify the written value
-                new_value = read_holding_registers(client, address, 1)
-                if new_value and format(new_value[0], '04x') == value:
-                    print(Fore.GREEN + f"Verified register at address {address} is set to {value}" + Style.RESET_ALL)
-                else:
-                    print(Fore.RED + f"Verification failed for register at address {address}" + Style.RESET_ALL)
-            elif cmd == "hex_randomize":
-                if len(command) != 2:
-                    print(Fore.RED + "Usage: hex_randomize <count>" + Style.RESET_ALL)
-                    continue
-                count = int(command[1])
-                hex_randomize(client, count)
-                # Verify the written values
-                new_values = read_holding_registers(client, 0, count)
-                print(Fore.GREEN + f"Randomized {count} registers." + Style.RESET_ALL)
-            elif cmd == "text_edit":
-                if len(command) < 2:
-                    print(Fore.RED + "Usage: text_edit <text>" + Style.RESET_ALL)
-                    continue
-                text = ' '.join(command[1:])
-                text_edit(client, text)
-                # Verify the written values
-                hex_values = string_to_hex_list(text)
-                int_values = [int(hex_val, 16) for hex_val in hex_values]
-                new_values = read_holding_registers(client, 0, len(int_values))
-                if new_values and new_values == int_values:
-                    print(Fore.GREEN + f"Verified text written to registers: {text}" + Style.RESET_ALL)
-                else:
-                    print(Fore.RED + f"Verification failed for text written to registers" + Style.RESET_ALL)
-            elif cmd == "crash_system":
-                speed = 0.01
-                if len(command) == 2:
-                    try:
-                        speed = float(command[1])
-                    except ValueError:
-                        print(Fore.RED + "Invalid speed value. Using default speed 0.01s." + Style.RESET_ALL)
-                crash_system(client, speed)
-            elif cmd == "monitor":
-                monitor(client)
-            else:
-                print(Fore.RED + "Unknown command. Type 'help' for a list of commands." + Style.RESET_ALL)
+        except EOFError:
+            break
         except KeyboardInterrupt:
             print("\nUse 'exit' command to disconnect from the Modbus server.")
 
-    client.close()
+    close_connections(client, args)
     print(Fore.CYAN + "Disconnected from Modbus server." + Style.RESET_ALL)
 
 if __name__ == "__main__":
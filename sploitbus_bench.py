@@ -0,0 +1,570 @@
+# Created by PlayerFridei
+# Benchmark harness for Sploitbus: runs standard workloads against a local
+# pymodbus simulator behind a proxy that injects latency, jitter and loss,
+# or behind a pseudo-terminal that stands in for a serial line
+
+import io
+import os
+import sys
+import math
+import json
+import queue
+import random
+import asyncio
+import logging
+import socket
+import struct
+import tempfile
+import subprocess
+import threading
+import time
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+from pymodbus.server import ModbusTcpServer
+from prettytable import PrettyTable
+from colorama import init, Fore, Style
+
+import sploitbus
+
+init()
+
+MBAP_HEADER = sploitbus.MBAP_HEADER
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def unit_context(size, seed):
+    # Deterministic register map: the same seed always yields the same values
+    rng = random.Random(seed)
+    return ModbusSlaveContext(
+        co=ModbusSequentialDataBlock(0, [rng.random() < 0.5 for _ in range(size)]),
+        di=ModbusSequentialDataBlock(0, [rng.random() < 0.5 for _ in range(size)]),
+        hr=ModbusSequentialDataBlock(0, [rng.getrandbits(16) for _ in range(size)]),
+        ir=ModbusSequentialDataBlock(0, [rng.getrandbits(16) for _ in range(size)]),
+        zero_mode=True)
+
+class Simulator:
+    # pymodbus TCP server on its own event loop thread
+    def __init__(self, units, size, seed=0):
+        self.units = units
+        self.port = free_port()
+        slaves = {unit_id: unit_context(size, seed + unit_id) for unit_id in units}
+        self.context = ModbusServerContext(slaves=slaves, single=False)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        async def serve():
+            server = ModbusTcpServer(self.context, address=("127.0.0.1", self.port))
+            await server.serve_forever()
+        asyncio.run(serve())
+
+    def start(self):
+        self.thread.start()
+        if not wait_for_port(self.port):
+            raise RuntimeError(f"simulator did not start on port {self.port}")
+
+class ProxyStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.responses = 0
+            self.dropped = 0
+            self.bytes_sent = 0      # client -> device
+            self.bytes_received = 0  # device -> client
+            self.latencies = []
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "responses": self.responses,
+                "dropped": self.dropped,
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "latencies": sorted(self.latencies),
+            }
+
+def split_frames(buffer):
+    # Yield (transaction_id, unit_id, frame) for every complete MBAP frame in the buffer
+    while len(buffer) >= MBAP_HEADER.size:
+        tid, _, length, unit = MBAP_HEADER.unpack_from(buffer)
+        end = 6 + length
+        if len(buffer) < end:
+            break
+        frame = bytes(buffer[:end])
+        del buffer[:end]
+        yield tid, unit, frame
+
+class ProxyConnection:
+    # One client connection: requests go straight to the simulator, responses
+    # are held back until their injected delay has passed (in order, like TCP)
+    def __init__(self, proxy, client, rng):
+        self.proxy = proxy
+        self.client = client
+        self.rng = rng
+        self.upstream = socket.create_connection(("127.0.0.1", proxy.server_port))
+        self.upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.arrivals = {}
+        self.delays = {}
+        self.outbox = queue.Queue()
+        self.last_delivery = 0.0
+        self.lock = threading.Lock()
+        for target in (self._from_client, self._from_server, self._deliver):
+            threading.Thread(target=target, daemon=True).start()
+
+    def _delay(self):
+        return max(0.0, self.proxy.latency + self.rng.uniform(-self.proxy.jitter, self.proxy.jitter))
+
+    def _queue_response(self, tid, frame):
+        with self.lock:
+            arrived = self.arrivals.pop(tid, None)
+            delay = self.delays.pop(tid, 0.0)
+            if arrived is None:
+                return
+            self.last_delivery = max(arrived + delay, self.last_delivery)
+            self.outbox.put((self.last_delivery, arrived, frame))
+
+    def _from_client(self):
+        buffer = bytearray()
+        stats = self.proxy.stats
+        try:
+            while True:
+                data = self.client.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                for tid, unit, frame in split_frames(buffer):
+                    now = time.monotonic()
+                    with stats.lock:
+                        stats.requests += 1
+                        stats.bytes_sent += len(frame)
+                    # Draw both values for every request so the fault pattern
+                    # only depends on the seed and the request order
+                    lost = self.rng.random() < self.proxy.loss
+                    delay = self._delay()
+                    if lost:
+                        with stats.lock:
+                            stats.dropped += 1
+                        continue
+                    with self.lock:
+                        self.arrivals[tid] = now
+                        self.delays[tid] = delay
+                    if unit in self.proxy.units:
+                        self.upstream.sendall(frame)
+                    else:
+                        # Answer for absent units like a gateway: target failed to respond
+                        pdu = bytes([frame[7] | 0x80, 0x0B])
+                        self._queue_response(tid, MBAP_HEADER.pack(tid, 0, len(pdu) + 1, unit) + pdu)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def _from_server(self):
+        buffer = bytearray()
+        try:
+            while True:
+                data = self.upstream.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                for tid, _, frame in split_frames(buffer):
+                    self._queue_response(tid, frame)
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def _deliver(self):
+        stats = self.proxy.stats
+        while True:
+            entry = self.outbox.get()
+            if entry is None:
+                break
+            deliver_at, arrived, frame = entry
+            wait = deliver_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.client.sendall(frame)
+            except OSError:
+                break
+            with stats.lock:
+                stats.responses += 1
+                stats.bytes_received += len(frame)
+                stats.latencies.append(time.monotonic() - arrived)
+
+    def close(self):
+        for sock in (self.client, self.upstream):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self.outbox.put(None)
+
+class FaultProxy:
+    # Listens in front of the simulator; every accepted connection gets its own
+    # random generator seeded from the run seed and the connection number
+    def __init__(self, server_port, units, latency=0.0, jitter=0.0, loss=0.0, seed=0):
+        self.server_port = server_port
+        self.units = set(units)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.seed = seed
+        self.connections = 0
+        self.stats = ProxyStats()
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            self.connections += 1
+            ProxyConnection(self, client, random.Random(f"{self.seed}:{self.connections}"))
+
+def rtu_request_length(frame):
+    # Length of an RTU request once its header has arrived, None if unknown
+    if len(frame) < 7:
+        return 8
+    if frame[1] in (15, 16):
+        return 9 + frame[6]
+    return 8 if frame[1] <= 6 else None
+
+def serve_pdu(slave, pdu):
+    # Response PDU from a pymodbus slave context, as a serial device would answer
+    fc = pdu[0]
+    try:
+        if fc in (1, 2, 3, 4):
+            address, count = struct.unpack_from(">HH", pdu, 1)
+            if not slave.validate(fc, address, count):
+                return bytes([fc | 0x80, 2])
+            values = slave.getValues(fc, address, count)
+            if fc <= 2:
+                data = sploitbus.pack_bits(values).to_bytes((count + 7) >> 3, "little")
+            else:
+                data = struct.pack(f">{count}H", *values)
+            return bytes([fc, len(data)]) + data
+        if fc in (5, 6, 15, 16):
+            if fc in (5, 6):
+                address, value = struct.unpack_from(">HH", pdu, 1)
+                values = [value == 0xFF00] if fc == 5 else [value]
+            else:
+                address, count, size = struct.unpack_from(">HHB", pdu, 1)
+                data = pdu[6:6 + size]
+                if fc == 15:
+                    values = sploitbus.unpack_bits(int.from_bytes(data, "little"), count)
+                else:
+                    values = list(struct.unpack(f">{count}H", data))
+            if not slave.validate(fc, address, len(values)):
+                return bytes([fc | 0x80, 2])
+            slave.setValues(fc, address, values)
+            return pdu[:5]
+    except struct.error:
+        return bytes([fc | 0x80, 3])
+    return bytes([fc | 0x80, 1])
+
+class SerialSlave:
+    # Simulated RS-485 slaves behind a pty pair: the client opens `path`, this end
+    # answers RTU or ASCII frames from the simulator's datastore and holds each
+    # answer back for the time the request and response would spend on the line
+    def __init__(self, context, units, framing, baudrate, latency=0.0, jitter=0.0, loss=0.0, seed=0):
+        self.master, self.slave = os.openpty()  # keep both ends open across client reconnects
+        self.path = os.ttyname(self.slave)
+        self.context = context
+        self.units = set(units)
+        self.framing = framing
+        self.char_time = 10 / baudrate  # 8N1: ptys only carry 8 data bits
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = random.Random(f"{seed}:serial")
+        self.stats = ProxyStats()
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _frames(self, buffer):
+        while buffer:
+            if self.framing == "rtu":
+                length = rtu_request_length(buffer)
+                if length is None or len(buffer) < length:
+                    return
+            else:
+                length = buffer.find(b"\n") + 1
+                if not length:
+                    return
+            frame = bytes(buffer[:length])
+            del buffer[:length]
+            yield frame
+
+    def _serve(self):
+        buffer = bytearray()
+        while True:
+            buffer += os.read(self.master, 4096)
+            for frame in self._frames(buffer):
+                decoded = sploitbus.decode_serial_frame(self.framing, frame)
+                with self.stats.lock:
+                    self.stats.requests += 1
+                    self.stats.bytes_sent += len(frame)
+                if decoded is None or decoded[0] not in self.units:
+                    continue  # bad checksum or nobody at that address: silence
+                if self.rng.random() < self.loss:
+                    with self.stats.lock:
+                        self.stats.dropped += 1
+                    continue
+                unit, pdu = decoded
+                response = sploitbus.encode_serial_frame(self.framing, unit, serve_pdu(self.context[unit], pdu))
+                started = time.monotonic()
+                time.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)) + len(frame) * self.char_time)
+                # Stream the answer at line speed, as a real device would
+                for i in range(0, len(response), 16):
+                    os.write(self.master, response[i:i + 16])
+                    time.sleep(len(response[i:i + 16]) * self.char_time)
+                delay = time.monotonic() - started
+                with self.stats.lock:
+                    self.stats.responses += 1
+                    self.stats.bytes_received += len(response)
+                    self.stats.latencies.append(delay)
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+def workload_dump(client, options):
+    with tempfile.TemporaryDirectory() as directory:
+        sploitbus.dump(client, os.path.join(directory, "bench.snap"), sploitbus.parse_dump_ranges([]), options.units[0])
+
+def workload_sweep(client, options):
+    sploitbus.enumerate_units(client, options.concurrency, options.timeout)
+
+def workload_poll(client, options):
+    scheduler = sploitbus.PollScheduler(options.max_rate, options.max_unit_rate)
+    for unit_id in options.units:
+        for table, address, count in sploitbus.BANNER_READS:
+            scheduler.add(unit_id, table, address, count, 0)
+    for _ in range(options.polls):
+        scheduler.poll(client)
+
+def workload_write(client, options):
+    rng = random.Random(options.seed)
+    count = min(options.write_count, options.size)
+    for _ in range(options.writes):
+        values = [rng.getrandbits(16) for _ in range(count)]
+        sploitbus.write_values(client, "holding_registers", 0, values, options.verify, options.units[0])
+
+WORKLOADS = {
+    "dump": (workload_dump, "Full-map dump of all four tables"),
+    "sweep": (workload_sweep, "Unit ID sweep plus banners"),
+    "poll": (workload_poll, "Monitor polling of the banner blocks"),
+    "write": (workload_write, "Batched register writes with verification"),
+}
+
+SPLOITBUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sploitbus.py")
+LAUNCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sploitbus_cli.py")
+
+# Command lines timed by the startup workload: (arguments, stdin). The budget
+# applies to the launcher, whose import of sploitbus reuses cached bytecode;
+# "script:help" runs sploitbus.py directly, recompiling it on every start, and
+# the bare interpreter is the floor both are compared against.
+STARTUP_SCENARIOS = {
+    "interpreter": (["-c", "pass"], None),
+    "script:help": ([SPLOITBUS, "--help"], None),
+    "help": ([LAUNCHER, "--help"], None),
+    "shtab": ([LAUNCHER, "--shtab", "bash"], None),
+    "read": ([LAUNCHER, "127.0.0.1", "{port}", "--batch", "-"], "read_holding_registers 0 10\n"),
+}
+UNBUDGETED_SCENARIOS = ("interpreter", "script:help")
+
+def run_startup(proxy, options):
+    results = []
+    for name, (arguments, stdin) in STARTUP_SCENARIOS.items():
+        command = [sys.executable] + [argument.format(port=proxy.port) for argument in arguments]
+        times = []
+        failures = 0
+        for _ in range(options.startup_runs):
+            started = time.perf_counter()
+            completed = subprocess.run(command, input=stdin, capture_output=True, text=True)
+            times.append(time.perf_counter() - started)
+            failures += completed.returncode != 0
+        times.sort()
+        median = percentile(times, 0.50)
+        budget = None if name in UNBUDGETED_SCENARIOS else options.startup_budget
+        results.append({
+            "workload": f"startup:{name}",
+            "runs": len(times),
+            "failures": failures,
+            "median_ms": round(median * 1000, 1),
+            "max_ms": round(times[-1] * 1000, 1),
+            "budget_ms": budget,
+            "within_budget": budget is None or median * 1000 <= budget,
+        })
+    return results
+
+def run_workload(name, proxy, options):
+    # `proxy` is the FaultProxy, or the SerialSlave when running over a pty
+    if options.serial:
+        client = sploitbus.SerialClient(proxy.path, options.baudrate, options.serial, timeout=options.timeout, bytesize=8)
+    else:
+        client = sploitbus.modbus_client("127.0.0.1", proxy.port, options.timeout)
+    if not client.connect():
+        raise RuntimeError("failed to connect to the benchmark proxy")
+    sploitbus.current_unit_id = options.units[0]
+    sploitbus.request_timeout = options.timeout
+    sploitbus.min_timeout = min(options.min_timeout, options.timeout)
+    sploitbus.max_retries = options.retries
+    sploitbus.rtt_estimators.clear()
+    if options.serial:
+        sploitbus.pipeline = client.transport
+    elif options.window > 1:
+        sploitbus.pipeline = sploitbus.PipelinedTransport("127.0.0.1", proxy.port, options.window, options.timeout)
+    proxy.stats.reset()
+    started = time.monotonic()
+    try:
+        with redirect_stdout(sys.stdout if options.verbose else io.StringIO()):
+            WORKLOADS[name][0](client, options)
+    finally:
+        elapsed = time.monotonic() - started
+        client.close()
+        if sploitbus.pipeline is not None:
+            sploitbus.pipeline.close()
+            sploitbus.pipeline = None
+    # Let responses still held by the proxy drain before the next workload
+    time.sleep(options.latency + options.jitter)
+    stats = proxy.stats.snapshot()
+    latencies = stats.pop("latencies")
+    p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+    stats.update({
+        "workload": name,
+        "elapsed": round(elapsed, 4),
+        "requests_per_second": round(stats["responses"] / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": None if p50 is None else round(p50 * 1000, 3),
+        "p99_ms": None if p99 is None else round(p99 * 1000, 3),
+    })
+    return stats
+
+def print_results(results):
+    traffic = [result for result in results if "requests" in result]
+    startup = [result for result in results if "median_ms" in result]
+    if traffic:
+        table = PrettyTable(["Workload", "Requests", "Lost", "Time (s)", "Req/s", "p50 (ms)", "p99 (ms)", "Bytes out", "Bytes in"])
+        for result in traffic:
+            table.add_row([result["workload"], result["requests"], result["dropped"], f"{result['elapsed']:.3f}",
+                           result["requests_per_second"], result["p50_ms"], result["p99_ms"],
+                           result["bytes_sent"], result["bytes_received"]])
+        print(table)
+    if startup:
+        table = PrettyTable(["Startup", "Runs", "Failed", "Median (ms)", "Max (ms)", "Budget (ms)"])
+        for result in startup:
+            budget = "-" if result["budget_ms"] is None else result["budget_ms"]
+            color = Fore.GREEN if result["within_budget"] else Fore.RED
+            table.add_row([result["workload"], result["runs"], result["failures"], color + str(result["median_ms"]) + Style.RESET_ALL,
+                           result["max_ms"], budget])
+        print(table)
+
+def parse_units(value):
+    units = sorted({int(unit_id) for unit_id in value.split(",") if unit_id})
+    if not units or not all(1 <= unit_id <= 247 for unit_id in units):
+        raise ValueError("unit IDs must be between 1 and 247")
+    return units
+
+def main():
+    parser = ArgumentParser(description="Benchmark Sploitbus against a local simulated Modbus device")
+    parser.add_argument("workloads", nargs="*", metavar="WORKLOAD", help=f"Workloads to run: {', '.join(WORKLOADS)}, startup (default: all)")
+    parser.add_argument("--units", default="1", help="Comma-separated unit IDs served by the simulator (default: 1)")
+    parser.add_argument("--size", type=int, default=65536, help="Values per table for every unit (default: 65536)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for register contents, jitter and loss (default: 0)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Injected one-way response delay in milliseconds (default: 0)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform +/- jitter on the delay in milliseconds (default: 0)")
+    parser.add_argument("--loss", type=float, default=0.0, help="Fraction of requests silently dropped, 0-1 (default: 0)")
+    parser.add_argument("-w", "--window", type=int, default=1, help="Pipelined read window, as in sploitbus.py (default: 1)")
+    parser.add_argument("--serial", choices=sploitbus.SERIAL_FRAMINGS, help="Run the traffic workloads over a pty pair with RTU or ASCII framing instead of TCP")
+    parser.add_argument("--baudrate", type=int, default=19200, help="Line speed simulated by --serial (default: 19200)")
+    parser.add_argument("-t", "--timeout", type=float, default=1.0, help="Maximum client request timeout in seconds (default: 1)")
+    parser.add_argument("--min-timeout", type=float, default=0.1, help="Lower bound for the adaptive timeout in seconds (default: 0.1)")
+    parser.add_argument("-r", "--retries", type=int, default=2, help="Resends of unanswered requests (default: 2)")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="Requests in flight during the sweep (default: 16)")
+    parser.add_argument("--polls", type=int, default=50, help="Polling rounds in the poll workload (default: 50)")
+    parser.add_argument("--max-rate", type=float, default=0, help="Global polling rate cap, as in sploitbus.py (default: unlimited)")
+    parser.add_argument("--max-unit-rate", type=float, default=0, help="Per-unit polling rate cap (default: unlimited)")
+    parser.add_argument("--writes", type=int, default=20, help="Write operations in the write workload (default: 20)")
+    parser.add_argument("--write-count", type=int, default=500, help="Registers per write operation (default: 500)")
+    parser.add_argument("--verify", choices=sploitbus.VERIFY_POLICIES, default="once", help="Write verification policy (default: once)")
+    parser.add_argument("--startup-runs", type=int, default=10, help="Runs of each command line in the startup workload (default: 10)")
+    parser.add_argument("--startup-budget", type=float, help="Fail (exit status 1) if a sploitbus_cli.py startup median exceeds this many milliseconds")
+    parser.add_argument("--json", action="store_true", help="Print one JSON line per workload instead of a table")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show Sploitbus output and errors while the workloads run")
+    args = parser.parse_args()
+
+    try:
+        args.units = parse_units(args.units)
+    except ValueError as e:
+        parser.error(f"--units: {e}")
+    if not 0 <= args.loss < 1:
+        parser.error("--loss must be between 0 and 1")
+    args.size = max(1, min(args.size, sploitbus.ADDRESS_SPACE))
+    args.latency /= 1000
+    args.jitter /= 1000
+    workloads = args.workloads or list(WORKLOADS) + ["startup"]
+    unknown = [name for name in workloads if name not in WORKLOADS and name != "startup"]
+    if unknown:
+        parser.error(f"unknown workload {unknown[0]!r}, choose from {', '.join(WORKLOADS)}, startup")
+    args.startup_runs = max(1, args.startup_runs)
+
+    if not args.verbose:
+        logging.disable(logging.ERROR)
+    simulator = Simulator(args.units, args.size, args.seed)
+    simulator.start()
+    proxy = FaultProxy(simulator.port, args.units, args.latency, args.jitter, args.loss, args.seed)
+    proxy.start()
+    serial_slave = None
+    if args.serial:
+        serial_slave = SerialSlave(simulator.context, args.units, args.serial, args.baudrate, args.latency, args.jitter, args.loss, args.seed)
+        serial_slave.start()
+
+    if not args.json:
+        if serial_slave is not None:
+            print(Fore.CYAN + f"Serial: {args.serial.upper()} at {args.baudrate} baud on {serial_slave.path}" + Style.RESET_ALL)
+        print(Fore.CYAN + f"Simulator: units {','.join(map(str, args.units))}, {args.size} values per table, "
+              f"latency {args.latency * 1000:g}ms +/- {args.jitter * 1000:g}ms, loss {args.loss:g}, seed {args.seed}" + Style.RESET_ALL)
+    results = []
+    for name in workloads:
+        batch = run_startup(proxy, args) if name == "startup" else [run_workload(name, serial_slave or proxy, args)]
+        results.extend(batch)
+        if args.json:
+            for result in batch:
+                print(json.dumps(result), flush=True)
+    if not args.json:
+        print_results(results)
+    if not all(result.get("within_budget", True) for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+# Launcher for sploitbus.py with the same arguments. Python never caches the
+# bytecode of the script it runs, so this stays tiny and imports sploitbus,
+# whose compiled code is then reused from __pycache__ on every later start.
+from sploitbus import main
+
+if __name__ == "__main__":
+    main()